@@ -6,10 +6,17 @@ class QueryType(str, Enum):
     COMPLEX = "complex"                                                        
     UNDETERMINED = "undetermined"                                              
                                                                                
+class RequestPriority(str, Enum):
+    INTERACTIVE = "interactive" # Physician waiting on the answer
+    BATCH = "batch" # Background/bulk callers; queued behind interactive traffic
+
 class ChatRequest(BaseModel):                                                  
     query: str                                                                 
     patient_id: str # Assuming patient_id is known and provided                
     session_id: str | None = None                                              
+    physician_id: str | None = None # Scopes chat history; anonymous when omitted
+    polish: bool | None = None # Background LLM rewrite of a rendered answer; None = server default
+    priority: RequestPriority = RequestPriority.INTERACTIVE
                                                                                
 class ChatResponse(BaseModel):                                                 
     answer: str                                                                
@@ -17,5 +24,69 @@ class ChatResponse(BaseModel):
     query_type: QueryType                                                      
     # session_id: str | None = None # Echoes session_id from request if provided
     sources: list[dict] | None = None # For RAG, to cite sources (e.g. SQL query)
+    polish_id: str | None = None # Poll GET /polished-answers/{polish_id} for the LLM-polished wording
+    degraded: bool = False # The LLM was unavailable; the answer was built without it
+    stale: bool = False # A backend was unavailable; this is a recent cached answer to the same question
     # error_message: str | None = None                                           
                                       
+
+class PatientSummary(BaseModel):
+    id: str
+    name: str | None = None
+    gender: str | None = None
+    birth_date: str | None = None
+    identifiers: list[str] = [] # Medical record numbers (identifier type MR) only
+
+class PatientListResponse(BaseModel):
+    patients: list[PatientSummary]
+    next_cursor: str | None = None # Pass back as `cursor` to fetch the next page
+
+class ChatHistoryEntry(BaseModel):
+    query: str
+    answer: str
+    query_type: QueryType
+    created_at: str # ISO-8601, UTC
+    sources: list[dict] | None = None
+
+class ChatHistoryResponse(BaseModel):
+    patient_id: str
+    physician_id: str
+    entries: list[ChatHistoryEntry] # Newest first
+    next_cursor: str | None = None # Pass back as `cursor` to fetch older entries
+
+class Demographics(BaseModel):
+    name: str | None = None
+    gender: str | None = None
+    birth_date: str | None = None
+
+class ConditionItem(BaseModel):
+    text: str | None = None
+    recorded_date: str | None = None
+
+class MedicationItem(BaseModel):
+    text: str | None = None
+    authored_on: str | None = None
+
+class AllergyItem(BaseModel):
+    text: str | None = None
+    criticality: str | None = None
+
+class ObservationItem(BaseModel):
+    text: str | None = None
+    value: float | None = None
+    unit: str | None = None
+    value_text: str | None = None # valueString or coded value when there is no quantity
+    effective_date: str | None = None
+
+class PatientOverview(BaseModel):
+    patient_id: str
+    demographics: Demographics
+    conditions: list[ConditionItem] # Active or confirmed
+    medications: list[MedicationItem] # Active
+    allergies: list[AllergyItem] # Active
+    recent_observations: list[ObservationItem] # Latest five
+
+class PolishedAnswer(BaseModel):
+    polish_id: str
+    status: str # "pending", "ready" or "failed"
+    answer: str | None = None
@@ -19,6 +19,92 @@ class Settings:
 
     QUERY_HANDLER_TYPE: str = os.getenv("QUERY_HANDLER_TYPE", "vanna") # "vanna" or "langchain"
 
+    # Speculative execution: race the simple and advanced paths instead of running them back to back
+    SPECULATIVE_EXECUTION: bool = os.getenv("SPECULATIVE_EXECUTION", "false").lower() == "true"
+    SPECULATIVE_BUDGET_SECONDS: float = float(os.getenv("SPECULATIVE_BUDGET_SECONDS", "30"))
+    # Hedged Gemini calls: fire a duplicate request once the first exceeds the p95 latency
+    LLM_HEDGING_ENABLED: bool = os.getenv("LLM_HEDGING_ENABLED", "false").lower() == "true"
+    LLM_HEDGE_DELAY_SECONDS: float = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "4.0")) # Observed p95 of generate_content
+    LLM_CALL_BUDGET_SECONDS: float = float(os.getenv("LLM_CALL_BUDGET_SECONDS", "20"))
+
+    # Admission control: per-backend concurrency limits and bounded wait queues. SQL-generation
+    # chains also take bigquery/vertex_llm slots, so those two cap all BigQuery and Gemini work
+    BIGQUERY_MAX_CONCURRENCY: int = int(os.getenv("BIGQUERY_MAX_CONCURRENCY", "8"))
+    VERTEX_LLM_MAX_CONCURRENCY: int = int(os.getenv("VERTEX_LLM_MAX_CONCURRENCY", "4"))
+    SQL_GENERATION_MAX_CONCURRENCY: int = int(os.getenv("SQL_GENERATION_MAX_CONCURRENCY", "2"))
+    SCHEDULER_MAX_QUEUE: int = int(os.getenv("SCHEDULER_MAX_QUEUE", "32")) # Waiters per backend before shedding
+    REQUEST_DEADLINE_SECONDS: float = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+
+    # Resilience: per-attempt timeouts, jittered retries and circuit breakers
+    BIGQUERY_TIMEOUT_SECONDS: float = float(os.getenv("BIGQUERY_TIMEOUT_SECONDS", "20"))
+    LLM_TIMEOUT_SECONDS: float = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))
+    RETRY_MAX_ATTEMPTS: int = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+    RETRY_BASE_DELAY_SECONDS: float = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.2"))
+    RETRY_MAX_DELAY_SECONDS: float = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "2.0"))
+    BREAKER_FAILURE_THRESHOLD: int = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+    BREAKER_RESET_SECONDS: float = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+    ANSWER_CACHE_TTL_SECONDS: float = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "600")) # Fallback answers when a backend is down
+
+    # Question-aware schema pruning for SQL-generation prompts
+    SCHEMA_STRUCT_DEPTH: int = int(os.getenv("SCHEMA_STRUCT_DEPTH", "2")) # Nested STRUCT levels spelled out in DDLs
+    SCHEMA_MAX_TABLES: int = int(os.getenv("SCHEMA_MAX_TABLES", "4"))
+    SCHEMA_MAX_COLUMNS: int = int(os.getenv("SCHEMA_MAX_COLUMNS", "14"))
+
+    # Local NumPy analytics for lab/vital trend questions instead of LLM-generated SQL
+    TREND_ENGINE_ENABLED: bool = os.getenv("TREND_ENGINE_ENABLED", "true").lower() == "true"
+
+    # Incremental change sync driven by meta.lastUpdated watermarks
+    SYNC_MIRROR_PATH: str = os.getenv("SYNC_MIRROR_PATH", "sync_mirror.sqlite3")
+    SYNC_WATERMARK_PATH: str = os.getenv("SYNC_WATERMARK_PATH", "sync_watermarks.json")
+    SYNC_RESOURCE_TYPES: list[str] = os.getenv(
+        "SYNC_RESOURCE_TYPES",
+        "Patient,Condition,MedicationRequest,Observation,AllergyIntolerance,Encounter,Procedure,Immunization"
+    ).split(",")
+    SYNC_PAGE_SIZE: int = int(os.getenv("SYNC_PAGE_SIZE", "500"))
+    SYNC_INTERVAL_SECONDS: float = float(os.getenv("SYNC_INTERVAL_SECONDS", "0")) # 0 = no background sync in the API worker
+    # e.g. _PARTITIONTIME; prunes pages to recent partitions. Append-only loads only: rows changed by
+    # DML UPDATE stay in their old partition and would be missed
+    SYNC_PARTITION_COLUMN: str | None = os.getenv("SYNC_PARTITION_COLUMN")
+    SYNC_PARTITION_LAG_HOURS: float = float(os.getenv("SYNC_PARTITION_LAG_HOURS", "24")) # Allowed skew between lastUpdated and load time
+
+    # In-memory patient directory behind GET /patients
+    PATIENT_INDEX_REFRESH_SECONDS: float = float(os.getenv("PATIENT_INDEX_REFRESH_SECONDS", "3600"))
+    PATIENT_PAGE_MAX: int = int(os.getenv("PATIENT_PAGE_MAX", "100"))
+
+    # Simple-path answers: "template" renders rows deterministically, "llm" asks Gemini to write them
+    ANSWER_RENDER_MODE: str = os.getenv("ANSWER_RENDER_MODE", "template")
+    ANSWER_POLISH_DEFAULT: bool = os.getenv("ANSWER_POLISH_DEFAULT", "false").lower() == "true" # Background LLM rewrite of rendered answers
+    ANSWER_POLISH_TTL_SECONDS: float = float(os.getenv("ANSWER_POLISH_TTL_SECONDS", "600"))
+
+    # Structured patient overview behind GET /patients/{id}/summary
+    PATIENT_SUMMARY_REVALIDATE_SECONDS: float = float(os.getenv("PATIENT_SUMMARY_REVALIDATE_SECONDS", "60")) # Trust a cached ETag this long before re-fingerprinting
+    PATIENT_SUMMARY_CACHE_SIZE: int = int(os.getenv("PATIENT_SUMMARY_CACHE_SIZE", "1000"))
+    GZIP_MINIMUM_SIZE: int = int(os.getenv("GZIP_MINIMUM_SIZE", "1000")) # Bytes; smaller responses go out uncompressed
+
+    # Chat history: append-only segment log (or SQLite) written in batches off the request path
+    CHAT_HISTORY_BACKEND: str = os.getenv("CHAT_HISTORY_BACKEND", "segment_log") # "segment_log" or "sqlite"
+    CHAT_HISTORY_DIR: str = os.getenv("CHAT_HISTORY_DIR", "chat_history") # Locked by one process; give each worker its own
+    CHAT_HISTORY_SQLITE_PATH: str = os.getenv("CHAT_HISTORY_SQLITE_PATH", "chat_history.sqlite3")
+    CHAT_HISTORY_SEGMENT_BYTES: int = int(os.getenv("CHAT_HISTORY_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+    CHAT_HISTORY_RETENTION_DAYS: float = float(os.getenv("CHAT_HISTORY_RETENTION_DAYS", "0")) # 0 = keep forever
+    CHAT_HISTORY_MAX_PER_CONVERSATION: int = int(os.getenv("CHAT_HISTORY_MAX_PER_CONVERSATION", "0")) # 0 = no cap
+    CHAT_HISTORY_BATCH_SIZE: int = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", "64"))
+    CHAT_HISTORY_FLUSH_SECONDS: float = float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", "0.5"))
+    CHAT_HISTORY_QUEUE_MAX: int = int(os.getenv("CHAT_HISTORY_QUEUE_MAX", "10000"))
+    CHAT_HISTORY_MAINTENANCE_SECONDS: float = float(os.getenv("CHAT_HISTORY_MAINTENANCE_SECONDS", "3600"))
+    CHAT_HISTORY_PAGE_MAX: int = int(os.getenv("CHAT_HISTORY_PAGE_MAX", "100"))
+
+    # Profiling hooks: admin-gated sampling profiles, slow-request and loop-blocking capture
+    ADMIN_TOKEN: str | None = os.getenv("ADMIN_TOKEN") # Unset = admin endpoints and per-request profiling disabled
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "profiles")
+    PROFILE_SAMPLE_INTERVAL_SECONDS: float = float(os.getenv("PROFILE_SAMPLE_INTERVAL_SECONDS", "0.005"))
+    PROFILE_MAX_SECONDS: float = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+    SLOW_REQUEST_SECONDS: float = float(os.getenv("SLOW_REQUEST_SECONDS", "5")) # 0 = no slow-request capture
+    SLOW_REQUEST_CAPTURE_INTERVAL_SECONDS: float = float(os.getenv("SLOW_REQUEST_CAPTURE_INTERVAL_SECONDS", "60")) # At most one capture file per interval
+    PROFILE_MAX_FILES: int = int(os.getenv("PROFILE_MAX_FILES", "200")) # Oldest files in PROFILE_DIR are pruned past this; 0 = no cap
+    PROFILE_MAX_AGE_SECONDS: float = float(os.getenv("PROFILE_MAX_AGE_SECONDS", str(7 * 86400))) # 0 = no age limit
+    LOOP_BLOCK_THRESHOLD_SECONDS: float = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.2")) # 0 = no loop watchdog
+
     # W&B experiment tracking
     WANDB_PROJECT: str = os.getenv("WANDB_PROJECT", "physician-chat")
     WANDB_ENTITY: str | None = os.getenv("WANDB_ENTITY")  # Optional team/org
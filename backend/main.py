@@ -1,69 +1,390 @@
-from fastapi import FastAPI, HTTPException, Depends                            
-from .api.models import ChatRequest, ChatResponse, QueryType                   
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, Header
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response
+from .api.models import ChatRequest, ChatResponse, QueryType, PatientSummary, PatientListResponse, ChatHistoryEntry, ChatHistoryResponse, PatientOverview, PolishedAnswer
 # from .services.query_router import route_query # No longer primary router
 from .services.bigquery_handler import BigQueryHandler, get_bigquery_handler # May still be needed for RAG or direct execution
 from .services.rag_llm_handler import RagLlmHandler, get_rag_llm_handler # May be used for RAG or complex summarization
 from .services.vanna_handler import VannaHandler, get_vanna_handler # Keep for Vanna
 from .services.langchain_sql_handler import LangchainSqlHandler, get_langchain_sql_handler # Add Langchain handler
+from .services.speculative import race_first_acceptable, get_speculation_stats
+from .services.scheduler import OverloadedError, get_scheduler
+from .services.trend_engine import TrendEngine, detect_trend_request
+from .services.query_templates import is_listing_question, match_intents
+from .services.answer_renderer import get_polish_jobs, render_answer
+from .services.change_sync import build_incremental_sync, change_bus
+from .services.patient_index import PatientIndexManager, get_patient_index_manager
+from .services.chat_history import ChatHistory, HistoryEntry, get_chat_history
+from .services.patient_summary import PatientSummaryService, etag_matches, get_patient_summary_service
+from .services.resilience import CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, answer_cache, get_breaker_states
+from .utils.request_context import set_request_context
+from .utils.profiler import get_profiling_hooks, stage, start_stage_trace
 from .config import settings # Import settings to choose handler
+import asyncio
+import hmac
+import time
                                                                                
 app = FastAPI(                                                                 
     title="Physician Chat API",                                                
     description="API for querying patient data from FHIR BigQuery dataset.",   
     version="0.1.0"                                                            
 )                                                                              
+
+app.add_middleware(GZipMiddleware, minimum_size=settings.GZIP_MINIMUM_SIZE)
+
+def _invalidate_cached_answers(resource_type: str, patient_ids: set[str]):
+    for patient_id in patient_ids:
+        answer_cache.invalidate_patient(patient_id)
+
+change_bus.subscribe(_invalidate_cached_answers)
+
+@app.on_event("startup")
+async def start_incremental_sync():
+    # Optional in-process sync loop; can also run standalone via `python -m backend.services.change_sync`
+    if settings.SYNC_INTERVAL_SECONDS > 0:
+        app.state.sync_task = asyncio.create_task(
+            build_incremental_sync().run_forever(settings.SYNC_INTERVAL_SECONDS)
+        )
+
+@app.on_event("startup")
+async def start_chat_history_maintenance():
+    # Opening the store here makes a history directory locked by another worker fail start-up
+    chat_history = get_chat_history()
+    if settings.CHAT_HISTORY_MAINTENANCE_SECONDS > 0:
+        app.state.history_maintenance_task = asyncio.create_task(
+            chat_history.run_maintenance_forever(settings.CHAT_HISTORY_MAINTENANCE_SECONDS)
+        )
+
+@app.on_event("shutdown")
+async def flush_chat_history():
+    # Write out whatever /chat has queued before the worker exits
+    await get_chat_history().close()
+
+@app.on_event("startup")
+async def start_loop_watchdog():
+    hooks = get_profiling_hooks()
+    if hooks.watchdog is not None:
+        hooks.watchdog.start()
+
+def _is_admin(token: str | None) -> bool:
+    return bool(settings.ADMIN_TOKEN and token and hmac.compare_digest(token.encode(), settings.ADMIN_TOKEN.encode()))
+
+async def require_admin(x_admin_token: str | None = Header(None)):
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not _is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.middleware("http")
+async def profile_requests(request: Request, call_next):
+    """
+    Stage timings for every request; for admin requests sent with X-Profile:
+    true, a sampling profile of the whole worker taken while the request runs
+    (concurrent requests appear in it too); and a capture file for requests
+    slower than SLOW_REQUEST_SECONDS, rate-limited to one per
+    SLOW_REQUEST_CAPTURE_INTERVAL_SECONDS. Only the route template is recorded,
+    never the path.
+    """
+    hooks = get_profiling_hooks()
+    started, wall_started = time.perf_counter(), time.time()
+    stages = start_stage_trace()
+    profile_session = None
+    if request.headers.get("X-Profile", "").lower() in ("1", "true") and _is_admin(request.headers.get("X-Admin-Token")):
+        profile_session = hooks.begin_request_profile(settings.PROFILE_MAX_SECONDS)
+    response = None
+    try:
+        response = await call_next(request)
+    finally:
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        if profile_session is not None:
+            profile_name = await asyncio.to_thread(hooks.end_request_profile, profile_session, route)
+            if response is not None:
+                response.headers["X-Profile-File"] = profile_name
+    seconds = time.perf_counter() - started
+    if 0 < hooks.slow_request_seconds <= seconds and hooks.claim_slow_capture():
+        await asyncio.to_thread(
+            hooks.capture_slow_request, route, request.method, response.status_code,
+            started, wall_started, seconds, stages
+        )
+    return response
+
+@app.exception_handler(OverloadedError)
+async def handle_overloaded(request: Request, exc: OverloadedError):
+    # Shed quickly with a retry hint rather than letting the caller time out
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Service is busy ({exc.backend}). Please retry shortly."},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(CircuitOpenError)
+async def handle_circuit_open(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "A data service is temporarily unavailable. Please retry shortly."},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(RetriesExhaustedError)
+async def handle_retries_exhausted(request: Request, exc: RetriesExhaustedError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "A data service is not responding. Please retry shortly."},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(DeadlineExceededError)
+async def handle_deadline_exceeded(request: Request, exc: DeadlineExceededError):
+    return JSONResponse(status_code=504, content={"detail": "The request took too long to process"})
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Per-worker scheduler queue depth/wait times, circuit breaker states and
+    speculative-execution counters.
+    """
+    return {
+        "scheduler": get_scheduler().snapshot(),
+        "breakers": get_breaker_states(),
+        "speculation": get_speculation_stats(),
+        "chat_history": get_chat_history().stats,
+        "profiling": get_profiling_hooks().snapshot()
+    }
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def start_worker_profile(seconds: float = Query(10, gt=0)):
+    """
+    Sample every thread of this worker for `seconds`; the result is written as a
+    flamegraph-compatible .folded file listed under /admin/profiles.
+    """
+    try:
+        name = get_profiling_hooks().start_session(min(seconds, settings.PROFILE_MAX_SECONDS))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"profile": name, "seconds": min(seconds, settings.PROFILE_MAX_SECONDS)}
+
+@app.get("/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = Query(100, ge=1, le=1000)):
+    # Newest first; PROFILE_MAX_FILES and PROFILE_MAX_AGE_SECONDS bound what is kept
+    return {"profiles": get_profiling_hooks().list_profiles(limit)}
+
+@app.get("/admin/profiles/{name}", dependencies=[Depends(require_admin)])
+async def download_profile(name: str):
+    path = get_profiling_hooks().profile_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FileResponse(path, media_type="application/json" if name.endswith(".json") else "text/plain")
                                                                                
-@app.post("/chat", response_model=ChatResponse)                                
-async def handle_chat_request(                                                 
-    request: ChatRequest,                                                      
-    bq_handler: BigQueryHandler = Depends(get_bigquery_handler),               
-    rag_handler: RagLlmHandler = Depends(get_rag_llm_handler)
-    # Specific handlers will be resolved based on config
-):                                                                             
-    """                                                                        
-    Handles incoming chat requests, routes them, and returns a response.       
-    Uses either Vanna.AI or Langchain for text-to-SQL and response generation based on configuration.
-    """                                                                        
-    nl_answer_str: str | None = None
-    sql_query_str: str | None = None
+ANONYMOUS_PHYSICIAN_ID = "anonymous"
 
-    # Validate patient_id is present and not empty
-    if not request.patient_id or not request.patient_id.strip():
-        raise HTTPException(status_code=400, detail="Patient ID is required")
-    
-    # Check if this is a simple query that can be handled directly by BigQuery handler
-    if any(keyword in request.query.lower() for keyword in [
-        "medication", "allergy", "allergies", "condition", "diagnosis", 
-        "lab", "test", "result", "vital", "bp", "blood pressure"
-    ]):
-        try:
-            # Try to handle as a simple query first
-            results = await bq_handler.handle_simple_query(
-                patient_id=request.patient_id,
-                query_text=request.query
+@app.get("/patients", response_model=PatientListResponse)
+async def list_patients(
+    q: str | None = Query(None, description="Name, identifier or ID prefix; every word must match"),
+    limit: int = Query(25, ge=1),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    index_manager: PatientIndexManager = Depends(get_patient_index_manager)
+):
+    """
+    Lists patients in name order with prefix search and keyset pagination,
+    served from the in-memory patient index.
+    """
+    index = await index_manager.get_index()
+    try:
+        records, next_cursor = index.search(q, min(limit, settings.PATIENT_PAGE_MAX), cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return PatientListResponse(
+        patients=[PatientSummary(**record.to_dict()) for record in records],
+        next_cursor=next_cursor
+    )
+
+@app.get("/patients/{patient_id}", response_model=PatientSummary)
+async def get_patient(
+    patient_id: str,
+    index_manager: PatientIndexManager = Depends(get_patient_index_manager)
+):
+    """
+    Patient metadata (not the full EHR) from the in-memory patient index.
+    """
+    record = (await index_manager.get_index()).get(patient_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return PatientSummary(**record.to_dict())
+
+@app.get("/chat/{patient_id}/history", response_model=ChatHistoryResponse)
+async def get_chat_history_page(
+    patient_id: str,
+    physician_id: str = Query(ANONYMOUS_PHYSICIAN_ID),
+    limit: int = Query(20, ge=1),
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    chat_history: ChatHistory = Depends(get_chat_history)
+):
+    """
+    One physician's conversation about one patient, newest first, served from
+    the history index (cost grows with the page, not the history).
+
+    Limitation: physician_id is a free query parameter, not an authenticated
+    identity, so any caller can read any physician's history. Deploy behind an
+    auth layer that pins physician_id to the signed-in user.
+    """
+    try:
+        entries, next_cursor = await chat_history.read_page(
+            physician_id, patient_id, min(limit, settings.CHAT_HISTORY_PAGE_MAX), cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ChatHistoryResponse(
+        patient_id=patient_id,
+        physician_id=physician_id,
+        entries=[
+            ChatHistoryEntry(
+                query=entry.query,
+                answer=entry.answer,
+                query_type=entry.query_type,
+                created_at=entry.created_at_iso(),
+                sources=entry.sources
             )
-            
-            # If we got results (not an error), generate a natural language answer
-            if results and not (isinstance(results, list) and results and "error" in results[0]):
-                nl_answer_str = await rag_handler.generate_summary_from_data(
-                    structured_data=results,
-                    original_query=request.query
-                )
-                # Extract the SQL query from the BigQuery handler if possible
-                # This would require adding a method to track the last query
-                sql_query_str = "Simple query handled by BigQuery handler"
-                
-                return ChatResponse(
-                    answer=nl_answer_str, 
-                    patient_id=request.patient_id,
-                    query_type=QueryType.SIMPLE,
-                    sources=[{"sql_query": sql_query_str, "result_count": len(results)}]
+            for entry in entries
+        ],
+        next_cursor=next_cursor
+    )
+
+@app.get("/patients/{patient_id}/summary", response_model=PatientOverview)
+async def get_patient_overview(
+    patient_id: str,
+    if_none_match: str | None = Header(None),
+    summary_service: PatientSummaryService = Depends(get_patient_summary_service)
+):
+    """
+    Structured overview (demographics, conditions, medications, allergies, recent
+    observations) with an ETag fingerprinting the source rows; a matching
+    If-None-Match gets 304 with no body.
+    """
+    summary = await summary_service.get(patient_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    # PHI: private caches only, and always revalidate
+    headers = {"ETag": summary.etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, summary.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=summary.body, media_type="application/json", headers=headers)
+
+@app.get("/polished-answers/{polish_id}", response_model=PolishedAnswer)
+async def get_polished_answer(polish_id: str):
+    """
+    LLM-polished wording for a /chat answer that returned a polish_id.
+    """
+    job = get_polish_jobs().get(polish_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired polish_id")
+    return PolishedAnswer(polish_id=polish_id, **job)
+
+SECURITY_REFUSAL_ANSWER = "I'm sorry, but I cannot process this request due to security constraints. All queries must be limited to the specified patient's data."
+
+async def _run_simple_path(
+    request: ChatRequest,
+    bq_handler: BigQueryHandler,
+    rag_handler: RagLlmHandler
+) -> ChatResponse | None:
+    """
+    Registry-matched direct BigQuery lookup. Plain listing questions are rendered
+    without the LLM unless ANSWER_RENDER_MODE is "llm"; questions with a qualifier
+    (a drug, test, indication or year) have the LLM read the rows against the
+    question. Returns None when the simple path failed or found nothing, so the
+    caller can fall through to the advanced handlers.
+    """
+    try:
+        # Try to handle as a simple query first
+        results = await bq_handler.handle_simple_query(
+            patient_id=request.patient_id,
+            query_text=request.query
+        )
+        if results and "error" in results[0]:
+            return None
+
+        intents = [template.intent for template in match_intents(request.query)]
+        if not results:
+            # Nothing found may mean the wrong table; the advanced handlers get a chance
+            return None
+        polish_id = None
+        deterministic = settings.ANSWER_RENDER_MODE != "llm" and is_listing_question(request.query)
+        if not deterministic:
+            nl_answer_str = await rag_handler.generate_summary_from_data(
+                structured_data=results,
+                original_query=request.query
+            )
+        else:
+            if {row["intent"] for row in results} != set(intents):
+                # Part of the question found nothing; a partial list would read as complete
+                return None
+            # Rows are already exact answers; rendering takes microseconds
+            nl_answer_str = render_answer(results)
+            polish = request.polish if request.polish is not None else settings.ANSWER_POLISH_DEFAULT
+            if polish:
+                polish_id = get_polish_jobs().submit(
+                    lambda: rag_handler.polish_answer(nl_answer_str, request.query)
                 )
-        except Exception as e:
-            print(f"Error in simple query handling: {e}")
-            # Continue to advanced handlers if simple query fails
+        # Extract the SQL query from the BigQuery handler if possible
+        # This would require adding a method to track the last query
+        sql_query_str = "Simple query handled by BigQuery handler"
+        
+        return ChatResponse(
+            answer=nl_answer_str, 
+            patient_id=request.patient_id,
+            query_type=QueryType.SIMPLE,
+            sources=[{"sql_query": sql_query_str, "intents": intents, "result_count": len(results)}],
+            polish_id=polish_id,
+            degraded=not deterministic and rag_handler.used_fallback
+        )
+    except (OverloadedError, DeadlineExceededError, RetriesExhaustedError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        print(f"Error in simple query handling: {e}")
+        # Continue to advanced handlers if simple query fails
+    return None
+
+async def _run_trend_path(
+    request: ChatRequest,
+    bq_handler: BigQueryHandler,
+    rag_handler: RagLlmHandler
+) -> ChatResponse | None:
+    """
+    Lab/vital trend questions are answered from NumPy-computed facts over the full
+    observation series. Returns None when the question is not a recognised trend
+    question or the patient has no matching observations.
+    """
+    trend_request = detect_trend_request(request.query)
+    if trend_request is None:
+        return None
+    try:
+        built = await TrendEngine(bq_handler).build_fact_sheet(request.patient_id, trend_request)
+        if built is None:
+            return None
+        fact_sheet, series_list = built
+        nl_answer_str = await rag_handler.generate_answer_from_facts(fact_sheet, request.query)
+        return ChatResponse(
+            answer=nl_answer_str,
+            patient_id=request.patient_id,
+            query_type=QueryType.SIMPLE,
+            degraded=rag_handler.used_fallback,
+            sources=[{
+                "engine": "observation_trend",
+                "loinc_codes": trend_request.loinc_codes,
+                "result_count": sum(series.facts["count"] for series in series_list)
+            }]
+        )
+    except (OverloadedError, DeadlineExceededError, RetriesExhaustedError, asyncio.CancelledError):
+        raise
+    except Exception as e:
+        print(f"Error in trend engine: {e}")
+        return None
 
-    # If simple query handling didn't return, proceed with advanced handlers
+async def _run_advanced_path(request: ChatRequest) -> ChatResponse:
+    """
+    Text-to-SQL path through Vanna.AI or Langchain, selected by QUERY_HANDLER_TYPE.
+    """
+    nl_answer_str: str | None = None
+    sql_query_str: str | None = None
     try:
         if settings.QUERY_HANDLER_TYPE == "langchain":
             print("Using Langchain SQL Handler")
@@ -76,7 +397,7 @@ async def handle_chat_request(
             except PermissionError as e:
                 # Handle security violations by returning a safe error message
                 return ChatResponse(
-                    answer="I'm sorry, but I cannot process this request due to security constraints. All queries must be limited to the specified patient's data.",
+                    answer=SECURITY_REFUSAL_ANSWER,
                     patient_id=request.patient_id,
                     query_type=QueryType.UNDETERMINED,
                     sources=None
@@ -93,7 +414,7 @@ async def handle_chat_request(
             except PermissionError as e:
                 # Handle security violations by returning a safe error message
                 return ChatResponse(
-                    answer="I'm sorry, but I cannot process this request due to security constraints. All queries must be limited to the specified patient's data.",
+                    answer=SECURITY_REFUSAL_ANSWER,
                     patient_id=request.patient_id,
                     query_type=QueryType.UNDETERMINED,
                     sources=None
@@ -112,6 +433,102 @@ async def handle_chat_request(
             query_type=response_query_type,
             sources=[{"sql_query": sql_query_str}] if sql_query_str else None
         )
+    except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, HTTPException, OverloadedError, asyncio.CancelledError):
+        # Dependency failures reach handle_chat_request, which may serve a cached answer
+        raise
     except Exception as e:
         print(f"Error processing chat request: {e}")
         raise HTTPException(status_code=500, detail="An error occurred while processing your request")
+
+async def _run_speculative(
+    request: ChatRequest,
+    bq_handler: BigQueryHandler,
+    rag_handler: RagLlmHandler
+) -> ChatResponse:
+    """
+    Starts the simple and advanced paths together and keeps the first acceptable
+    answer. A simple-path None is not acceptable, so the advanced path keeps running.
+    An UNDETERMINED advanced answer (an error or refusal message) is only used once
+    the simple path has finished without an answer.
+    """
+    try:
+        winner, response = await race_first_acceptable(
+            {
+                "simple": lambda: _run_simple_path(request, bq_handler, rag_handler),
+                "advanced": lambda: _run_advanced_path(request),
+            },
+            accept=lambda name, result: result is not None and result.query_type != QueryType.UNDETERMINED,
+            budget_seconds=settings.SPECULATIVE_BUDGET_SECONDS,
+            fallback=lambda name, result: result is not None,
+        )
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="The request took too long to process")
+    print(f"Speculative execution winner: {winner}")
+    if response is None:
+        raise HTTPException(status_code=500, detail="An error occurred while processing your request")
+    return response
+
+@app.post("/chat", response_model=ChatResponse)                                
+async def handle_chat_request(                                                 
+    request: ChatRequest,                                                      
+    bq_handler: BigQueryHandler = Depends(get_bigquery_handler),               
+    rag_handler: RagLlmHandler = Depends(get_rag_llm_handler)
+    # Specific handlers will be resolved based on config
+):                                                                             
+    """                                                                        
+    Handles incoming chat requests, routes them, and returns a response.       
+    Uses either Vanna.AI or Langchain for text-to-SQL and response generation based on configuration.
+    Lab/vital trend questions go to the local trend engine first. With
+    SPECULATIVE_EXECUTION enabled, keyword-matched questions race both paths.
+    """                                                                        
+    # Validate patient_id is present and not empty
+    if not request.patient_id or not request.patient_id.strip():
+        raise HTTPException(status_code=400, detail="Patient ID is required")
+
+    # Priority and deadline drive admission control for every backend call below
+    set_request_context(priority=request.priority.value, timeout_seconds=settings.REQUEST_DEADLINE_SECONDS)
+    
+    # Check if this is a simple query that can be handled directly by BigQuery handler
+    is_simple_candidate = bool(match_intents(request.query))
+
+    try:
+        # Trend questions about known labs/vitals are answered locally from the full series
+        response = None
+        if settings.TREND_ENGINE_ENABLED:
+            with stage("trend_path"):
+                response = await _run_trend_path(request, bq_handler, rag_handler)
+
+        if response is None and is_simple_candidate:
+            if settings.SPECULATIVE_EXECUTION:
+                with stage("speculative"):
+                    response = await _run_speculative(request, bq_handler, rag_handler)
+            else:
+                with stage("simple_path"):
+                    response = await _run_simple_path(request, bq_handler, rag_handler)
+        if response is None:
+            # If simple query handling didn't return, proceed with advanced handlers
+            with stage("advanced_path"):
+                response = await _run_advanced_path(request)
+    except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError) as e:
+        # A dependency is down or out of budget on whichever path ran: serve a recent answer
+        # if we have one, marked as such
+        cached_response = answer_cache.get(request.patient_id, request.query)
+        if cached_response is None:
+            raise
+        print(f"Serving cached answer after backend failure: {e}")
+        response = cached_response.model_copy(update={"stale": True})
+
+    # Only full answers are worth replaying during an outage; fallbacks and replays are not
+    if response.query_type != QueryType.UNDETERMINED and not (response.degraded or response.stale):
+        # polish_id points at a one-off job on this worker; a replayed answer must not carry it
+        answer_cache.put(request.patient_id, request.query, response.model_copy(update={"polish_id": None}))
+    # Enqueue only; the history writer persists it in the background
+    get_chat_history().record(HistoryEntry(
+        physician_id=request.physician_id or ANONYMOUS_PHYSICIAN_ID,
+        patient_id=request.patient_id,
+        query=request.query,
+        answer=response.answer,
+        query_type=response.query_type.value,
+        sources=response.sources
+    ))
+    return response
@@ -0,0 +1,208 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from ..config import settings
+from ..utils.request_context import BATCH, set_request_context
+from .query_templates import TEMPLATES, TEMPLATES_BY_INTENT
+
+NO_DATA_ANSWER = "No matching information was found for this patient."
+ERROR_ANSWER = "This request could not be processed. Please try rephrasing your question."
+
+
+def _date(value) -> str | None:
+    # FHIR dates arrive as strings or date/datetime objects; the day is enough here
+    return str(value)[:10] if value else None
+
+
+def _number(value, unit) -> str:
+    if value is None:
+        return "no value"
+    text = f"{value:g}" if isinstance(value, float) else str(value)
+    return f"{text} {unit}" if unit else text
+
+
+def _vital_value(row: dict) -> str:
+    # Blood pressure panels carry systolic/diastolic components instead of a single value
+    if row.get("value") is None and (row.get("systolic") is not None or row.get("diastolic") is not None):
+        return _number(row.get("systolic"), None) + "/" + _number(row.get("diastolic"), "mmHg")
+    return _number(row.get("value"), row.get("unit"))
+
+
+def _join(*parts) -> str:
+    return ", ".join(part for part in parts if part)
+
+
+def _dated(label: str, value) -> str | None:
+    date = _date(value)
+    return f"{label} {date}" if date else None
+
+
+@dataclass(frozen=True)
+class RenderSpec:
+    """
+    How one intent's rows read as text. Rows sharing `key_columns` collapse to
+    the newest one, annotated with how many times it appeared.
+    """
+    heading: str
+    key_columns: tuple[str, ...]
+    line: Callable[[dict], str]
+
+
+RENDER_SPECS = {
+    "medications": RenderSpec(
+        "Medications", ("medication_name", "status"),
+        lambda r: _join(r.get("medication_name") or "Unnamed medication", r.get("status"), _dated("prescribed", r.get("prescribed_date"))),
+    ),
+    "allergies": RenderSpec(
+        "Allergies", ("allergy_name",),
+        lambda r: _join(r.get("allergy_name") or "Unnamed allergy", r.get("severity") and f"{r['severity']} criticality", _dated("recorded", r.get("recorded_date"))),
+    ),
+    "conditions": RenderSpec(
+        "Conditions", ("condition_name",),
+        lambda r: _join(r.get("condition_name") or "Unnamed condition", r.get("status"), _dated("recorded", r.get("recorded_date"))),
+    ),
+    "labs": RenderSpec(
+        "Recent lab results", ("test_name",),
+        lambda r: f"{r.get('test_name') or 'Lab test'}: " + _join(_number(r.get("value"), r.get("unit")), _date(r.get("test_date"))),
+    ),
+    "vitals": RenderSpec(
+        "Recent vital signs", ("vital_sign",),
+        lambda r: f"{r.get('vital_sign') or 'Vital sign'}: " + _join(_vital_value(r), _date(r.get("recorded_date"))),
+    ),
+    "encounters": RenderSpec(
+        "Encounters", ("encounter_type", "start_date"),
+        lambda r: _join(r.get("encounter_type") or "Encounter", r.get("encounter_class"), r.get("status"), _date(r.get("start_date"))),
+    ),
+    "procedures": RenderSpec(
+        "Procedures", ("procedure_name", "performed_date"),
+        lambda r: _join(r.get("procedure_name") or "Unnamed procedure", r.get("status"), _dated("performed", r.get("performed_date"))),
+    ),
+    "immunizations": RenderSpec(
+        "Immunizations", ("vaccine_name",),
+        lambda r: _join(r.get("vaccine_name") or "Unnamed vaccine", _dated("last given", r.get("administered_date"))),
+    ),
+    "care_plans": RenderSpec(
+        "Care plans", ("plan_category", "status"),
+        lambda r: _join(r.get("plan_category") or "Care plan", r.get("status"), _dated("started", r.get("start_date"))),
+    ),
+}
+
+_unrendered = {template.intent for template in TEMPLATES} - set(RENDER_SPECS)
+if _unrendered:
+    raise ValueError(f"No render spec for intents: {sorted(_unrendered)}")
+
+
+def _render_section(intent: str, rows: list[dict]) -> str:
+    spec = RENDER_SPECS[intent]
+    template = TEMPLATES_BY_INTENT[intent]
+    date_column = template.date_column
+    # Newest first; undated rows last
+    ordered = sorted(rows, key=lambda r: str(r.get(date_column) or ""), reverse=True) if date_column else rows
+
+    seen: dict[tuple, list] = {}
+    for row in ordered:
+        key = tuple(str(row.get(column) or "").strip().lower() for column in spec.key_columns)
+        if key in seen:
+            seen[key][1] += 1
+        else:
+            seen[key] = [row, 1]
+
+    # A full page means the template's LIMIT cut older records off; say so rather than imply completeness
+    truncated = f", from the latest {template.max_rows} records" if len(rows) >= template.max_rows else ""
+    lines = [f"{spec.heading} ({len(seen)}{truncated}):"]
+    for row, count in seen.values():
+        lines.append(f"- {spec.line(row)}" + (f" (latest of {count})" if count > 1 else ""))
+    return "\n".join(lines)
+
+
+def render_answer(rows: list[dict]) -> str:
+    """
+    Deterministic answer for simple-path rows (each tagged with its `intent`):
+    one section per intent in registry order, duplicates collapsed, newest first.
+    """
+    if rows and "error" in rows[0]:
+        return ERROR_ANSWER
+    grouped: dict[str, list[dict]] = {}
+    for row in rows:
+        grouped.setdefault(row.get("intent"), []).append(row)
+
+    sections = [
+        _render_section(template.intent, grouped[template.intent])
+        for template in TEMPLATES if template.intent in grouped
+    ]
+    # Rows from outside the registry are listed field by field
+    untemplated = [row for intent, rows in grouped.items() if intent not in RENDER_SPECS for row in rows]
+    if untemplated:
+        lines = ["Here is what I found:"]
+        for row in untemplated:
+            values = [f"{key.replace('_', ' ')}: {value}" for key, value in row.items() if value is not None and key != "intent"]
+            lines.append("- " + ", ".join(values))
+        sections.append("\n".join(lines))
+    if not sections:
+        return NO_DATA_ANSWER
+    return "\n\n".join(sections)
+
+
+class PolishJobs:
+    """
+    Optional LLM rewrites of rendered answers. The deterministic answer is
+    returned immediately; the rewrite runs in the background at batch priority
+    and is fetched later by id. Finished jobs are kept for `ttl_seconds`.
+    """
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, ttl_seconds: float, max_jobs: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._jobs: OrderedDict[str, dict] = OrderedDict()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._jobs:
+            oldest = next(iter(self._jobs.values()))
+            if now - oldest["created_at"] < self.ttl_seconds and len(self._jobs) <= self.max_jobs:
+                break
+            self._jobs.popitem(last=False)
+
+    def submit(self, polish: Callable[[], Awaitable[str | None]]) -> str:
+        self._expire()
+        polish_id = uuid.uuid4().hex
+        job = {"status": self.PENDING, "answer": None, "created_at": time.monotonic()}
+        self._jobs[polish_id] = job
+
+        async def run():
+            # Polishing is an upgrade; it must not compete with interactive requests
+            set_request_context(priority=BATCH, timeout_seconds=settings.LLM_CALL_BUDGET_SECONDS)
+            try:
+                answer = await polish()
+            except Exception as e:
+                print(f"Answer polishing failed: {e}")
+                answer = None
+            job["answer"] = answer
+            job["status"] = self.READY if answer else self.FAILED
+
+        job["task"] = asyncio.create_task(run())
+        return polish_id
+
+    def get(self, polish_id: str) -> dict | None:
+        self._expire()
+        job = self._jobs.get(polish_id)
+        if job is None:
+            return None
+        return {"status": job["status"], "answer": job["answer"]}
+
+
+_polish_jobs: PolishJobs | None = None
+
+def get_polish_jobs() -> PolishJobs:
+    # One job table per worker; polish ids are only valid on the worker that issued them
+    global _polish_jobs
+    if _polish_jobs is None:
+        _polish_jobs = PolishJobs(settings.ANSWER_POLISH_TTL_SECONDS)
+    return _polish_jobs
@@ -1,6 +1,16 @@
 from google.cloud import bigquery                                              
 from ..config import settings                                                  
 import asyncio # For running synchronous client calls in a thread
+import concurrent.futures
+from .scheduler import get_scheduler
+from .resilience import call_with_resilience
+from .query_templates import QueryTemplate, build_combined_query, match_intents
+
+def _cancel_job(query_job) -> None:
+    try:
+        query_job.cancel()
+    except Exception as e:
+        print(f"Could not cancel BigQuery job {query_job.job_id}: {e}")
                                                                                
 class BigQueryHandler:
     def __init__(self, job_exec_project_id: str, data_source_project_id: str, dataset_id: str):
@@ -16,92 +26,39 @@ class BigQueryHandler:
             "condition": f"{data_source_project_id}.{dataset_id}.Condition",
             "observation": f"{data_source_project_id}.{dataset_id}.Observation", # For lab results, vitals
             "allergyintolerance": f"{data_source_project_id}.{dataset_id}.AllergyIntolerance",
+            "encounter": f"{data_source_project_id}.{dataset_id}.Encounter",
+            "procedure": f"{data_source_project_id}.{dataset_id}.Procedure",
+            "immunization": f"{data_source_project_id}.{dataset_id}.Immunization",
+            "careplan": f"{data_source_project_id}.{dataset_id}.CarePlan",
         }
                                                                                
-    async def handle_simple_query(self, patient_id: str, query_text: str) -> list[dict]:                                                                     
-        """                                                                    
-        Handles simple, direct queries to BigQuery based on parsed intent from query_text.                                                                     
-        This is a placeholder for specific query construction logic.           
-        """                                                                    
-        # Example: "List medications for patient X"                            
-        # This would be further parsed to identify the target resource (MedicationRequest)                                                             
-        # and construct the appropriate SQL query.                             
-                                                                               
-        # Placeholder logic - replace with actual query construction           
-        # based on query_text analysis (e.g. identify "medications","allergies")                                                                    
-        if "medication" in query_text.lower():                                 
-            # IMPORTANT: Always use parameterized queries to prevent SQL injection                                                                       
-            sql_query = f"""                                                   
-                SELECT M.medicationCodeableConcept.text as medication_name,
-                       M.status as status,
-                       M.authoredOn as prescribed_date                      
-                FROM `{self.fhir_base_tables['medicationrequest']}` AS M       
-                WHERE M.subject.patientId = @patient_id
-                ORDER BY M.authoredOn DESC                      
-            """                                                                
-            query_params = [bigquery.ScalarQueryParameter("patient_id","STRING", patient_id)]   
-            print("SQL_query:", sql_query)   
-            print("Query_params:", query_params) 
-
-        elif "allergies" in query_text.lower() or "allergy" in query_text.lower():                                
-            sql_query = f"""                                                  
-                SELECT A.code.text as allergy_name,
-                       A.criticality as severity,
-                       A.recordedDate as recorded_date                                          
-                FROM `{self.fhir_base_tables['allergyintolerance']}` AS A      
-                WHERE A.patient.patientId = @patient_id
-                ORDER BY A.recordedDate DESC                        
-            """                                                                
-            query_params = [bigquery.ScalarQueryParameter("patient_id","STRING", patient_id)]
-        
-        elif "condition" in query_text.lower() or "diagnosis" in query_text.lower():
-            sql_query = f"""
-                SELECT C.code.text as condition_name,
-                       (SELECT cs.code FROM UNNEST(C.clinicalStatus.coding) AS cs LIMIT 1) as status,
-                       C.recordedDate as recorded_date
-                FROM `{self.fhir_base_tables['condition']}` AS C
-                WHERE C.subject.patientId = @patient_id
-                ORDER BY C.recordedDate DESC
-            """
-            query_params = [bigquery.ScalarQueryParameter("patient_id","STRING", patient_id)]
-        
-        elif "lab" in query_text.lower() or "test" in query_text.lower() or "result" in query_text.lower():
-            sql_query = f"""
-                SELECT O.code.text as test_name,
-                       O.valueQuantity.value as value,
-                       O.valueQuantity.unit as unit,
-                       O.effectiveDateTime as test_date
-                FROM `{self.fhir_base_tables['observation']}` AS O
-                WHERE O.subject.patientId = @patient_id
-                AND EXISTS (SELECT 1 FROM UNNEST(O.category) AS cat 
-                           JOIN UNNEST(cat.coding) AS cat_coding 
-                           WHERE cat_coding.code = 'laboratory')
-                ORDER BY O.effectiveDateTime DESC
-                LIMIT 10
-            """
-            query_params = [bigquery.ScalarQueryParameter("patient_id","STRING", patient_id)]
-        
-        elif "vital" in query_text.lower() or "bp" in query_text.lower() or "blood pressure" in query_text.lower():
-            sql_query = f"""
-                SELECT O.code.text as vital_sign,
-                       O.valueQuantity.value as value,
-                       O.valueQuantity.unit as unit,
-                       O.effectiveDateTime as recorded_date
-                FROM `{self.fhir_base_tables['observation']}` AS O
-                WHERE O.subject.patientId = @patient_id
-                AND EXISTS (SELECT 1 FROM UNNEST(O.category) AS cat 
-                           JOIN UNNEST(cat.coding) AS cat_coding 
-                           WHERE cat_coding.code = 'vital-signs')
-                ORDER BY O.effectiveDateTime DESC
-                LIMIT 10
-            """
-            query_params = [bigquery.ScalarQueryParameter("patient_id","STRING", patient_id)]
-                                                                
-        else:                                                                  
-            return [{"error": "Unsupported simple query type."}]               
-                                                                               
-        # Use the _run_query helper to execute the query asynchronously
-        return await self._run_query(sql_query, query_params)
+    async def fetch_intents(self, patient_id: str, templates: list[QueryTemplate]) -> dict[str, list[dict]]:
+        """
+        Runs the given registry templates for one patient as a single BigQuery job
+        and returns {intent: rows}.
+        """
+        sql_query = build_combined_query(templates, self.fhir_base_tables)
+        # IMPORTANT: Always use parameterized queries to prevent SQL injection
+        query_params = [bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id)]
+        results = await self._run_query(sql_query, query_params)
+        row = results[0] if results else {}
+        return {template.intent: [dict(item) for item in row.get(template.intent) or []] for template in templates}
+
+    async def handle_simple_query(self, patient_id: str, query_text: str) -> list[dict]:
+        """
+        Handles simple, direct queries to BigQuery: every registry intent named in
+        query_text (e.g. "meds and allergies") is answered by one combined job.
+        Each returned row carries its `intent`.
+        """
+        templates = match_intents(query_text)
+        if not templates:
+            return [{"error": "Unsupported simple query type."}]
+        rows_by_intent = await self.fetch_intents(patient_id, templates)
+        return [
+            {"intent": intent, **row}
+            for intent, rows in rows_by_intent.items()
+            for row in rows
+        ]
 
     async def _run_query(self, sql_query: str, query_params: list[bigquery.ScalarQueryParameter] | None = None) -> list[dict]:
         """
@@ -119,114 +76,270 @@ class BigQueryHandler:
             if "patientId" not in sql_query and "patient.id" not in sql_query.lower():
                 raise PermissionError(f"Query security violation: Missing patient filter for {patient_id}")
         
+        started_jobs = []
+
         # This is the synchronous part that will be run in a separate thread
-        def sync_bq_call():
-            query_job = self.client.query(sql_query, job_config=job_config)
-            return [dict(row) for row in query_job.result()]
+        def sync_bq_call(timeout: float | None):
+            query_job = self.client.query(sql_query, job_config=job_config, timeout=timeout)
+            started_jobs.append(query_job)
+            try:
+                return [dict(row) for row in query_job.result(timeout=timeout)]
+            except concurrent.futures.TimeoutError:
+                # Giving up on the job must not leave it running (and billing) in BigQuery
+                _cancel_job(query_job)
+                raise
 
         # For Python 3.9+. For older versions, use loop.run_in_executor(None, sync_bq_call)
-        results = await asyncio.to_thread(sync_bq_call)
+        # Admission control caps concurrent BigQuery jobs per worker; the resilience layer
+        # bounds each attempt by the request deadline and retries transient failures
+        try:
+            async with get_scheduler().slot("bigquery"):
+                results = await call_with_resilience(
+                    lambda timeout: asyncio.to_thread(sync_bq_call, timeout),
+                    backend="bigquery",
+                    attempt_timeout=settings.BIGQUERY_TIMEOUT_SECONDS
+                )
+        except BaseException:
+            # e.g. a cancelled race branch or an abandoned attempt: stop its job server-side
+            for query_job in started_jobs:
+                if not query_job.done(reload=False):
+                    asyncio.get_running_loop().run_in_executor(None, _cancel_job, query_job)
+            raise
         return results
 
+    async def fetch_patient_directory(self, patient_ids: list[str] | None = None) -> list[dict]:
+        """
+        Fetches compact directory rows (id, display name, gender, birth date, medical
+        record numbers) for every patient, or only for patient_ids when given.
+        """
+        directory_sql = f"""
+            SELECT P.id AS id,
+                   (SELECT COALESCE(n.text, TRIM(CONCAT(ARRAY_TO_STRING(n.given, ' '), ' ', IFNULL(n.family, ''))))
+                    FROM UNNEST(P.name) AS n LIMIT 1) AS name,
+                   P.gender AS gender,
+                   P.birthDate AS birthDate,
+                   -- Medical record numbers only; SSN, driver's licence and passport identifiers never leave BigQuery
+                   ARRAY(
+                       SELECT i.value FROM UNNEST(P.identifier) AS i
+                       WHERE i.value IS NOT NULL
+                       AND EXISTS (SELECT 1 FROM UNNEST(i.type.coding) AS t WHERE t.code = 'MR')
+                   ) AS identifiers
+            FROM `{self.fhir_base_tables['patient']}` AS P
+        """
+        query_params = None
+        if patient_ids is not None:
+            directory_sql += "WHERE P.id IN UNNEST(@patient_ids)"
+            query_params = [bigquery.ArrayQueryParameter("patient_ids", "STRING", patient_ids)]
+        return await self._run_query(directory_sql, query_params)
+
+    async def fetch_observation_series(self, patient_id: str, loinc_codes: list[str], since=None) -> list[dict]:
+        """
+        Fetches every numeric Observation (and Observation component, e.g. BP panels)
+        for the given LOINC codes in a single job, aggregated to one row per code and unit
+        with time-ordered `times` (epoch seconds) and `vals` arrays. Values recorded in
+        different units are never merged into one series.
+        """
+        series_sql = f"""
+            WITH points AS (
+                SELECT coding.code AS loinc_code,
+                       COALESCE(O.code.text, coding.display) AS label,
+                       O.valueQuantity.unit AS unit,
+                       O.valueQuantity.value AS value,
+                       TIMESTAMP(O.effectiveDateTime) AS effective_at
+                FROM `{self.fhir_base_tables['observation']}` AS O, UNNEST(O.code.coding) AS coding
+                WHERE O.subject.patientId = @patient_id
+                AND coding.system = 'http://loinc.org'
+                AND coding.code IN UNNEST(@loinc_codes)
+                AND O.valueQuantity.value IS NOT NULL
+                UNION ALL
+                SELECT comp_coding.code AS loinc_code,
+                       COALESCE(comp.code.text, comp_coding.display) AS label,
+                       comp.valueQuantity.unit AS unit,
+                       comp.valueQuantity.value AS value,
+                       TIMESTAMP(O.effectiveDateTime) AS effective_at
+                FROM `{self.fhir_base_tables['observation']}` AS O,
+                     UNNEST(O.component) AS comp, UNNEST(comp.code.coding) AS comp_coding
+                WHERE O.subject.patientId = @patient_id
+                AND comp_coding.system = 'http://loinc.org'
+                AND comp_coding.code IN UNNEST(@loinc_codes)
+                AND comp.valueQuantity.value IS NOT NULL
+            )
+            SELECT loinc_code,
+                   ANY_VALUE(label) AS label,
+                   unit,
+                   ARRAY_AGG(UNIX_SECONDS(effective_at) ORDER BY effective_at) AS times,
+                   ARRAY_AGG(value ORDER BY effective_at) AS vals
+            FROM points
+            WHERE @since IS NULL OR effective_at >= @since
+            GROUP BY loinc_code, unit
+        """
+        query_params = [
+            bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id),
+            bigquery.ArrayQueryParameter("loinc_codes", "STRING", loinc_codes),
+            bigquery.ScalarQueryParameter("since", "TIMESTAMP", since),
+        ]
+        return await self._run_query(series_sql, query_params)
+
+    async def fetch_medication_start(self, patient_id: str, medication_term: str) -> dict | None:
+        """
+        Returns {"medication_name", "started_at"} for the earliest MedicationRequest whose
+        text contains medication_term, or None if the patient has no such prescription.
+        """
+        medication_sql = f"""
+            SELECT M.medicationCodeableConcept.text AS medication_name,
+                   TIMESTAMP(M.authoredOn) AS started_at
+            FROM `{self.fhir_base_tables['medicationrequest']}` AS M
+            WHERE M.subject.patientId = @patient_id
+            AND LOWER(M.medicationCodeableConcept.text) LIKE @medication_pattern
+            ORDER BY M.authoredOn ASC
+            LIMIT 1
+        """
+        query_params = [
+            bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id),
+            bigquery.ScalarQueryParameter("medication_pattern", "STRING", f"%{medication_term.lower()}%"),
+        ]
+        results = await self._run_query(medication_sql, query_params)
+        return results[0] if results else None
+
+    def _summary_fingerprint_sql(self) -> str:
+        """
+        Scalar SQL expression fingerprinting every row behind a patient summary: per
+        table, the row count and an XOR of (id, meta.lastUpdated) hashes. Inserts,
+        updates and deletes all change it; it is independent of row order.
+        """
+        parts = []
+        for table, patient_ref in [
+            ("patient", "id"),
+            ("condition", "subject.patientId"),
+            ("medicationrequest", "subject.patientId"),
+            ("allergyintolerance", "patient.patientId"),
+            ("observation", "subject.patientId"),
+        ]:
+            parts.append(f"""
+                (SELECT CONCAT(CAST(COUNT(*) AS STRING), ':', CAST(IFNULL(BIT_XOR(FARM_FINGERPRINT(
+                            CONCAT(R.id, '@', IFNULL(CAST(R.meta.lastUpdated AS STRING), ''))
+                        )), 0) AS STRING))
+                 FROM `{self.fhir_base_tables[table]}` AS R
+                 WHERE R.{patient_ref} = @patient_id)""")
+        return f"TO_HEX(SHA256(ARRAY_TO_STRING([{','.join(parts)}\n            ], '|')))"
+
+    async def fetch_patient_summary_fingerprint(self, patient_id: str) -> str:
+        """
+        Fingerprint of the rows behind the patient summary, without fetching them.
+        """
+        fingerprint_sql = f"SELECT {self._summary_fingerprint_sql()} AS fingerprint"
+        query_params = [bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id)]
+        results = await self._run_query(fingerprint_sql, query_params)
+        return results[0]["fingerprint"]
+
+    async def fetch_patient_summary_sections(self, patient_id: str) -> dict:
+        """
+        Fetches demographics, active conditions, active medications, allergies and
+        the five most recent observations in one BigQuery job, as one row of arrays,
+        together with the fingerprint of the rows they came from.
+        """
+        sections_sql = f"""
+            SELECT
+                {self._summary_fingerprint_sql()} AS fingerprint,
+                ARRAY(
+                    SELECT AS STRUCT
+                        (SELECT COALESCE(n.text, TRIM(CONCAT(ARRAY_TO_STRING(n.given, ' '), ' ', IFNULL(n.family, ''))))
+                         FROM UNNEST(P.name) AS n LIMIT 1) AS patient_name,
+                        P.gender AS gender,
+                        P.birthDate AS birth_date
+                    FROM `{self.fhir_base_tables['patient']}` AS P
+                    WHERE P.id = @patient_id
+                ) AS demographics,
+                ARRAY(
+                    SELECT AS STRUCT C.code.text AS condition_text, C.recordedDate AS recorded_date
+                    FROM `{self.fhir_base_tables['condition']}` AS C
+                    WHERE C.subject.patientId = @patient_id
+                    AND (
+                        EXISTS (SELECT 1 FROM UNNEST(C.clinicalStatus.coding) AS cs WHERE cs.code = 'active') OR
+                        EXISTS (SELECT 1 FROM UNNEST(C.verificationStatus.coding) AS vs WHERE vs.code = 'confirmed')
+                    )
+                    ORDER BY C.recordedDate DESC, C.id
+                ) AS conditions,
+                ARRAY(
+                    SELECT AS STRUCT M.medicationCodeableConcept.text AS medication_text, M.authoredOn AS authored_on
+                    FROM `{self.fhir_base_tables['medicationrequest']}` AS M
+                    WHERE M.subject.patientId = @patient_id AND M.status = 'active'
+                    ORDER BY M.authoredOn DESC, M.id
+                ) AS medications,
+                -- Synthea often leaves clinicalStatus empty for AllergyIntolerance, so this may be sparse
+                ARRAY(
+                    SELECT AS STRUCT A.code.text AS allergy_text, A.criticality AS criticality
+                    FROM `{self.fhir_base_tables['allergyintolerance']}` AS A
+                    WHERE A.patient.patientId = @patient_id
+                    AND EXISTS (SELECT 1 FROM UNNEST(A.clinicalStatus.coding) AS cs WHERE cs.code = 'active')
+                    ORDER BY A.recordedDate DESC, A.id
+                ) AS allergies,
+                ARRAY(
+                    SELECT AS STRUCT
+                        COALESCE(O.code.text, (SELECT c.display FROM UNNEST(O.code.coding) c WHERE c.system = 'http://loinc.org' LIMIT 1)) AS observation_text,
+                        O.valueQuantity.value AS observation_value,
+                        O.valueQuantity.unit AS observation_unit,
+                        COALESCE(O.valueString, (SELECT vc.text FROM UNNEST(O.valueCodeableConcept.coding) vc LIMIT 1)) AS observation_value_text,
+                        O.effectiveDateTime AS effective_date
+                    FROM `{self.fhir_base_tables['observation']}` AS O
+                    WHERE O.subject.patientId = @patient_id
+                    ORDER BY O.effectiveDateTime DESC, O.id
+                    LIMIT 5
+                ) AS observations
+        """
+        query_params = [bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id)]
+        results = await self._run_query(sections_sql, query_params)
+        return results[0] if results else {}
+
     async def fetch_comprehensive_patient_summary(self, patient_id: str) -> str:
         """
         Fetches a comprehensive summary for a given patient_id from BigQuery.
         This includes demographics, active conditions, active medications, allergies,
         and recent observations.
         """
+        sections = await self.fetch_patient_summary_sections(patient_id)
         summary_parts = []
-        patient_query_param = [bigquery.ScalarQueryParameter("patient_id", "STRING", patient_id)]
 
         # 1. Patient Demographics
-        patient_sql = f"""
-            SELECT
-                (SELECT name_item.text FROM UNNEST(P.name) AS name_item LIMIT 1) AS patient_name,
-                P.gender,
-                P.birthDate
-            FROM `{self.fhir_base_tables['patient']}` AS P
-            WHERE P.id = @patient_id
-        """
-        patient_results = await self._run_query(patient_sql, patient_query_param)
-        if patient_results:
-            patient_data = patient_results[0]
+        for patient_data in sections.get("demographics") or []:
             summary_parts.append(f"Patient Name: {patient_data.get('patient_name', 'N/A')}")
             summary_parts.append(f"Gender: {patient_data.get('gender', 'N/A')}")
-            summary_parts.append(f"Birth Date: {patient_data.get('birthDate', 'N/A')}")
+            summary_parts.append(f"Birth Date: {patient_data.get('birth_date', 'N/A')}")
             summary_parts.append("") # Newline for separation
 
         # 2. Active Conditions
-        conditions_sql = f"""
-            SELECT C.code.text AS condition_text
-            FROM `{self.fhir_base_tables['condition']}` AS C
-            WHERE C.subject.patientId = @patient_id
-            AND (
-                EXISTS (SELECT 1 FROM UNNEST(C.clinicalStatus.coding) AS cs WHERE cs.code = 'active') OR
-                EXISTS (SELECT 1 FROM UNNEST(C.verificationStatus.coding) AS vs WHERE vs.code = 'confirmed')
-            )
-        """
-        condition_results = await self._run_query(conditions_sql, patient_query_param)
-        if condition_results:
+        if sections.get("conditions"):
             summary_parts.append("Active Conditions:")
-            for row in condition_results:
+            for row in sections["conditions"]:
                 summary_parts.append(f"- {row.get('condition_text', 'N/A')}")
             summary_parts.append("")
 
         # 3. Active Medications
-        medications_sql = f"""
-            SELECT M.medicationCodeableConcept.text AS medication_text
-            FROM `{self.fhir_base_tables['medicationrequest']}` AS M
-            WHERE M.subject.patientId = @patient_id AND M.status = 'active'
-        """
-        medication_results = await self._run_query(medications_sql, patient_query_param)
-        if medication_results:
+        if sections.get("medications"):
             summary_parts.append("Current Medications:")
-            for row in medication_results:
+            for row in sections["medications"]:
                 summary_parts.append(f"- {row.get('medication_text', 'N/A')}")
             summary_parts.append("")
 
         # 4. Allergies
-        allergies_sql = f"""
-            SELECT A.code.text AS allergy_text
-            FROM `{self.fhir_base_tables['allergyintolerance']}` AS A
-            WHERE A.patient.patientId = @patient_id
-            AND EXISTS (SELECT 1 FROM UNNEST(A.clinicalStatus.coding) AS cs WHERE cs.code = 'active')
-        """ # Note: Synthea often doesn't populate clinicalStatus for AllergyIntolerance, verificationStatus might be better
-          # but for simplicity, sticking to clinicalStatus: active. This might yield few results for Synthea.
-        allergy_results = await self._run_query(allergies_sql, patient_query_param)
-        if allergy_results:
+        if sections.get("allergies"):
             summary_parts.append("Allergies:")
-            for row in allergy_results:
+            for row in sections["allergies"]:
                 summary_parts.append(f"- {row.get('allergy_text', 'N/A')}")
             summary_parts.append("")
 
-        # 5. Recent Observations (e.g., last 5)
-        observations_sql = f"""
-            SELECT
-                COALESCE(O.code.text, (SELECT c.display FROM UNNEST(O.code.coding) c WHERE c.system = 'http://loinc.org' LIMIT 1)) AS observation_text,
-                O.valueQuantity.value AS observation_value,
-                O.valueQuantity.unit AS observation_unit,
-                O.valueString,
-                (SELECT vc.text FROM UNNEST(O.valueCodeableConcept.coding) vc LIMIT 1) AS value_codeable_concept_text,
-                O.effectiveDateTime
-            FROM `{self.fhir_base_tables['observation']}` AS O
-            WHERE O.subject.patientId = @patient_id
-            ORDER BY O.effectiveDateTime DESC
-            LIMIT 5
-        """
-        observation_results = await self._run_query(observations_sql, patient_query_param)
-        if observation_results:
+        # 5. Recent Observations (last 5)
+        if sections.get("observations"):
             summary_parts.append("Recent Observations:")
-            for row in observation_results:
+            for row in sections["observations"]:
                 obs_text = row.get('observation_text') or "Observation"
                 value_str = "N/A"
                 if row.get('observation_value') is not None and row.get('observation_unit') is not None:
                     value_str = f"{row['observation_value']} {row['observation_unit']}"
-                elif row.get('valueString') is not None:
-                    value_str = row['valueString']
-                elif row.get('value_codeable_concept_text') is not None:
-                    value_str = row['value_codeable_concept_text']
+                elif row.get('observation_value_text') is not None:
+                    value_str = row['observation_value_text']
                 
-                date_str = row.get('effectiveDateTime', 'N/A')
+                date_str = row.get('effective_date', 'N/A')
                 # Ensure date_str is a string, as it might be a datetime object from BigQuery
                 summary_parts.append(f"- {obs_text}: {value_str} (Recorded: {str(date_str)})")
             summary_parts.append("")
@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+from google.cloud import bigquery
+
+from ..config import settings
+from ..utils.request_context import BATCH, set_request_context
+from ..utils.wandb_monitor import log_event
+from .bigquery_handler import BigQueryHandler, get_bigquery_handler
+
+# How each resource type points at its patient. FHIR names the reference `patient`
+# rather than `subject` on these types; anything else uses DEFAULT_PATIENT_REFERENCE.
+PATIENT_REFERENCE = {
+    "Patient": "id",
+    "AllergyIntolerance": "patient.patientId",
+    "Immunization": "patient.patientId",
+}
+DEFAULT_PATIENT_REFERENCE = "subject.patientId"
+
+EPOCH = "1970-01-01T00:00:00+00:00"
+# Rows without meta.lastUpdated sort as EPOCH in every source, so they sync on the first run
+LAST_UPDATED_SQL = "COALESCE(TIMESTAMP(R.meta.lastUpdated), TIMESTAMP '1970-01-01 00:00:00+00')"
+
+
+@dataclass
+class ChangedRow:
+    resource_type: str
+    resource_id: str
+    patient_id: str | None
+    last_updated: str # ISO-8601, UTC
+    resource: str # Full resource as JSON text
+
+
+class ChangeBus:
+    """
+    In-process fan-out of "these patients changed" notifications so caches and
+    indexes can invalidate exactly the affected entries.
+    """
+    def __init__(self):
+        self._subscribers: list[Callable[[str, set[str]], None]] = []
+
+    def subscribe(self, callback: Callable[[str, set[str]], None]) -> None:
+        self._subscribers.append(callback)
+
+    def publish(self, resource_type: str, patient_ids: set[str]) -> None:
+        if not patient_ids:
+            return
+        for callback in self._subscribers:
+            try:
+                callback(resource_type, patient_ids)
+            except Exception as e:
+                print(f"Change subscriber failed for {resource_type}: {e}")
+
+
+change_bus = ChangeBus()
+
+
+class WatermarkStore:
+    """
+    Per-resource-type high-water marks persisted as JSON. The mark is the
+    (lastUpdated, id) of the last applied row, so rows sharing a timestamp are
+    neither skipped nor re-read across pages.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._marks: dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._marks = json.load(f)
+
+    def get(self, resource_type: str) -> tuple[str, str]:
+        mark = self._marks.get(resource_type, {})
+        return mark.get("last_updated", EPOCH), mark.get("last_id", "")
+
+    def get_source_version(self, resource_type: str) -> str | None:
+        return self._marks.get(resource_type, {}).get("source_version")
+
+    def set(self, resource_type: str, last_updated: str, last_id: str) -> None:
+        mark = self._marks.setdefault(resource_type, {})
+        mark.update(last_updated=last_updated, last_id=last_id)
+        self._save()
+
+    def set_source_version(self, resource_type: str, version: str) -> None:
+        self._marks.setdefault(resource_type, {})["source_version"] = version
+        self._save()
+
+    def _save(self) -> None:
+        # Write-then-rename so a crash never leaves a truncated file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._marks, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def _to_iso(value) -> str:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc).isoformat()
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00")).astimezone(timezone.utc).isoformat()
+
+
+class BigQueryChangeSource:
+    """
+    Reads rows updated after a watermark from the FHIR BigQuery dataset, oldest first.
+    """
+    def __init__(self, bq_handler: BigQueryHandler, partition_column: str | None = None, partition_lag_hours: float = 24):
+        self.bq_handler = bq_handler
+        # meta.lastUpdated is a plain column, so filtering on it alone scans the whole table
+        # on every page. On ingestion-time partitioned tables (_PARTITIONTIME) that are only
+        # ever appended to, a row changed after the watermark was loaded after it too, so
+        # older partitions are pruned; the lag absorbs clock skew between the source and
+        # BigQuery. Only valid for such append-only loads: a DML UPDATE leaves the row in its
+        # old partition, and this filter would silently skip it.
+        self.partition_column = partition_column
+        self.partition_lag_hours = partition_lag_hours
+
+    def _table(self, resource_type: str) -> str:
+        return f"{self.bq_handler.data_source_project_id}.{self.bq_handler.dataset_id}.{resource_type}"
+
+    async def source_version(self, resource_type: str) -> str | None:
+        """
+        The table's last-modified time from its metadata (no scan), so unchanged
+        tables are skipped without running a query.
+        """
+        table = await asyncio.to_thread(self.bq_handler.client.get_table, self._table(resource_type))
+        return table.modified.isoformat() if table.modified else None
+
+    async def fetch_page(self, resource_type: str, after: tuple[str, str], page_size: int) -> list[ChangedRow]:
+        patient_ref = PATIENT_REFERENCE.get(resource_type, DEFAULT_PATIENT_REFERENCE)
+        partition_filter = (
+            f"{self.partition_column} >= TIMESTAMP_SUB(@after_ts, INTERVAL {int(self.partition_lag_hours)} HOUR) AND"
+            if self.partition_column else ""
+        )
+        page_sql = f"""
+            SELECT R.id AS id,
+                   R.{patient_ref} AS patient_id,
+                   {LAST_UPDATED_SQL} AS last_updated,
+                   TO_JSON_STRING(R) AS resource
+            FROM `{self._table(resource_type)}` AS R
+            WHERE {partition_filter} (
+                {LAST_UPDATED_SQL} > @after_ts
+                OR ({LAST_UPDATED_SQL} = @after_ts AND R.id > @after_id)
+            )
+            ORDER BY last_updated, id
+            LIMIT @page_size
+        """
+        query_params = [
+            bigquery.ScalarQueryParameter("after_ts", "TIMESTAMP", datetime.fromisoformat(after[0])),
+            bigquery.ScalarQueryParameter("after_id", "STRING", after[1]),
+            bigquery.ScalarQueryParameter("page_size", "INT64", page_size),
+        ]
+        rows = await self.bq_handler._run_query(page_sql, query_params)
+        return [
+            ChangedRow(resource_type, row["id"], row["patient_id"], _to_iso(row["last_updated"]), row["resource"])
+            for row in rows
+        ]
+
+
+class FixtureChangeSource:
+    """
+    Local stand-in for BigQuery: a JSON file {resource_type: [FHIR resources]}.
+    Pages with the same ordering and watermark semantics as BigQueryChangeSource.
+    """
+    def __init__(self, path: str):
+        with open(path) as f:
+            self.resources: dict[str, list[dict]] = json.load(f)
+
+    async def source_version(self, resource_type: str) -> str | None:
+        return None # Always page through the fixture
+
+    async def fetch_page(self, resource_type: str, after: tuple[str, str], page_size: int) -> list[ChangedRow]:
+        rows = []
+        for resource in self.resources.get(resource_type, []):
+            last_updated = _to_iso((resource.get("meta") or {}).get("lastUpdated") or EPOCH)
+            if (last_updated, resource["id"]) <= after:
+                continue
+            patient_id = resource
+            for part in PATIENT_REFERENCE.get(resource_type, DEFAULT_PATIENT_REFERENCE).split("."):
+                patient_id = patient_id.get(part) if isinstance(patient_id, dict) else None
+            rows.append(ChangedRow(resource_type, resource["id"], patient_id, last_updated, json.dumps(resource)))
+        rows.sort(key=lambda r: (r.last_updated, r.resource_id))
+        return rows[:page_size]
+
+
+class SqliteMirror:
+    """
+    Local mirror of synced resources. Upserts are idempotent: replaying a page,
+    or applying an older version of a row, leaves the mirror unchanged.
+    """
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS resources (
+                resource_type TEXT NOT NULL,
+                id TEXT NOT NULL,
+                patient_id TEXT,
+                last_updated TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (resource_type, id)
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS resources_patient ON resources (patient_id)")
+        self.conn.commit()
+
+    def upsert(self, rows: list[ChangedRow]) -> int:
+        before = self.conn.total_changes
+        self.conn.executemany("""
+            INSERT INTO resources (resource_type, id, patient_id, last_updated, body)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (resource_type, id) DO UPDATE SET
+                patient_id = excluded.patient_id,
+                last_updated = excluded.last_updated,
+                body = excluded.body
+            WHERE excluded.last_updated > resources.last_updated
+        """, [(r.resource_type, r.resource_id, r.patient_id, r.last_updated, r.resource) for r in rows])
+        self.conn.commit()
+        return self.conn.total_changes - before
+
+
+class IncrementalSync:
+    """
+    Pulls only rows changed since each resource type's watermark, page by page,
+    applies them to the mirror, publishes per-patient change events and then
+    advances the watermark. Work scales with the number of changed rows.
+    """
+    def __init__(
+        self,
+        source,
+        mirror: SqliteMirror,
+        watermarks: WatermarkStore,
+        resource_types: list[str],
+        bus: ChangeBus = change_bus,
+        page_size: int = 500,
+        max_page_retries: int = 5
+    ):
+        self.source = source
+        self.mirror = mirror
+        self.watermarks = watermarks
+        self.resource_types = resource_types
+        self.bus = bus
+        self.page_size = page_size
+        self.max_page_retries = max_page_retries
+
+    async def _fetch_with_backoff(self, resource_type: str, after: tuple[str, str]) -> list[ChangedRow]:
+        for attempt in range(self.max_page_retries):
+            try:
+                return await self.source.fetch_page(resource_type, after, self.page_size)
+            except Exception as e:
+                if attempt + 1 >= self.max_page_retries:
+                    raise
+                delay = min(60.0, 2 ** attempt)
+                print(f"Sync page for {resource_type} failed ({e}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def sync_resource(self, resource_type: str) -> dict:
+        after = self.watermarks.get(resource_type)
+        fetched = applied = 0
+        patients: set[str] = set()
+        # Read before paging, so a change landing mid-sync is picked up next run
+        version = await self.source.source_version(resource_type)
+        if version is not None and version == self.watermarks.get_source_version(resource_type):
+            return {"fetched": 0, "applied": 0, "patients": 0, "skipped": True}
+        while True:
+            rows = await self._fetch_with_backoff(resource_type, after)
+            if not rows:
+                break
+            applied += await asyncio.to_thread(self.mirror.upsert, rows)
+            page_patients = {r.patient_id for r in rows if r.patient_id}
+            self.bus.publish(resource_type, page_patients)
+            # Advance only after the page is applied and published, so a crash replays it
+            after = (rows[-1].last_updated, rows[-1].resource_id)
+            self.watermarks.set(resource_type, *after)
+            fetched += len(rows)
+            patients |= page_patients
+            if len(rows) < self.page_size:
+                break
+        if version is not None:
+            self.watermarks.set_source_version(resource_type, version)
+        return {"fetched": fetched, "applied": applied, "patients": len(patients)}
+
+    async def run_once(self) -> dict:
+        # Sync traffic queues behind interactive requests in the scheduler
+        set_request_context(priority=BATCH)
+        stats = {}
+        for resource_type in self.resource_types:
+            stats[resource_type] = await self.sync_resource(resource_type)
+        log_event("sync/run", stats)
+        return stats
+
+    async def run_forever(self, interval_seconds: float) -> None:
+        while True:
+            try:
+                stats = await self.run_once()
+                print(f"Incremental sync: {stats}")
+            except Exception as e:
+                print(f"Incremental sync failed: {e}")
+            await asyncio.sleep(interval_seconds)
+
+
+def build_incremental_sync(fixture_path: str | None = None) -> IncrementalSync:
+    if fixture_path:
+        source = FixtureChangeSource(fixture_path)
+    else:
+        source = BigQueryChangeSource(
+            get_bigquery_handler(),
+            partition_column=settings.SYNC_PARTITION_COLUMN,
+            partition_lag_hours=settings.SYNC_PARTITION_LAG_HOURS
+        )
+    return IncrementalSync(
+        source=source,
+        mirror=SqliteMirror(settings.SYNC_MIRROR_PATH),
+        watermarks=WatermarkStore(settings.SYNC_WATERMARK_PATH),
+        resource_types=settings.SYNC_RESOURCE_TYPES,
+        page_size=settings.SYNC_PAGE_SIZE
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally sync changed FHIR rows using meta.lastUpdated watermarks.")
+    parser.add_argument("--fixture", help="Sync from a local JSON fixture instead of BigQuery")
+    parser.add_argument("--interval", type=float, help="Keep running, syncing every N seconds")
+    args = parser.parse_args()
+
+    sync = build_incremental_sync(args.fixture)
+    if args.interval:
+        asyncio.run(sync.run_forever(args.interval))
+    else:
+        print(json.dumps(asyncio.run(sync.run_once()), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+import asyncio
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Protocol
+
+from ..config import settings
+from ..utils.wandb_monitor import log_event
+
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+LOCK_FILE = "LOCK"
+# Sealed segments whose dead-record share reaches this are rewritten
+COMPACTION_DEAD_RATIO = 0.5
+
+
+@dataclass
+class HistoryEntry:
+    physician_id: str
+    patient_id: str
+    query: str
+    answer: str
+    query_type: str
+    created_at: float = field(default_factory=time.time) # Epoch seconds
+    sources: list[dict] | None = None
+    seq: int | None = None # Assigned by the backend; orders entries and backs the cursor
+
+    def created_at_iso(self) -> str:
+        return datetime.fromtimestamp(self.created_at, tz=timezone.utc).isoformat()
+
+
+def encode_cursor(seq: int) -> str:
+    return str(seq)
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(cursor)
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+
+class HistoryBackend(Protocol):
+    """
+    Storage behind ChatHistory. Methods are blocking and are called off the event loop.
+    """
+    def append_batch(self, entries: list[HistoryEntry]) -> None: ...
+
+    def read_page(self, physician_id: str, patient_id: str, limit: int, before_seq: int | None) -> tuple[list[HistoryEntry], int | None]: ...
+
+    def run_maintenance(self, retention_cutoff: float | None) -> dict: ...
+
+    def close(self) -> None: ...
+
+
+class _ConversationIndex:
+    """
+    Locations of one (physician, patient) conversation's records, in seq order.
+    """
+    __slots__ = ("seqs", "segments", "offsets", "lengths")
+
+    def __init__(self):
+        self.seqs = array("q")
+        self.segments = array("q") # Base seq of the segment holding the record
+        self.offsets = array("q")
+        self.lengths = array("q")
+
+    def append(self, seq: int, segment: int, offset: int, length: int) -> None:
+        self.seqs.append(seq)
+        self.segments.append(segment)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def drop(self, start: int, stop: int) -> None:
+        for column in (self.seqs, self.segments, self.offsets, self.lengths):
+            del column[start:stop]
+
+
+class _Segment:
+    __slots__ = ("base", "path", "fd", "size", "count", "live", "oldest", "newest")
+
+    def __init__(self, base: int, path: str):
+        self.base = base
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self.size = os.fstat(self.fd).st_size
+        self.count = 0 # Records in the file
+        self.live = 0 # Records still referenced by the index
+        self.oldest = 0.0 # Earliest created_at (0 = empty); sealing the active segment once it expires
+        self.newest = 0.0 # Latest created_at, for retention
+
+
+class SegmentLogBackend:
+    """
+    Append-only history log split into size-bounded segment files named by their
+    first seq. An in-memory index maps each (physician, patient) to the seq,
+    segment and byte range of its records, so a page is a bisect plus one
+    positional read per entry, independent of total volume.
+
+    Sealed segments get an .idx sidecar so start-up rebuilds the index without
+    parsing every record. Retention drops whole segments past the cutoff;
+    compaction rewrites sealed segments dominated by records trimmed by the
+    per-conversation cap.
+    """
+    def __init__(self, directory: str, segment_bytes: int, max_per_conversation: int = 0, fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_per_conversation = max_per_conversation
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._maintenance_lock = threading.Lock()
+        self._segments: dict[int, _Segment] = {}
+        self._index: dict[tuple[str, str], _ConversationIndex] = {}
+        self._next_seq = 1
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = self._lock_directory()
+        self._recover()
+
+    # --- recovery ---------------------------------------------------------+
+    def _lock_directory(self) -> int:
+        """
+        Offsets and seqs live in this process's memory, so two processes appending
+        to one directory would corrupt each other's index. Refuse to share it.
+        """
+        fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(
+                f"Chat history directory {self.directory} is in use by another process; "
+                "give each worker its own CHAT_HISTORY_DIR or use CHAT_HISTORY_BACKEND=sqlite"
+            )
+        return fd
+
+    def _segment_path(self, base: int, suffix: str = SEGMENT_SUFFIX) -> str:
+        return os.path.join(self.directory, f"{base:020d}{suffix}")
+
+    def _recover(self) -> None:
+        bases = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX)
+        )
+        for base in bases:
+            segment = _Segment(base, self._segment_path(base))
+            self._segments[base] = segment
+            locations = self._load_sidecar(segment)
+            if locations is None:
+                locations = self._scan_segment(segment)
+            for key, seq, offset, length, created_at in locations:
+                self._conversation(key).append(seq, base, offset, length)
+                segment.count += 1
+                segment.live += 1
+                segment.oldest = min(segment.oldest or created_at, created_at)
+                segment.newest = max(segment.newest, created_at)
+                self._next_seq = max(self._next_seq, seq + 1)
+        for key in list(self._index):
+            self._enforce_cap(key)
+        if not self._segments:
+            self._roll()
+
+    def _load_sidecar(self, segment: _Segment) -> list | None:
+        path = self._segment_path(segment.base, INDEX_SUFFIX)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            header = json.loads(f.readline())
+            # A sidecar describes exactly one version of its segment
+            if header.get("log_size") != segment.size:
+                return None
+            return [
+                ((row[0], row[1]), row[2], row[3], row[4], row[5])
+                for row in map(json.loads, f)
+            ]
+
+    def _scan_segment(self, segment: _Segment) -> list:
+        locations = []
+        offset = 0
+        with open(segment.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Torn tail from a crash mid-write; drop it so appends stay aligned
+                    os.truncate(segment.path, offset)
+                    segment.size = offset
+                    break
+                record = json.loads(line)
+                locations.append(((record["physician_id"], record["patient_id"]), record["seq"], offset, len(line), record["created_at"]))
+                offset += len(line)
+        return locations
+
+    def _write_sidecar(self, segment: _Segment, locations: list) -> None:
+        path = self._segment_path(segment.base, INDEX_SUFFIX)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({"log_size": segment.size}) + "\n")
+            for key, seq, offset, length, created_at in locations:
+                f.write(json.dumps([key[0], key[1], seq, offset, length, created_at]) + "\n")
+        os.replace(tmp_path, path)
+
+    # --- writes -----------------------------------------------------------+
+    def _conversation(self, key: tuple[str, str]) -> _ConversationIndex:
+        conversation = self._index.get(key)
+        if conversation is None:
+            conversation = self._index[key] = _ConversationIndex()
+        return conversation
+
+    def _active(self) -> _Segment:
+        return self._segments[max(self._segments)]
+
+    def _roll(self) -> None:
+        if self._segments:
+            self._seal(self._active())
+        base = self._next_seq
+        self._segments[base] = _Segment(base, self._segment_path(base))
+
+    def _seal(self, segment: _Segment) -> None:
+        self._write_sidecar(segment, self._scan_segment(segment))
+
+    def _enforce_cap(self, key: tuple[str, str]) -> None:
+        conversation = self._index[key]
+        excess = len(conversation.seqs) - self.max_per_conversation
+        if self.max_per_conversation <= 0 or excess <= 0:
+            return
+        for base in conversation.segments[:excess]:
+            self._segments[base].live -= 1
+        conversation.drop(0, excess)
+
+    def append_batch(self, entries: list[HistoryEntry]) -> None:
+        with self._lock:
+            segment = self._active()
+            if segment.size >= self.segment_bytes:
+                self._roll()
+                segment = self._active()
+            chunks = []
+            offset = segment.size
+            for entry in entries:
+                entry.seq = self._next_seq
+                self._next_seq += 1
+                line = (json.dumps(asdict(entry), separators=(",", ":")) + "\n").encode()
+                chunks.append(line)
+                key = (entry.physician_id, entry.patient_id)
+                self._conversation(key).append(entry.seq, segment.base, offset, len(line))
+                offset += len(line)
+                segment.count += 1
+                segment.live += 1
+                segment.oldest = min(segment.oldest or entry.created_at, entry.created_at)
+                segment.newest = max(segment.newest, entry.created_at)
+                self._enforce_cap(key)
+            # One write (and one fsync) per batch
+            os.write(segment.fd, b"".join(chunks))
+            if self.fsync:
+                os.fsync(segment.fd)
+            segment.size = offset
+
+    # --- reads ------------------------------------------------------------+
+    def read_page(self, physician_id: str, patient_id: str, limit: int, before_seq: int | None) -> tuple[list[HistoryEntry], int | None]:
+        """
+        Newest-first page of entries with seq < before_seq, and the cursor for
+        the next (older) page.
+        """
+        with self._lock:
+            conversation = self._index.get((physician_id, patient_id))
+            if conversation is None:
+                return [], None
+            stop = len(conversation.seqs) if before_seq is None else bisect_left(conversation.seqs, before_seq)
+            start = max(0, stop - limit)
+            entries = []
+            for i in range(stop - 1, start - 1, -1):
+                fd = self._segments[conversation.segments[i]].fd
+                record = json.loads(os.pread(fd, conversation.lengths[i], conversation.offsets[i]))
+                entries.append(HistoryEntry(**record))
+            next_seq = conversation.seqs[start] if start > 0 else None
+        return entries, next_seq
+
+    # --- retention and compaction ----------------------------------------+
+    def _drop_segment_range(self, first_seq: int, end_seq: int) -> None:
+        # Seqs are global and increasing, so a segment's records are one contiguous slice per conversation
+        for key in list(self._index):
+            conversation = self._index[key]
+            start = bisect_left(conversation.seqs, first_seq)
+            stop = bisect_left(conversation.seqs, end_seq, start)
+            if start < stop:
+                conversation.drop(start, stop)
+            if not conversation.seqs:
+                del self._index[key]
+
+    def _segment_end(self, base: int) -> int:
+        later = [b for b in self._segments if b > base]
+        return min(later) if later else self._next_seq
+
+    def _remove_segment(self, segment: _Segment) -> None:
+        self._drop_segment_range(segment.base, self._segment_end(segment.base))
+        del self._segments[segment.base]
+        os.close(segment.fd)
+        os.remove(segment.path)
+        sidecar = self._segment_path(segment.base, INDEX_SUFFIX)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+    def _compact(self, segment: _Segment) -> None:
+        with self._lock:
+            if segment.live == 0:
+                self._remove_segment(segment)
+                return
+            end = self._segment_end(segment.base)
+            live = []
+            for key, conversation in self._index.items():
+                start = bisect_left(conversation.seqs, segment.base)
+                stop = bisect_left(conversation.seqs, end, start)
+                for i in range(start, stop):
+                    live.append((conversation.seqs[i], conversation.offsets[i], conversation.lengths[i]))
+        live.sort()
+
+        # The segment is sealed, so it can be copied without holding the lock
+        tmp_path = f"{segment.path}.compact"
+        moved = {}
+        offset = 0
+        with open(tmp_path, "wb") as out:
+            for seq, old_offset, length in live:
+                out.write(os.pread(segment.fd, length, old_offset))
+                moved[seq] = offset
+                offset += length
+            out.flush()
+            os.fsync(out.fileno())
+
+        with self._lock:
+            os.replace(tmp_path, segment.path)
+            os.close(segment.fd)
+            replacement = _Segment(segment.base, segment.path)
+            replacement.oldest = segment.oldest
+            replacement.newest = segment.newest
+            for conversation in self._index.values():
+                start = bisect_left(conversation.seqs, segment.base)
+                stop = bisect_left(conversation.seqs, end, start)
+                for i in range(start, stop):
+                    conversation.offsets[i] = moved[conversation.seqs[i]]
+                    replacement.count += 1
+            replacement.live = replacement.count
+            self._segments[segment.base] = replacement
+            self._seal(replacement)
+
+    def run_maintenance(self, retention_cutoff: float | None) -> dict:
+        """
+        Drop sealed segments whose newest record is older than `retention_cutoff`
+        (epoch seconds), then compact sealed segments that are mostly dead.
+
+        The active segment is sealed as soon as its oldest record passes the
+        cutoff, so a low-traffic log that never reaches segment_bytes still
+        expires: each segment spans at most one retention period.
+        """
+        stats = {"segments_dropped": 0, "segments_compacted": 0}
+        with self._maintenance_lock:
+            with self._lock:
+                active = self._active()
+                if retention_cutoff is not None and active.count and active.oldest < retention_cutoff:
+                    self._roll()
+                active_base = max(self._segments)
+                sealed = [s for base, s in sorted(self._segments.items()) if base != active_base]
+                for segment in sealed:
+                    if retention_cutoff is None or segment.newest >= retention_cutoff:
+                        continue
+                    self._remove_segment(segment)
+                    stats["segments_dropped"] += 1
+                sealed = [s for s in sealed if s.base in self._segments]
+            for segment in sealed:
+                if segment.count and (segment.count - segment.live) / segment.count >= COMPACTION_DEAD_RATIO:
+                    self._compact(segment)
+                    stats["segments_compacted"] += 1
+        return stats
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in self._segments.values():
+                os.close(segment.fd)
+            self._segments.clear()
+            if self._lock_fd is not None:
+                os.close(self._lock_fd) # Releases the directory lock
+                self._lock_fd = None
+
+
+class SqliteHistoryBackend:
+    """
+    Single-table SQLite store with the same paging semantics; handy for tests
+    and single-node deployments (path=":memory:" keeps it in-process).
+    """
+    def __init__(self, path: str, max_per_conversation: int = 0):
+        self.max_per_conversation = max_per_conversation
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_history (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                physician_id TEXT NOT NULL,
+                patient_id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                query TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                query_type TEXT NOT NULL,
+                sources TEXT
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chat_history_conversation ON chat_history (physician_id, patient_id, seq)")
+        self.conn.commit()
+
+    def append_batch(self, entries: list[HistoryEntry]) -> None:
+        with self._lock:
+            for entry in entries:
+                cursor = self.conn.execute(
+                    "INSERT INTO chat_history (physician_id, patient_id, created_at, query, answer, query_type, sources) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (entry.physician_id, entry.patient_id, entry.created_at, entry.query, entry.answer, entry.query_type,
+                     json.dumps(entry.sources) if entry.sources is not None else None)
+                )
+                entry.seq = cursor.lastrowid
+            if self.max_per_conversation > 0:
+                for physician_id, patient_id in {(e.physician_id, e.patient_id) for e in entries}:
+                    self.conn.execute("""
+                        DELETE FROM chat_history
+                        WHERE physician_id = ? AND patient_id = ? AND seq <= (
+                            SELECT seq FROM chat_history WHERE physician_id = ? AND patient_id = ?
+                            ORDER BY seq DESC LIMIT 1 OFFSET ?
+                        )
+                    """, (physician_id, patient_id, physician_id, patient_id, self.max_per_conversation))
+            self.conn.commit()
+
+    def read_page(self, physician_id: str, patient_id: str, limit: int, before_seq: int | None) -> tuple[list[HistoryEntry], int | None]:
+        with self._lock:
+            rows = self.conn.execute("""
+                SELECT seq, physician_id, patient_id, created_at, query, answer, query_type, sources
+                FROM chat_history
+                WHERE physician_id = ? AND patient_id = ? AND seq < ?
+                ORDER BY seq DESC
+                LIMIT ?
+            """, (physician_id, patient_id, before_seq if before_seq is not None else 2 ** 63 - 1, limit + 1)).fetchall()
+        entries = [
+            HistoryEntry(
+                seq=row[0], physician_id=row[1], patient_id=row[2], created_at=row[3], query=row[4],
+                answer=row[5], query_type=row[6], sources=json.loads(row[7]) if row[7] else None
+            )
+            for row in rows[:limit]
+        ]
+        next_seq = entries[-1].seq if len(rows) > limit else None
+        return entries, next_seq
+
+    def run_maintenance(self, retention_cutoff: float | None) -> dict:
+        with self._lock:
+            deleted = 0
+            if retention_cutoff is not None:
+                deleted = self.conn.execute("DELETE FROM chat_history WHERE created_at < ?", (retention_cutoff,)).rowcount
+            self.conn.commit()
+        return {"rows_deleted": deleted}
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class ChatHistory:
+    """
+    Front door for chat history. record() only enqueues, so /chat never waits
+    on storage; a background writer drains the queue in batches. Entries become
+    readable once their batch is written (normally within flush_seconds).
+    """
+    def __init__(
+        self,
+        backend: HistoryBackend,
+        batch_size: int = 64,
+        flush_seconds: float = 0.5,
+        max_queue: int = 10000,
+        retention_days: float = 0
+    ):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_queue = max_queue
+        self.retention_days = retention_days
+        self._queue: asyncio.Queue | None = None
+        self._writer: asyncio.Task | None = None
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "batches": 0}
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or self._writer.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def record(self, entry: HistoryEntry) -> None:
+        """
+        Enqueue an entry without blocking. When the queue is full the entry is
+        dropped and counted rather than slowing the request down.
+        """
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(entry)
+            self.stats["queued"] += 1
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            print("Chat history queue full; dropping entry")
+
+    async def _next_batch(self) -> list[HistoryEntry]:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        flush_at = loop.time() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            remaining = flush_at - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write_batch(self, batch: list[HistoryEntry]) -> None:
+        for attempt in range(3):
+            try:
+                await asyncio.to_thread(self.backend.append_batch, batch)
+                self.stats["written"] += len(batch)
+                self.stats["batches"] += 1
+                return
+            except Exception as e:
+                print(f"Chat history write failed (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        self.stats["dropped"] += len(batch)
+        log_event("chat_history/dropped", {"entries": len(batch)})
+
+    async def _write_loop(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            await self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def flush(self) -> None:
+        """
+        Wait until everything enqueued so far has been written.
+        """
+        if self._queue is not None and self._writer is not None and not self._writer.done():
+            await self._queue.join()
+
+    async def read_page(self, physician_id: str, patient_id: str, limit: int, cursor: str | None = None) -> tuple[list[HistoryEntry], str | None]:
+        before_seq = decode_cursor(cursor) if cursor else None
+        entries, next_seq = await asyncio.to_thread(self.backend.read_page, physician_id, patient_id, limit, before_seq)
+        return entries, encode_cursor(next_seq) if next_seq is not None else None
+
+    async def run_maintenance(self) -> dict:
+        cutoff = time.time() - self.retention_days * 86400 if self.retention_days > 0 else None
+        stats = await asyncio.to_thread(self.backend.run_maintenance, cutoff)
+        log_event("chat_history/maintenance", stats)
+        return stats
+
+    async def run_maintenance_forever(self, interval_seconds: float) -> None:
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                print(f"Chat history maintenance: {await self.run_maintenance()}")
+            except Exception as e:
+                print(f"Chat history maintenance failed: {e}")
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._writer is not None:
+            self._writer.cancel()
+        await asyncio.to_thread(self.backend.close)
+
+
+def build_history_backend() -> HistoryBackend:
+    if settings.CHAT_HISTORY_BACKEND == "sqlite":
+        return SqliteHistoryBackend(settings.CHAT_HISTORY_SQLITE_PATH, settings.CHAT_HISTORY_MAX_PER_CONVERSATION)
+    return SegmentLogBackend(
+        settings.CHAT_HISTORY_DIR,
+        settings.CHAT_HISTORY_SEGMENT_BYTES,
+        settings.CHAT_HISTORY_MAX_PER_CONVERSATION
+    )
+
+
+_chat_history: ChatHistory | None = None
+
+def get_chat_history() -> ChatHistory:
+    # One writer per worker, shared across requests
+    global _chat_history
+    if _chat_history is None:
+        _chat_history = ChatHistory(
+            build_history_backend(),
+            batch_size=settings.CHAT_HISTORY_BATCH_SIZE,
+            flush_seconds=settings.CHAT_HISTORY_FLUSH_SECONDS,
+            max_queue=settings.CHAT_HISTORY_QUEUE_MAX,
+            retention_days=settings.CHAT_HISTORY_RETENTION_DAYS
+        )
+    return _chat_history
@@ -1,11 +1,15 @@
+import asyncio
+import re
 from langchain_google_vertexai import ChatVertexAI
 from langchain_community.utilities import SQLDatabase
-from langchain.chains import create_sql_query_chain
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import PromptTemplate
 from langchain_core.runnables import RunnablePassthrough
-from ..utils.schema_loader import get_fhir_synthea_schema
+from ..utils.schema_loader import build_table_ddl, load_fhir_synthea_tables
+from ..utils.schema_selector import SchemaSelector
 from ..utils.wandb_monitor import log_event
+from .scheduler import get_scheduler
+from .resilience import CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, call_with_resilience
 
 from ..config import settings
 
@@ -18,6 +22,21 @@ ALLERGY_TABLE_FQ = f"`{settings.BIGQUERY_PROJECT_ID}.{settings.FHIR_DATASET_ID}.
 ENCOUNTER_TABLE_FQ = f"`{settings.BIGQUERY_PROJECT_ID}.{settings.FHIR_DATASET_ID}.Encounter`"
 PROCEDURE_TABLE_FQ = f"`{settings.BIGQUERY_PROJECT_ID}.{settings.FHIR_DATASET_ID}.Procedure`"
 
+# Same shape as LangChain's create_sql_query_chain prompt, but table_info is filled
+# per question by the SchemaSelector instead of carrying every table in the dataset.
+SQL_GENERATION_PROMPT = PromptTemplate.from_template(
+    """You are a GoogleSQL (BigQuery) expert. Given an input question, write one syntactically correct query that answers it.
+Unless the question asks for a specific number of rows, return at most {top_k} rows.
+Only use columns that appear in the tables below. Address nested STRUCT fields with dot paths (e.g. subject.patientId) and UNNEST ARRAY fields.
+Return only the SQL query, without explanations or markdown.
+
+Only use the following tables:
+{table_info}
+
+Question: {input}
+SQLQuery:"""
+)
+
 ANSWER_PROMPT = PromptTemplate.from_template(
     """Given the following user question, corresponding SQL query, and SQL result, answer the user question.
 If the SQL result is empty or contains no relevant information, state that no information was found for the specific request.
@@ -28,6 +47,18 @@ SQL Result: {result}
 Answer:"""
 )
 
+# Code fences (tagged or not) and the "SQLQuery:" label that models echo from the prompt
+_SQL_FENCE = re.compile(r"^\s*```[A-Za-z]*\s*\n?|\n?\s*```\s*$")
+_SQL_LABEL = re.compile(r"^\s*SQLQuery:\s*", re.IGNORECASE)
+
+def clean_generated_sql(text: str) -> str:
+    """
+    Reduce an LLM completion to the bare SQL, as create_sql_query_chain's parser did.
+    """
+    sql = _SQL_LABEL.sub("", text.strip())
+    sql = _SQL_FENCE.sub("", sql)
+    return _SQL_LABEL.sub("", sql).strip()
+
 class LangchainSqlHandler:
     def __init__(self):
         self.llm = ChatVertexAI(
@@ -39,11 +70,22 @@ class LangchainSqlHandler:
         # Jobs will run in VERTEX_AI_PROJECT_ID (where client is initialized), data is read from BIGQUERY_PROJECT_ID.FHIR_DATASET_ID
         db_uri = f"bigquery://{settings.BIGQUERY_PROJECT_ID}/{settings.FHIR_DATASET_ID}"
 
-        # Pull full authoritative DDLs for every table in the dataset
-        custom_table_info_dict = get_fhir_synthea_schema(
+        # Pull authoritative schemas for every table in the dataset once; prompts only
+        # receive the subset the SchemaSelector picks for each question
+        tables = load_fhir_synthea_tables(
             settings.BIGQUERY_PROJECT_ID,
             settings.FHIR_DATASET_ID
         )
+        custom_table_info_dict = {
+            fq_table: build_table_ddl(fq_table, fields, settings.SCHEMA_STRUCT_DEPTH)
+            for fq_table, fields in tables.items()
+        }
+        self.schema_selector = SchemaSelector(
+            tables,
+            max_depth=settings.SCHEMA_STRUCT_DEPTH,
+            max_tables=settings.SCHEMA_MAX_TABLES,
+            max_columns=settings.SCHEMA_MAX_COLUMNS
+        )
         
         self.db = SQLDatabase.from_uri(
             db_uri,
@@ -52,7 +94,19 @@ class LangchainSqlHandler:
             include_tables=list(custom_table_info_dict.keys())
         )
 
-        self.generate_query_chain = create_sql_query_chain(self.llm, self.db)
+        # "schema_question" (the bare physician question) drives schema selection, so the
+        # patient-filter instructions naming every table don't pull all of them back in
+        self.generate_query_chain = (
+            RunnablePassthrough.assign(
+                input=lambda x: x["question"],
+                table_info=lambda x: self.schema_selector.table_info(x.get("schema_question", x["question"])),
+                top_k=lambda x: 10
+            )
+            | SQL_GENERATION_PROMPT
+            | self.llm.bind(stop=["\nSQLResult:"])
+            | StrOutputParser()
+            | clean_generated_sql
+        )
         # Using RunnablePassthrough to ensure the query string is passed to db.run
         self.execute_query_chain = RunnablePassthrough.assign(result=lambda x: self.db.run(x["query"]))
         self.answer_chain = ANSWER_PROMPT | self.llm | StrOutputParser()
@@ -66,6 +120,12 @@ class LangchainSqlHandler:
         )
 
     async def get_response(self, natural_language_query: str, patient_id: str) -> tuple[str | None, str | None]:
+        # Admission control: the sql_generation slot covers the whole chain; each Gemini call
+        # and the BigQuery run also take their backend's slot, so those limits cap all work
+        async with get_scheduler().slot("sql_generation"):
+            return await self._answer(natural_language_query, patient_id)
+
+    async def _answer(self, natural_language_query: str, patient_id: str) -> tuple[str | None, str | None]:
         # Log the incoming request for traceability
         log_event("request/langchain_sql", {"question": natural_language_query, "patient_id": patient_id})
         system_message = f"""You MUST include 'WHERE subject.patientId = '{patient_id}' 
@@ -75,27 +135,32 @@ class LangchainSqlHandler:
 
         try:
             # To get the SQL query separately for logging/returning:
-            sql_query = self.generate_query_chain.invoke({"question": question_with_context})
+            sql_query = await self._call_llm(self.generate_query_chain.invoke, {"question": question_with_context, "schema_question": natural_language_query})
             print(f"Langchain Generated SQL: {sql_query}")
             
             # Using the pre-defined full_chain for simplicity, though it might re-run query generation.
             # For more control and to ensure the logged SQL is the one used for the result:
-            chain_input = {"question": question_with_context}
+            chain_input = {"question": question_with_context, "schema_question": natural_language_query}
             # First, get the SQL query
-            generated_sql_query = self.generate_query_chain.invoke(chain_input)
+            generated_sql_query = await self._call_llm(self.generate_query_chain.invoke, chain_input)
             print(f"Langchain Generated SQL: {generated_sql_query}")
             
             if not self._validate_sql(generated_sql_query, patient_id):
                 raise ValueError(f"Query validation failed for patient {patient_id}")
 
             # Then, execute the query
-            sql_result = self.db.run(generated_sql_query)
+            async with get_scheduler().slot("bigquery"):
+                sql_result = await call_with_resilience(
+                    lambda timeout: asyncio.to_thread(self.db.run, generated_sql_query),
+                    backend="bigquery",
+                    attempt_timeout=settings.BIGQUERY_TIMEOUT_SECONDS
+                )
             print(f"Langchain SQL Result: {sql_result}")
             # Log the SQL execution and result count
             log_event("sql/langchain", {"sql": generated_sql_query, "patient_id": patient_id, "rows": len(sql_result)})
             
             # Finally, generate the natural language answer
-            nl_answer = self.answer_chain.invoke({
+            nl_answer = await self._call_llm(self.answer_chain.invoke, {
                 "question": question_with_context, # Pass original question with context
                 "query": generated_sql_query,
                 "result": sql_result
@@ -105,6 +170,9 @@ class LangchainSqlHandler:
             log_event("response/langchain_sql", {"answer": nl_answer})
 
             return nl_answer, generated_sql_query
+        except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError):
+            # No point asking a failing LLM to phrase the error; let the caller fall back
+            raise
         except Exception as e:
             print(f"Error during Langchain SQL interaction: {e}")
             log_event("error/langchain_sql", {"error": str(e)})
@@ -114,12 +182,24 @@ class LangchainSqlHandler:
             # Attempt to get the LLM to phrase the error to the user
             try:
                 error_prompt = f"An internal error occurred: {str(e)}. Please inform the user politely that their request could not be completed due to this error."
-                nl_error_answer = self.llm.predict(error_prompt) # predict is a shorthand
+                nl_error_answer = await self._call_llm(self.llm.predict, error_prompt) # predict is a shorthand
                 return nl_error_answer, None
             except Exception: # Fallback if LLM fails during error reporting
                  return error_message, None
 
 
+    async def _call_llm(self, fn, *args):
+        """
+        Runs a blocking chain call in a thread under a Vertex LLM slot, breaker and deadline.
+        """
+        async with get_scheduler().slot("vertex_llm"):
+            return await call_with_resilience(
+                lambda timeout: asyncio.to_thread(fn, *args),
+                backend="vertex_llm",
+                model=settings.LLM_MODEL_NAME,
+                attempt_timeout=settings.LLM_TIMEOUT_SECONDS
+            )
+
     def _validate_sql(self, sql_query: str, patient_id: str) -> bool:
         """
         Validates that the SQL query contains proper patient ID filtering.
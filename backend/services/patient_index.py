@@ -0,0 +1,333 @@
+import asyncio
+import base64
+import copy
+import heapq
+import json
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+from ..config import settings
+from .bigquery_handler import BigQueryHandler, get_bigquery_handler
+from .change_sync import change_bus
+
+
+# Prefixes spanning more distinct terms than this are answered by an ordered scan
+BROAD_PREFIX_TERMS = 256
+# Incremental changes are folded into fresh arrays (in memory, no BigQuery) past this size
+MAX_DELTA = 1024
+
+
+def normalize(text: str | None) -> str:
+    """
+    Accent-stripped, lower-case, alphanumeric-only form used for matching.
+    """
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if ch.isalnum() or ch.isspace()).lower().strip()
+
+
+class PatientRecord:
+    """
+    Compact directory entry; __slots__ keeps tens of thousands of these small.
+    """
+    __slots__ = ("id", "name", "gender", "birth_date", "identifiers", "sort_key", "terms")
+
+    def __init__(self, id: str, name: str | None, gender: str | None, birth_date: str | None, identifiers: tuple[str, ...]):
+        self.id = id
+        self.name = name
+        self.gender = gender
+        self.birth_date = birth_date
+        self.identifiers = identifiers
+        # Listing order and keyset cursor position
+        name_key = normalize(name)
+        self.sort_key = (name_key, id)
+        # Normalised search terms: name tokens, the joined name, identifiers and the id
+        terms = set(name_key.split())
+        terms.add(name_key.replace(" ", ""))
+        terms.update(normalize(identifier) for identifier in identifiers)
+        terms.add(normalize(id))
+        terms.discard("")
+        self.terms = tuple(terms)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "gender": self.gender,
+            "birth_date": self.birth_date,
+            "identifiers": list(self.identifiers),
+        }
+
+
+def encode_cursor(sort_key: tuple[str, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, str]:
+    try:
+        name_key, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(name_key), str(patient_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+class _PostingCursor:
+    """
+    Ascending stream over the union of several sorted posting arrays (all terms
+    sharing a prefix), with seek() so intersections can skip ahead.
+    """
+    def __init__(self, arrays: list[array], start: int):
+        self._arrays = arrays
+        self._heap = []
+        for i, postings in enumerate(arrays):
+            offset = bisect_left(postings, start)
+            if offset < len(postings):
+                self._heap.append((postings[offset], i, offset))
+        heapq.heapify(self._heap)
+
+    def seek(self, target: int) -> int | None:
+        """
+        Smallest position >= target, or None when exhausted.
+        """
+        heap = self._heap
+        while heap and heap[0][0] < target:
+            _, i, offset = heap[0]
+            postings = self._arrays[i]
+            offset = bisect_left(postings, target, offset + 1)
+            if offset < len(postings):
+                heapq.heapreplace(heap, (postings[offset], i, offset))
+            else:
+                heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+
+class PatientIndex:
+    """
+    Immutable search index. Records are stored in sort-key order; a sorted array
+    of distinct terms (name tokens, full name, identifiers, id) maps to per-term
+    position arrays, so a prefix query is two binary searches plus a lazy merge
+    of already-sorted postings starting at the cursor.
+
+    Changed patients are layered on top without touching those arrays: their old
+    entries are tombstoned and the new ones kept in a small sorted delta that is
+    searched directly and merged into each page (see with_changes).
+    """
+    def __init__(self, records: list[PatientRecord]):
+        self.records = sorted(records, key=lambda r: r.sort_key)
+        self._sort_keys = [r.sort_key for r in self.records]
+        self._by_id = {r.id: position for position, r in enumerate(self.records)}
+
+        postings: dict[str, array] = {}
+        for position, record in enumerate(self.records):
+            for term in record.terms:
+                # Positions are appended in ascending order, so each array stays sorted
+                postings.setdefault(term, array("I")).append(position)
+        self._terms = sorted(postings)
+        self._postings = [postings[term] for term in self._terms]
+        self._tombstones: frozenset[str] = frozenset() # Base ids superseded or deleted
+        self._delta: list[PatientRecord] = [] # Changed/added records, in sort-key order
+        self._delta_by_id: dict[str, PatientRecord] = {}
+        self.built_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.records) - len(self._tombstones) + len(self._delta)
+
+    @property
+    def delta_size(self) -> int:
+        return len(self._tombstones) + len(self._delta)
+
+    def get(self, patient_id: str) -> PatientRecord | None:
+        record = self._delta_by_id.get(patient_id)
+        if record is not None or patient_id in self._tombstones:
+            return record
+        position = self._by_id.get(patient_id)
+        return self.records[position] if position is not None else None
+
+    def all_records(self) -> list[PatientRecord]:
+        return [r for r in self.records if r.id not in self._tombstones] + self._delta
+
+    def with_changes(self, changed: dict[str, PatientRecord | None]) -> "PatientIndex":
+        """
+        A new index sharing this one's arrays, with `changed` ({id: record, or None
+        when deleted}) applied in O(changes). Readers of this index are unaffected.
+        """
+        index = copy.copy(self)
+        index._tombstones = self._tombstones | {patient_id for patient_id in changed if patient_id in self._by_id}
+        delta = {r.id: r for r in self._delta}
+        for patient_id, record in changed.items():
+            delta.pop(patient_id, None)
+            if record is not None:
+                delta[patient_id] = record
+        index._delta = sorted(delta.values(), key=lambda r: r.sort_key)
+        index._delta_by_id = delta
+        return index
+
+    def _prefix_range(self, prefix: str) -> tuple[int, int]:
+        start = bisect_left(self._terms, prefix)
+        # Every term with this prefix sorts before prefix + U+10FFFF
+        return start, bisect_left(self._terms, prefix + "\U0010ffff", start)
+
+    @staticmethod
+    def _record_matches(record: PatientRecord, token: str) -> bool:
+        return any(term.startswith(token) for term in record.terms)
+
+    def _intersect(self, tokens: list[str], ranges: dict, start: int):
+        """
+        Yield, in order, positions >= start present in every token's postings
+        (leapfrog join). Without any selective token, every position is a candidate.
+        """
+        if not tokens:
+            yield from range(start, len(self.records))
+            return
+        cursors = [_PostingCursor(self._postings[low:high], start) for low, high in (ranges[t] for t in tokens)]
+        target = start
+        while True:
+            heads = [cursor.seek(target) for cursor in cursors]
+            if None in heads:
+                return
+            highest = max(heads)
+            if highest == min(heads):
+                yield highest
+                target = highest + 1
+            else:
+                target = highest
+
+    def _base_matches(self, tokens: list[str], start: int):
+        ranges = {token: self._prefix_range(token) for token in tokens}
+        narrow = [token for token in tokens if ranges[token][1] - ranges[token][0] <= BROAD_PREFIX_TERMS]
+        broad = [token for token in tokens if token not in narrow]
+        for position in self._intersect(narrow, ranges, start):
+            record = self.records[position]
+            if record.id in self._tombstones:
+                continue
+            if all(self._record_matches(record, token) for token in broad):
+                yield record
+
+    def search(self, query: str | None, limit: int, cursor: str | None = None) -> tuple[list[PatientRecord], str | None]:
+        """
+        Return one page of records matching every query token as a prefix (all
+        records when query is empty), in name order, after the keyset cursor.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        start = bisect_right(self._sort_keys, after) if after else 0
+        tokens = normalize(query).split() if query else []
+
+        matches = self._base_matches(tokens, start)
+        if self._delta:
+            delta_start = bisect_right([r.sort_key for r in self._delta], after) if after else 0
+            delta_matches = (
+                r for r in self._delta[delta_start:]
+                if all(self._record_matches(r, token) for token in tokens)
+            )
+            matches = heapq.merge(matches, delta_matches, key=lambda r: r.sort_key)
+        # One look-ahead row tells us whether another page exists
+        page = list(islice(matches, limit + 1))
+
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].sort_key) if page and has_more else None
+        return page, next_cursor
+
+
+class PatientIndexManager:
+    """
+    Owns the live index: full rebuilds when it goes stale, and incremental
+    updates for patients reported by the change bus. Readers always see a
+    complete index because a new one is built off to the side and swapped in.
+    """
+    def __init__(self, bq_handler: BigQueryHandler, refresh_seconds: float):
+        self.bq_handler = bq_handler
+        self.refresh_seconds = refresh_seconds
+        self.index: PatientIndex | None = None
+        self._rebuild_lock = asyncio.Lock()
+        # Background rebuilds and change applications; held so they are not garbage collected
+        self._tasks: set[asyncio.Task] = set()
+        self._refresh_task: asyncio.Task | None = None
+        change_bus.subscribe(self._on_change)
+
+    @staticmethod
+    def _to_record(row: dict) -> PatientRecord:
+        return PatientRecord(
+            id=row["id"],
+            name=row.get("name"),
+            gender=row.get("gender"),
+            birth_date=str(row["birthDate"]) if row.get("birthDate") is not None else None,
+            identifiers=tuple(row.get("identifiers") or ()),
+        )
+
+    def _spawn(self, coro, label: str) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+
+        def done(finished: asyncio.Task):
+            self._tasks.discard(finished)
+            if not finished.cancelled() and finished.exception() is not None:
+                print(f"Patient index {label} failed: {finished.exception()}")
+
+        task.add_done_callback(done)
+        return task
+
+    async def rebuild(self, force: bool = True) -> PatientIndex:
+        """
+        Full rebuild from BigQuery. Without `force`, a caller that queued behind
+        another build reuses its index instead of scanning the Patient table again.
+        """
+        async with self._rebuild_lock:
+            if not force and self.index is not None:
+                return self.index
+            rows = await self.bq_handler.fetch_patient_directory()
+            records = [self._to_record(row) for row in rows]
+            self.index = await asyncio.to_thread(PatientIndex, records)
+            print(f"Patient index rebuilt with {len(self.index)} patients")
+            return self.index
+
+    async def get_index(self) -> PatientIndex:
+        if self.index is None:
+            # Concurrent cold requests share the first build
+            return await self.rebuild(force=False)
+        refreshing = self._refresh_task is not None and not self._refresh_task.done()
+        if time.time() - self.index.built_at > self.refresh_seconds and not refreshing:
+            # Serve the current index while a fresh one is built in the background
+            self._refresh_task = self._spawn(self.rebuild(), "rebuild")
+        return self.index
+
+    async def apply_changes(self, patient_ids: set[str]) -> None:
+        """
+        Re-fetch only the changed patients and layer them over the live index;
+        patients no longer returned are treated as deleted.
+        """
+        if self.index is None:
+            return
+        rows = await self.bq_handler.fetch_patient_directory(list(patient_ids))
+        changed: dict[str, PatientRecord | None] = dict.fromkeys(patient_ids)
+        changed.update((row["id"], self._to_record(row)) for row in rows)
+        async with self._rebuild_lock:
+            index = self.index.with_changes(changed)
+            if index.delta_size > MAX_DELTA:
+                index = await asyncio.to_thread(PatientIndex, index.all_records())
+                # Compaction reuses the in-memory records; keep the original staleness clock
+                index.built_at = self.index.built_at
+            self.index = index
+
+    def _on_change(self, resource_type: str, patient_ids: set[str]) -> None:
+        if resource_type != "Patient":
+            return
+        try:
+            self._spawn(self.apply_changes(patient_ids), "update")
+        except RuntimeError:
+            # No loop (e.g. CLI sync in another process); the periodic rebuild catches up
+            pass
+
+
+_manager: PatientIndexManager | None = None
+
+def get_patient_index_manager() -> PatientIndexManager:
+    # One index per worker, shared across requests
+    global _manager
+    if _manager is None:
+        _manager = PatientIndexManager(get_bigquery_handler(), settings.PATIENT_INDEX_REFRESH_SECONDS)
+    return _manager
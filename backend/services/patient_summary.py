@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+import orjson
+
+from ..api.models import AllergyItem, ConditionItem, Demographics, MedicationItem, ObservationItem, PatientOverview
+from ..config import settings
+from .bigquery_handler import BigQueryHandler, get_bigquery_handler
+from .change_sync import change_bus
+
+# Bump when the response shape changes so clients holding old ETags refetch
+SUMMARY_FORMAT_VERSION = "1"
+
+
+def _text(value) -> str | None:
+    # BigQuery may hand back date/datetime objects for FHIR date fields
+    return str(value) if value is not None else None
+
+
+def build_overview(patient_id: str, sections: dict) -> PatientOverview:
+    demographics = (sections.get("demographics") or [{}])[0]
+    return PatientOverview(
+        patient_id=patient_id,
+        demographics=Demographics(
+            name=demographics.get("patient_name"),
+            gender=demographics.get("gender"),
+            birth_date=_text(demographics.get("birth_date")),
+        ),
+        conditions=[
+            ConditionItem(text=row.get("condition_text"), recorded_date=_text(row.get("recorded_date")))
+            for row in sections.get("conditions") or []
+        ],
+        medications=[
+            MedicationItem(text=row.get("medication_text"), authored_on=_text(row.get("authored_on")))
+            for row in sections.get("medications") or []
+        ],
+        allergies=[
+            AllergyItem(text=row.get("allergy_text"), criticality=row.get("criticality"))
+            for row in sections.get("allergies") or []
+        ],
+        recent_observations=[
+            ObservationItem(
+                text=row.get("observation_text"),
+                value=row.get("observation_value"),
+                unit=row.get("observation_unit"),
+                value_text=row.get("observation_value_text"),
+                effective_date=_text(row.get("effective_date")),
+            )
+            for row in sections.get("observations") or []
+        ],
+    )
+
+
+def make_etag(fingerprint: str) -> str:
+    # Weak validator: GZipMiddleware may send this body gzip- or identity-coded under the
+    # same tag, and strong validators must differ across content-codings (RFC 9110 8.8.3)
+    return 'W/"' + hashlib.sha256(f"{SUMMARY_FORMAT_VERSION}:{fingerprint}".encode()).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    If-None-Match uses weak comparison, so a W/ prefix on either side is ignored.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == bare for candidate in if_none_match.split(","))
+
+
+class CachedSummary:
+    __slots__ = ("fingerprint", "etag", "body", "validated_at")
+
+    def __init__(self, fingerprint: str, body: bytes):
+        self.fingerprint = fingerprint
+        self.etag = make_etag(fingerprint)
+        self.body = body # Pre-serialised JSON, reused for every 200 until the rows change
+        self.validated_at = time.monotonic()
+
+
+class PatientSummaryService:
+    """
+    Serves the structured patient overview with a data-fingerprint ETag.
+
+    A cached entry is trusted for `revalidate_seconds` (or until the change bus
+    reports the patient changed), so a conditional reopen usually costs no
+    BigQuery job at all. After that, one fingerprint-only job decides whether
+    the cached body still stands; only a changed fingerprint refetches the
+    sections, which come back with their own fingerprint in the same job.
+    """
+    def __init__(self, bq_handler: BigQueryHandler, revalidate_seconds: float, max_entries: int):
+        self.bq_handler = bq_handler
+        self.revalidate_seconds = revalidate_seconds
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, CachedSummary] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Task] = {}
+        change_bus.subscribe(self._on_change)
+
+    def _on_change(self, resource_type: str, patient_ids: set[str]) -> None:
+        for patient_id in patient_ids:
+            self._cache.pop(patient_id, None)
+
+    def _store(self, patient_id: str, entry: CachedSummary) -> None:
+        self._cache[patient_id] = entry
+        self._cache.move_to_end(patient_id)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    async def get(self, patient_id: str) -> CachedSummary | None:
+        """
+        Current summary for the patient, or None when the patient does not exist.
+        """
+        # Concurrent opens of the same patient share one round of BigQuery work
+        task = self._in_flight.get(patient_id)
+        if task is None:
+            task = asyncio.create_task(self._get(patient_id))
+            self._in_flight[patient_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(patient_id, None))
+        # One caller going away must not cancel the fetch for the others
+        return await asyncio.shield(task)
+
+    async def _get(self, patient_id: str) -> CachedSummary | None:
+        entry = self._cache.get(patient_id)
+        if entry is not None:
+            if time.monotonic() - entry.validated_at < self.revalidate_seconds:
+                self._cache.move_to_end(patient_id)
+                return entry
+            fingerprint = await self.bq_handler.fetch_patient_summary_fingerprint(patient_id)
+            if fingerprint == entry.fingerprint:
+                entry.validated_at = time.monotonic()
+                self._cache.move_to_end(patient_id)
+                return entry
+
+        sections = await self.bq_handler.fetch_patient_summary_sections(patient_id)
+        if not sections.get("demographics"):
+            self._cache.pop(patient_id, None)
+            return None
+        overview = build_overview(patient_id, sections)
+        entry = CachedSummary(sections["fingerprint"], orjson.dumps(overview.model_dump(mode="json")))
+        self._store(patient_id, entry)
+        return entry
+
+
+_service: PatientSummaryService | None = None
+
+def get_patient_summary_service() -> PatientSummaryService:
+    # One cache per worker, shared across requests
+    global _service
+    if _service is None:
+        _service = PatientSummaryService(
+            get_bigquery_handler(),
+            revalidate_seconds=settings.PATIENT_SUMMARY_REVALIDATE_SECONDS,
+            max_entries=settings.PATIENT_SUMMARY_CACHE_SIZE
+        )
+    return _service
@@ -0,0 +1,324 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+@dataclass(frozen=True)
+class QueryTemplate:
+    """
+    One parameterised, patient-scoped FHIR lookup. `columns` are (output name,
+    SQL expression over `alias`) pairs; the only parameter is @patient_id.
+    """
+    intent: str
+    # Matched as whole words; a trailing plural "s" is allowed. Keep these to nouns
+    # that only name this record type: generic words ("test", "result", "problem")
+    # pull unrelated questions onto the wrong table. A question that also names a
+    # specific drug, test, indication or year ("penicillin allergy", "A1c lab result")
+    # still matches here; is_listing_question() keeps such questions away from the
+    # deterministic renderer, since the template returns the unfiltered list.
+    keywords: tuple[str, ...]
+    table: str # Key into BigQueryHandler.fhir_base_tables
+    alias: str
+    patient_column: str
+    columns: tuple[tuple[str, str], ...]
+    order_by: str
+    max_rows: int # Newest rows returned; renderers say when older ones were cut off
+    filters: tuple[str, ...] = ()
+    date_column: str | None = None # Output column holding the row's date, for renderers
+
+
+def _category_filter(alias: str, category: str) -> str:
+    return (
+        f"EXISTS (SELECT 1 FROM UNNEST({alias}.category) AS cat "
+        f"JOIN UNNEST(cat.coding) AS cat_coding WHERE cat_coding.code = '{category}')"
+    )
+
+
+def _component_value(alias: str, loinc_code: str) -> str:
+    return (
+        f"(SELECT comp.valueQuantity.value FROM UNNEST({alias}.component) AS comp "
+        f"JOIN UNNEST(comp.code.coding) AS comp_coding WHERE comp_coding.code = '{loinc_code}' LIMIT 1)"
+    )
+
+
+TEMPLATES = (
+    QueryTemplate(
+        intent="medications",
+        keywords=("medication", "med", "prescription", "prescribed"),
+        table="medicationrequest",
+        alias="M",
+        patient_column="subject.patientId",
+        columns=(
+            ("medication_name", "M.medicationCodeableConcept.text"),
+            ("status", "M.status"),
+            ("prescribed_date", "M.authoredOn"),
+        ),
+        order_by="M.authoredOn DESC",
+        max_rows=50,
+        date_column="prescribed_date",
+    ),
+    QueryTemplate(
+        intent="allergies",
+        keywords=("allergy", "allergies", "allergic", "intolerance"),
+        table="allergyintolerance",
+        alias="A",
+        patient_column="patient.patientId",
+        columns=(
+            ("allergy_name", "A.code.text"),
+            ("severity", "A.criticality"),
+            ("recorded_date", "A.recordedDate"),
+        ),
+        order_by="A.recordedDate DESC",
+        max_rows=50,
+        date_column="recorded_date",
+    ),
+    QueryTemplate(
+        intent="conditions",
+        keywords=("condition", "diagnosis", "diagnoses", "diagnosed", "problem list"),
+        table="condition",
+        alias="C",
+        patient_column="subject.patientId",
+        columns=(
+            ("condition_name", "C.code.text"),
+            ("status", "(SELECT cs.code FROM UNNEST(C.clinicalStatus.coding) AS cs LIMIT 1)"),
+            ("recorded_date", "C.recordedDate"),
+        ),
+        order_by="C.recordedDate DESC",
+        max_rows=50,
+        date_column="recorded_date",
+    ),
+    QueryTemplate(
+        intent="labs",
+        keywords=("lab", "laboratory", "lab result", "test result", "blood test", "bloodwork", "blood work"),
+        table="observation",
+        alias="O",
+        patient_column="subject.patientId",
+        columns=(
+            ("test_name", "O.code.text"),
+            ("value", "O.valueQuantity.value"),
+            ("unit", "O.valueQuantity.unit"),
+            ("test_date", "O.effectiveDateTime"),
+        ),
+        filters=(_category_filter("O", "laboratory"),),
+        order_by="O.effectiveDateTime DESC",
+        max_rows=10,
+        date_column="test_date",
+    ),
+    QueryTemplate(
+        intent="vitals",
+        keywords=("vital", "vital sign", "bp", "blood pressure", "heart rate", "pulse", "temperature", "respiratory rate"),
+        table="observation",
+        alias="O",
+        patient_column="subject.patientId",
+        columns=(
+            ("vital_sign", "O.code.text"),
+            ("value", "O.valueQuantity.value"),
+            ("unit", "O.valueQuantity.unit"),
+            # Blood pressure is a panel: its readings are components, not valueQuantity
+            ("systolic", _component_value("O", "8480-6")),
+            ("diastolic", _component_value("O", "8462-4")),
+            ("recorded_date", "O.effectiveDateTime"),
+        ),
+        filters=(_category_filter("O", "vital-signs"),),
+        order_by="O.effectiveDateTime DESC",
+        max_rows=10,
+        date_column="recorded_date",
+    ),
+    QueryTemplate(
+        intent="encounters",
+        keywords=("encounter", "visit", "admission", "admitted", "appointment", "hospitalization", "hospitalized"),
+        table="encounter",
+        alias="E",
+        patient_column="subject.patientId",
+        columns=(
+            ("encounter_type", "(SELECT t.text FROM UNNEST(E.type) AS t LIMIT 1)"),
+            ("encounter_class", "E.class.code"),
+            ("status", "E.status"),
+            ("start_date", "E.period.start"),
+            ("end_date", "E.period.end"),
+        ),
+        order_by="E.period.start DESC",
+        max_rows=20,
+        date_column="start_date",
+    ),
+    QueryTemplate(
+        intent="procedures",
+        keywords=("procedure", "surgery", "surgeries", "operation", "surgical"),
+        table="procedure",
+        alias="P",
+        patient_column="subject.patientId",
+        columns=(
+            ("procedure_name", "P.code.text"),
+            ("status", "P.status"),
+            ("performed_date", "P.performedPeriod.start"),
+        ),
+        order_by="P.performedPeriod.start DESC",
+        max_rows=20,
+        date_column="performed_date",
+    ),
+    QueryTemplate(
+        intent="immunizations",
+        keywords=("immunization", "immunisation", "vaccine", "vaccination", "vaccinated", "flu shot"),
+        table="immunization",
+        alias="I",
+        patient_column="patient.patientId",
+        columns=(
+            ("vaccine_name", "I.vaccineCode.text"),
+            ("status", "I.status"),
+            ("administered_date", "I.occurrenceDateTime"),
+        ),
+        order_by="I.occurrenceDateTime DESC",
+        max_rows=30,
+        date_column="administered_date",
+    ),
+    QueryTemplate(
+        intent="care_plans",
+        keywords=("care plan", "careplan", "treatment plan"),
+        table="careplan",
+        alias="CP",
+        patient_column="subject.patientId",
+        columns=(
+            ("plan_category", "(SELECT c.text FROM UNNEST(CP.category) AS c LIMIT 1)"),
+            ("status", "CP.status"),
+            ("start_date", "CP.period.start"),
+            ("end_date", "CP.period.end"),
+        ),
+        order_by="CP.period.start DESC",
+        max_rows=20,
+        date_column="start_date",
+    ),
+)
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_PATIENT_COLUMNS = {"subject.patientId", "patient.patientId"}
+
+
+def validate_template(template: QueryTemplate) -> None:
+    """
+    Reject templates that could escape the patient scope or break the combined
+    query. Runs once at import, so a bad template fails start-up, not a request.
+    """
+    problems = []
+    if not _IDENTIFIER.match(template.intent):
+        problems.append("intent must be an identifier")
+    if not _IDENTIFIER.match(template.alias):
+        problems.append("alias must be an identifier")
+    if template.patient_column not in _PATIENT_COLUMNS:
+        problems.append(f"patient_column must be one of {sorted(_PATIENT_COLUMNS)}")
+    if not template.keywords or not template.columns:
+        problems.append("keywords and columns are required")
+    if not 0 < template.max_rows <= 1000:
+        problems.append("max_rows must be between 1 and 1000")
+    names = [name for name, _ in template.columns]
+    if len(set(names)) != len(names) or not all(_IDENTIFIER.match(name) for name in names):
+        problems.append("column names must be unique identifiers")
+    if template.date_column is not None and template.date_column not in names:
+        problems.append("date_column must be one of the columns")
+    sql_parts = [expression for _, expression in template.columns] + list(template.filters) + [template.order_by]
+    for part in sql_parts:
+        if ";" in part or "--" in part or "@" in part:
+            problems.append(f"unsafe SQL fragment: {part!r}")
+    if problems:
+        raise ValueError(f"Invalid query template '{template.intent}': {'; '.join(problems)}")
+
+
+for _template in TEMPLATES:
+    validate_template(_template)
+if len({t.intent for t in TEMPLATES}) != len(TEMPLATES):
+    raise ValueError("Query template intents must be unique")
+
+TEMPLATES_BY_INTENT = {template.intent: template for template in TEMPLATES}
+
+# One alternation per template, compiled once; the question is lower-cased once per match call.
+# Longest keywords first, so "vital signs" matches as one phrase rather than "vital" + "signs"
+_KEYWORD_PATTERNS = [
+    (template, re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(template.keywords, key=len, reverse=True)) + r")s?\b"))
+    for template in TEMPLATES
+]
+
+
+def match_intents(query_text: str) -> list[QueryTemplate]:
+    """
+    Every template whose keywords appear in the question, in registry order.
+    """
+    text = query_text.lower()
+    return [template for template, pattern in _KEYWORD_PATTERNS if pattern.search(text)]
+
+
+# A plain listing question is template keywords plus these words and nothing else
+# ("What meds is she on?", "Any allergies?", "List her vital signs")
+_LISTING_WORDS = {
+    "list", "show", "what", "which", "any", "all", "current", "currently", "recent", "latest",
+    "most", "give", "display", "tell", "see", "get", "pull", "up", "known", "active",
+    "her", "his", "their", "she", "he", "they", "patient", "patients", "s", "the", "a", "an",
+    "is", "are", "was", "were", "does", "do", "did", "has", "have", "had", "on", "of", "for",
+    "to", "in", "this", "that", "there", "me", "us", "i", "my", "can", "you", "please",
+    "and", "or", "with", "about", "record", "records", "result", "results", "reading", "readings",
+}
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def is_listing_question(query_text: str) -> bool:
+    """
+    True when the question only asks to list a patient's records, so template rows
+    answer it verbatim. Anything left over once keywords and listing words are
+    removed (a drug, test, indication, year, "family", "should") is a qualifier the
+    unfiltered template list does not answer. So are two adjacent keywords, where
+    one qualifies the other ("blood pressure meds").
+    """
+    text = query_text.lower()
+    spans = sorted(
+        match.span()
+        for _, pattern in _KEYWORD_PATTERNS
+        for match in pattern.finditer(text)
+    )
+    if not spans:
+        return False
+    remainder = []
+    position = 0
+    for start, end in spans:
+        if start < position:
+            continue # Overlapping keywords ("blood test" inside "blood test result")
+        between = text[position:start]
+        if position > 0 and not between.strip():
+            return False
+        remainder.append(between)
+        position = end
+    remainder.append(text[position:])
+    return all(word in _LISTING_WORDS for word in _WORD.findall(" ".join(remainder)))
+
+
+def _template_subquery(template: QueryTemplate, table: str) -> str:
+    a = template.alias
+    select_list = ", ".join(f"{expression} AS {name}" for name, expression in template.columns)
+    where = " AND ".join([f"{a}.{template.patient_column} = @patient_id", *template.filters])
+    return f"""ARRAY(
+                SELECT AS STRUCT {select_list}
+                FROM `{table}` AS {a}
+                WHERE {where}
+                ORDER BY {template.order_by}
+                LIMIT {template.max_rows}
+            ) AS {template.intent}"""
+
+
+@lru_cache(maxsize=128)
+def _build_combined_sql(intents: tuple[str, ...], tables: tuple[tuple[str, str], ...]) -> str:
+    table_names = dict(tables)
+    arrays = ",\n            ".join(
+        _template_subquery(TEMPLATES_BY_INTENT[intent], table_names[TEMPLATES_BY_INTENT[intent].table])
+        for intent in intents
+    )
+    return f"""
+        SELECT
+            {arrays}
+    """
+
+
+def build_combined_query(templates: list[QueryTemplate], fhir_tables: dict[str, str]) -> str:
+    """
+    One SELECT returning a single row with one ARRAY<STRUCT> column per intent,
+    so several intents cost one BigQuery job. Built SQL is cached per intent set.
+    """
+    intents = tuple(template.intent for template in templates)
+    tables = tuple(sorted((t.table, fhir_tables[t.table]) for t in templates))
+    return _build_combined_sql(intents, tables)
@@ -1,9 +1,14 @@
 from ..config import settings
+import asyncio
 import vertexai
 from vertexai.generative_models import GenerativeModel
                                                                                
 # Placeholder for BigQuery client to fetch context data                        
 from .bigquery_handler import BigQueryHandler, get_bigquery_handler # Could reuse or have a dedicated one                                                   
+from .speculative import hedged_call
+from .scheduler import get_scheduler
+from .resilience import CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, TRANSIENT_ERRORS, call_with_resilience
+from .answer_renderer import render_answer
                                                                                
 class RagLlmHandler:                                                           
     def __init__(self, bq_handler: BigQueryHandler):
@@ -18,6 +23,33 @@ class RagLlmHandler:
         # Ensure LLM_MODEL_NAME in config.py is set to a valid Gemini model name,
         # e.g., "gemini-1.0-pro" or "gemini-1.5-pro-preview-0409"
         self.llm_client = GenerativeModel(settings.LLM_MODEL_NAME)
+        # Set when the last answer had to be built without the LLM; such answers are not cached
+        self.used_fallback = False
+
+    async def _generate(self, prompt: str) -> str:
+        """
+        Calls Gemini off the event loop, hedging with a duplicate request when enabled.
+        """
+        call = lambda: self.llm_client.generate_content(prompt)
+        if settings.LLM_HEDGING_ENABLED:
+            attempt = lambda timeout: hedged_call(
+                call,
+                hedge_delay_seconds=settings.LLM_HEDGE_DELAY_SECONDS,
+                budget_seconds=min(settings.LLM_CALL_BUDGET_SECONDS, timeout or settings.LLM_CALL_BUDGET_SECONDS),
+                label="rag_llm",
+                backend="vertex_llm",
+            )
+        else:
+            # generate_content takes no per-call timeout; an overrunning call keeps its slot until it returns
+            attempt = lambda timeout: asyncio.to_thread(call)
+        async with get_scheduler().slot("vertex_llm"):
+            response = await call_with_resilience(
+                attempt,
+                backend="vertex_llm",
+                model=settings.LLM_MODEL_NAME,
+                attempt_timeout=settings.LLM_TIMEOUT_SECONDS,
+            )
+        return response.text # Access the text part of the response
                                                                                
     async def retrieve_context(self, patient_id: str, query_text: str) -> str: 
         """                                                                    
@@ -40,29 +72,50 @@ class RagLlmHandler:
     async def handle_complex_query(self, patient_id: str, query_text: str) ->  str:
         context = await self.retrieve_context(patient_id, query_text)
         prompt = f"Based on the following patient context:\n{context}\n\nAnswer the question: {query_text}"
-        response = self.llm_client.generate_content(prompt)
-        return response.text # Access the text part of the response
+        return await self._generate(prompt)
 
     async def generate_summary_from_data(self, structured_data: list[dict], original_query: str) -> str:
         """
         Generates a human-readable summary or answer based on structured data retrieved
         from a simple query.
         """
-        if not structured_data:
-            # Handle cases where the simple query returned no data
-            # Ask LLM to state that no information was found regarding the query
-            prompt = f"The user asked: '{original_query}'. No specific data was found for this request. Please inform the user politely that the requested information is not available or not found for this patient."
-        elif isinstance(structured_data, list) and structured_data and isinstance(structured_data[0], dict) and "error" in structured_data[0]:
-            # Handle cases where the simple query handler itself returned an error (e.g., unsupported query)
-            error_message = structured_data[0]["error"]
-            prompt = f"The user asked: '{original_query}'. However, there was an issue processing this request: {error_message}. Please inform the user politely about this issue."
-        else:
-            # Format the structured data into a string for the prompt
-            data_as_string = "\n".join([str(item) for item in structured_data])
-            prompt = f"Based on the following retrieved data:\n{data_as_string}\n\nPlease answer the user's original question: '{original_query}'. Present the information clearly and confidently."
+        self.used_fallback = False
+        if not structured_data or "error" in structured_data[0]:
+            # "Nothing found" and "could not process" need no LLM round trip
+            return render_answer(structured_data)
+        # Format the structured data into a string for the prompt
+        data_as_string = "\n".join([str(item) for item in structured_data])
+        prompt = f"Based on the following retrieved data:\n{data_as_string}\n\nPlease answer the user's original question: '{original_query}'. Present the information clearly and confidently."
         
-        response = self.llm_client.generate_content(prompt)
-        return response.text
+        try:
+            return await self._generate(prompt)
+        except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, *TRANSIENT_ERRORS) as e:
+            # Gemini is unavailable or too slow: answer deterministically from the rows instead
+            print(f"LLM unavailable for summary, using deterministic fallback: {e}")
+            self.used_fallback = True
+            return render_answer(structured_data)
+
+    async def polish_answer(self, draft_answer: str, original_query: str) -> str:
+        """
+        Rewrites a deterministically rendered answer as natural prose without
+        adding, dropping or changing any fact.
+        """
+        prompt = f"The user asked: '{original_query}'. Here is a complete, correct answer built from the patient's records:\n{draft_answer}\n\nRewrite it as a concise, natural answer for a physician. Keep every item, value and date exactly as given and do not add any information."
+        return await self._generate(prompt)
+
+    async def generate_answer_from_facts(self, fact_sheet: str, original_query: str) -> str:
+        """
+        Answers a trend question from a precomputed fact sheet rather than raw rows.
+        """
+        self.used_fallback = False
+        prompt = f"The following facts were computed from the patient's observations:\n{fact_sheet}\n\nUsing only these facts, answer the user's question: '{original_query}'. Describe the direction and size of any change and cite dates."
+        try:
+            return await self._generate(prompt)
+        except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, *TRANSIENT_ERRORS) as e:
+            # The fact sheet is already human-readable
+            print(f"LLM unavailable for trend answer, returning fact sheet: {e}")
+            self.used_fallback = True
+            return fact_sheet
                                                                                
 def get_rag_llm_handler():                                                     
     bq_handler = get_bigquery_handler() # Or a new instance if different config needed                                                                          
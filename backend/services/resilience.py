@@ -0,0 +1,249 @@
+import asyncio
+import concurrent.futures
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+from google.api_core import exceptions as google_exceptions
+
+from ..config import settings
+from ..utils.request_context import remaining_seconds
+from .scheduler import hold_slot_for, lingering_work
+from ..utils.wandb_monitor import log_event
+
+# Errors worth retrying: throttling, 5xx and timeouts. Anything else (bad SQL,
+# permission errors, validation failures) fails immediately and does not trip a breaker.
+TRANSIENT_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+    asyncio.TimeoutError,
+    concurrent.futures.TimeoutError, # Raised by QueryJob.result(timeout=...)
+)
+_TIMEOUT_ERRORS = (TimeoutError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+
+# How long past its own timeout a client gets to return before its thread is abandoned
+ABANDON_GRACE_SECONDS = 1.0
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when the request's deadline budget runs out before a dependency answered.
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the dependency while its circuit breaker is open.
+    """
+    def __init__(self, key: str, retry_after: int):
+        super().__init__(f"Circuit open for {key}; retry after {retry_after}s")
+        self.key = key
+        self.retry_after = retry_after
+
+
+class RetriesExhaustedError(Exception):
+    """
+    Raised when every attempt at a dependency failed with a transient error.
+    """
+    def __init__(self, key: str, retry_after: int):
+        super().__init__(f"{key} kept failing; retry after {retry_after}s")
+        self.key = key
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker. After `failure_threshold` transient failures the
+    circuit opens for `reset_seconds`; then a single half-open probe is let through
+    and its outcome closes or re-opens the circuit.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, key: str, failure_threshold: int, reset_seconds: float):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_seconds:
+                raise CircuitOpenError(self.key, max(1, int(self.reset_seconds - elapsed)))
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight:
+                raise CircuitOpenError(self.key, 1)
+            self.probe_in_flight = True
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            log_event("resilience/breaker", {"key": self.key, "state": self.CLOSED})
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            log_event("resilience/breaker", {"key": self.key, "state": self.OPEN, "failures": self.consecutive_failures})
+
+    def release_probe(self) -> None:
+        # A probe that ended in a non-transient error says nothing about health
+        self.probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures}
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+def get_breaker(backend: str, model: str | None = None) -> CircuitBreaker:
+    key = f"{backend}:{model}" if model else backend
+    if key not in _breakers:
+        _breakers[key] = CircuitBreaker(
+            key,
+            failure_threshold=settings.BREAKER_FAILURE_THRESHOLD,
+            reset_seconds=settings.BREAKER_RESET_SECONDS,
+        )
+    return _breakers[key]
+
+def get_breaker_states() -> dict:
+    return {key: breaker.snapshot() for key, breaker in _breakers.items()}
+
+
+async def call_with_resilience(
+    call: Callable[[float | None], Awaitable[Any]],
+    backend: str,
+    model: str | None = None,
+    attempt_timeout: float | None = None,
+    max_attempts: int | None = None,
+) -> Any:
+    """
+    Await `call(timeout)` under the backend's circuit breaker. Each attempt gets
+    the smaller of `attempt_timeout` and what is left of the request deadline,
+    and `call` must hand it to the client (e.g. QueryJob.result(timeout=...)) so
+    the blocking call ends, and its server-side work is cancelled, on its own.
+
+    Transient errors are retried with full-jitter exponential backoff while the
+    backoff still fits in the remaining budget. A client that overruns its
+    timeout by ABANDON_GRACE_SECONDS is abandoned but keeps the caller's
+    scheduler slot until its thread returns, and is not retried.
+    """
+    breaker = get_breaker(backend, model)
+    attempts = max_attempts or settings.RETRY_MAX_ATTEMPTS
+    for attempt in range(attempts):
+        breaker.before_call()
+        remaining = remaining_seconds()
+        if remaining is not None and remaining <= 0:
+            breaker.release_probe()
+            raise DeadlineExceededError(f"No time left for {breaker.key}")
+        limits = [t for t in (attempt_timeout, remaining) if t is not None]
+        timeout = min(limits) if limits else None
+        # Timing out here is the request's fault, not the backend's
+        deadline_bound = remaining is not None and (attempt_timeout is None or remaining < attempt_timeout)
+        task = asyncio.ensure_future(call(timeout))
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(task), timeout=timeout + ABANDON_GRACE_SECONDS if timeout is not None else None
+            )
+        except TRANSIENT_ERRORS as e:
+            if not task.done():
+                # The client ignored its timeout; its thread still occupies the backend
+                _abandon(task)
+            # Retrying while an earlier attempt still runs would only pile more work on the backend
+            abandoned = lingering_work() > 0 or not task.done()
+            if deadline_bound and (abandoned or isinstance(e, _TIMEOUT_ERRORS)):
+                breaker.release_probe()
+                raise DeadlineExceededError(f"Deadline reached waiting for {breaker.key}") from e
+            breaker.record_failure()
+            log_event("resilience/retry", {"key": breaker.key, "attempt": attempt + 1, "error": type(e).__name__})
+            if abandoned or attempt + 1 >= attempts:
+                raise RetriesExhaustedError(breaker.key, _retry_after(breaker)) from e
+            if not await _backoff(attempt):
+                raise DeadlineExceededError(f"Deadline reached while retrying {breaker.key}") from e
+            continue
+        except asyncio.CancelledError:
+            # e.g. a losing speculative branch: stop waiting, but keep the slot until the thread ends
+            _abandon(task)
+            breaker.release_probe()
+            raise
+        except BaseException:
+            breaker.release_probe()
+            raise
+        breaker.record_success()
+        return result
+
+
+def _abandon(task: asyncio.Future) -> None:
+    hold_slot_for(task)
+    # Nobody awaits the result any more; retrieve it so a late error is not reported as unhandled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+def _retry_after(breaker: CircuitBreaker) -> int:
+    seconds = breaker.reset_seconds if breaker.state == CircuitBreaker.OPEN else settings.RETRY_MAX_DELAY_SECONDS
+    return max(1, int(seconds))
+
+
+async def _backoff(attempt: int) -> bool:
+    """
+    Sleep before the next attempt; False when the backoff would not fit in the deadline.
+    """
+    backoff = random.uniform(0, min(settings.RETRY_MAX_DELAY_SECONDS, settings.RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+    remaining = remaining_seconds()
+    if remaining is not None and backoff >= remaining:
+        return False
+    await asyncio.sleep(backoff)
+    return True
+
+
+class AnswerCache:
+    """
+    Small TTL cache of recent successful answers, served when a dependency is
+    unavailable instead of failing the request outright.
+    """
+    def __init__(self, ttl_seconds: float, max_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: dict[tuple[str, str], tuple[float, Any]] = {}
+
+    @staticmethod
+    def _key(patient_id: str, query: str) -> tuple[str, str]:
+        return patient_id, " ".join(query.lower().split())
+
+    def get(self, patient_id: str, query: str) -> Any | None:
+        entry = self._entries.get(self._key(patient_id, query))
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            return None
+        return entry[1]
+
+    def invalidate_patient(self, patient_id: str) -> None:
+        for key in [key for key in self._entries if key[0] == patient_id]:
+            del self._entries[key]
+
+    def put(self, patient_id: str, query: str, value: Any) -> None:
+        if len(self._entries) >= self.max_entries:
+            # Drop the oldest entry (dicts preserve insertion order)
+            self._entries.pop(next(iter(self._entries)))
+        key = self._key(patient_id, query)
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic(), value)
+
+
+answer_cache = AnswerCache(ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS)
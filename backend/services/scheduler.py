@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+
+from ..config import settings
+from ..utils.profiler import stage
+from ..utils.request_context import BATCH, INTERACTIVE, current_priority, remaining_seconds
+from ..utils.wandb_monitor import log_event
+
+# Lower rank is served first
+_PRIORITY_RANK = {INTERACTIVE: 0, BATCH: 1}
+
+# Work the current slot's holder stopped waiting for but which is still running
+_lingering: contextvars.ContextVar[list | None] = contextvars.ContextVar("slot_lingering_work", default=None)
+
+
+def hold_slot_for(work: asyncio.Future) -> None:
+    """
+    Keep the enclosing slot occupied until `work` finishes. Used for threads that
+    cannot be interrupted (a timed-out client, a cancelled race branch), so the
+    concurrency limit still counts them after their caller has moved on.
+    """
+    lingering = _lingering.get()
+    if lingering is not None and not work.done():
+        lingering.append(work)
+
+
+def lingering_work() -> int:
+    """
+    How many abandoned threads are still holding the enclosing slot.
+    """
+    return sum(1 for work in _lingering.get() or () if not work.done())
+
+
+class OverloadedError(Exception):
+    """
+    Raised when a backend sheds a request: its wait queue is full, or the
+    request's deadline would pass before a slot frees up.
+    """
+    def __init__(self, backend: str, retry_after: int, reason: str):
+        super().__init__(f"Backend '{backend}' overloaded ({reason}); retry after {retry_after}s")
+        self.backend = backend
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class BackendLimiter:
+    """
+    Concurrency limit for one backend with a bounded, priority-ordered wait queue.
+    Slots are handed directly from the releasing request to the next waiter.
+    """
+    def __init__(self, name: str, max_concurrency: int, max_queue: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        # Metrics
+        self.admitted = 0
+        self.shed = 0
+        self.max_queue_depth = 0
+        self.total_wait_seconds = 0.0
+        self.total_service_seconds = 0.0
+        self.completed = 0
+        self.lingering = 0 # Slots held past their request by abandoned threads
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+    def _retry_after(self) -> int:
+        avg_service = self.total_service_seconds / self.completed if self.completed else 1.0
+        backlog = self.queue_depth + 1
+        return max(1, math.ceil(avg_service * backlog / self.max_concurrency))
+
+    def _shed(self, reason: str) -> OverloadedError:
+        self.shed += 1
+        error = OverloadedError(self.name, self._retry_after(), reason)
+        log_event("scheduler/shed", {"backend": self.name, "reason": reason, "queue_depth": self.queue_depth})
+        return error
+
+    def _evict_batch_waiter(self) -> bool:
+        """
+        Make room for an interactive request by shedding the newest queued batch request.
+        """
+        candidates = [w for w in self._waiters if w[0] == _PRIORITY_RANK[BATCH] and not w[2].done()]
+        if not candidates:
+            return False
+        victim = max(candidates, key=lambda w: w[1])
+        victim[2].set_exception(self._shed("evicted_by_interactive"))
+        return True
+
+    def try_acquire(self) -> bool:
+        """
+        Take a free slot without queueing; False when none is free or others are waiting.
+        """
+        if self._in_flight < self.max_concurrency and self.queue_depth == 0:
+            self._in_flight += 1
+            self.admitted += 1
+            return True
+        return False
+
+    async def acquire(self, priority: str) -> float:
+        """
+        Wait for a slot and return the time spent queued.
+        """
+        rank = _PRIORITY_RANK.get(priority, _PRIORITY_RANK[INTERACTIVE])
+        if self._in_flight < self.max_concurrency and self.queue_depth == 0:
+            self._in_flight += 1
+            self.admitted += 1
+            return 0.0
+
+        if self.queue_depth >= self.max_queue:
+            if rank != _PRIORITY_RANK[INTERACTIVE] or not self._evict_batch_waiter():
+                raise self._shed("queue_full")
+
+        timeout = remaining_seconds()
+        if timeout is not None and timeout <= 0:
+            raise self._shed("deadline")
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (rank, next(self._seq), fut))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=timeout)
+        except asyncio.TimeoutError:
+            if not self._abandon(fut):
+                raise self._shed("deadline")
+        except asyncio.CancelledError:
+            if self._abandon(fut):
+                self._hand_off()
+            raise
+        waited = time.monotonic() - started
+        self.admitted += 1
+        self.total_wait_seconds += waited
+        return waited
+
+    def _abandon(self, fut: asyncio.Future) -> bool:
+        """
+        Withdraw a waiter. Returns True when the slot had already been handed over,
+        in which case the caller owns it (used on timeout) or it is passed on (on cancel).
+        """
+        if fut.done() and not fut.cancelled() and fut.exception() is None:
+            return True
+        fut.cancel()
+        return False
+
+    def release(self, service_seconds: float, lingered: bool = False) -> None:
+        if lingered:
+            self.lingering -= 1
+        self.completed += 1
+        self.total_service_seconds += service_seconds
+        self._hand_off()
+
+    def _hand_off(self) -> None:
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                # Hand the slot straight to the next waiter; in-flight count is unchanged
+                fut.set_result(True)
+                return
+        self._in_flight -= 1
+
+    def snapshot(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queue_depth,
+            "max_queue": self.max_queue,
+            "max_queue_depth_seen": self.max_queue_depth,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "lingering": self.lingering,
+            "avg_wait_seconds": self.total_wait_seconds / self.admitted if self.admitted else 0.0,
+            "avg_service_seconds": self.total_service_seconds / self.completed if self.completed else 0.0,
+        }
+
+
+class AdmissionScheduler:
+    """
+    Per-backend admission control shared by every request handled by this worker.
+    """
+    def __init__(self, limits: dict[str, int], max_queue: int):
+        self.limiters = {name: BackendLimiter(name, limit, max_queue) for name, limit in limits.items()}
+
+    @asynccontextmanager
+    async def slot(self, backend: str):
+        limiter = self.limiters[backend]
+        priority = current_priority()
+        # Queue wait and time holding the slot show up as separate request stages
+        with stage(f"{backend}.queue"):
+            waited = await limiter.acquire(priority)
+        if waited > 0:
+            log_event("scheduler/wait", {"backend": backend, "priority": priority, "wait_s": waited})
+        started = time.monotonic()
+        lingering = []
+        token = _lingering.set(lingering)
+        try:
+            with stage(backend):
+                yield
+        finally:
+            _lingering.reset(token)
+            pending = [work for work in lingering if not work.done()]
+            if pending:
+                limiter.lingering += 1
+                asyncio.gather(*pending, return_exceptions=True).add_done_callback(
+                    lambda _: limiter.release(time.monotonic() - started, lingered=True)
+                )
+            else:
+                limiter.release(time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        return {name: limiter.snapshot() for name, limiter in self.limiters.items()}
+
+
+_scheduler: AdmissionScheduler | None = None
+
+def get_scheduler() -> AdmissionScheduler:
+    # Handlers are created per request, so the scheduler is a worker-wide singleton
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = AdmissionScheduler(
+            limits={
+                "bigquery": settings.BIGQUERY_MAX_CONCURRENCY,
+                "vertex_llm": settings.VERTEX_LLM_MAX_CONCURRENCY,
+                "sql_generation": settings.SQL_GENERATION_MAX_CONCURRENCY,
+            },
+            max_queue=settings.SCHEDULER_MAX_QUEUE,
+        )
+    return _scheduler
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+from ..utils.wandb_monitor import log_event
+from .scheduler import get_scheduler, hold_slot_for
+
+# Worker-wide counters for speculative races and hedged LLM calls.
+# "wasted" is the time a losing branch had already spent when it was cancelled.
+_stats = {
+    "races": 0,
+    "race_wins": {},
+    "race_budget_exhausted": 0,
+    "cancelled_branches": 0,
+    "wasted_seconds": 0.0,
+    "hedged_calls": 0,
+    "hedges_sent": 0,
+    "hedges_skipped": 0, # No free slot for the hedge
+    "hedge_wins": 0,
+    "hedge_wasted_seconds": 0.0,
+}
+
+
+def get_speculation_stats() -> dict:
+    """
+    Snapshot of the speculative-execution counters for this worker.
+    """
+    snapshot = dict(_stats)
+    snapshot["race_wins"] = dict(_stats["race_wins"])
+    return snapshot
+
+
+async def race_first_acceptable(
+    branches: dict[str, Callable[[], Awaitable[Any]]],
+    accept: Callable[[str, Any], bool],
+    budget_seconds: float,
+    fallback: Callable[[str, Any], bool] | None = None,
+) -> tuple[str | None, Any]:
+    """
+    Start every branch at once and return (branch_name, result) for the first
+    branch whose result passes `accept`. Remaining branches are cancelled; their
+    BigQuery jobs are cancelled too, and any backend thread that cannot be
+    interrupted keeps its scheduler slot until it returns (see call_with_resilience).
+
+    Branches that raise or return an unacceptable result simply drop out of the
+    race. A result that fails `accept` but passes `fallback` is held back and
+    returned only once every other branch has finished without an acceptable
+    result. Otherwise, if no branch is acceptable, the last exception raised is
+    re-raised; if none raised, (None, None) is returned. Exceeding the budget
+    raises asyncio.TimeoutError.
+    """
+    started = time.monotonic()
+    tasks = {asyncio.create_task(factory()): name for name, factory in branches.items()}
+    pending = set(tasks)
+    last_error: BaseException | None = None
+    winner: tuple[str | None, Any] = (None, None)
+    held: tuple[str | None, Any] = (None, None)
+    _stats["races"] += 1
+
+    try:
+        while pending:
+            remaining = budget_seconds - (time.monotonic() - started)
+            if remaining <= 0:
+                _stats["race_budget_exhausted"] += 1
+                raise asyncio.TimeoutError(f"Speculative budget of {budget_seconds}s exhausted")
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks[task]
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                result = task.result()
+                if accept(name, result):
+                    winner = (name, result)
+                    break
+                if fallback is not None and held[0] is None and fallback(name, result):
+                    held = (name, result)
+            if winner[0] is not None:
+                break
+    finally:
+        elapsed = time.monotonic() - started
+        for task in pending:
+            task.cancel()
+        if pending:
+            _stats["cancelled_branches"] += len(pending)
+            _stats["wasted_seconds"] += elapsed * len(pending)
+
+    if winner[0] is None and held[0] is not None:
+        winner = held
+    if winner[0] is not None:
+        _stats["race_wins"][winner[0]] = _stats["race_wins"].get(winner[0], 0) + 1
+    log_event("speculative/race", {
+        "winner": winner[0],
+        "elapsed_s": elapsed,
+        "cancelled": [tasks[t] for t in pending],
+        "wasted_s": elapsed * len(pending),
+    })
+
+    if winner[0] is None and last_error is not None:
+        raise last_error
+    return winner
+
+
+async def hedged_call(
+    fn: Callable[[], Any],
+    hedge_delay_seconds: float,
+    budget_seconds: float,
+    label: str = "llm",
+    backend: str | None = None,
+) -> Any:
+    """
+    Run the synchronous `fn` in a worker thread. If it has not returned after
+    `hedge_delay_seconds` (typically the observed p95), fire an identical second
+    call and return whichever finishes first.
+
+    The caller's scheduler slot covers the primary. With `backend` set, the hedge
+    needs a second slot of its own and is skipped when none is free, so hedging
+    never exceeds the backend's concurrency limit. Threads cannot be interrupted:
+    a losing attempt keeps its slot until it returns, its result is discarded and
+    its elapsed time is counted as wasted work. An error from one attempt is only
+    raised once the other attempt has also failed.
+    """
+    started = time.monotonic()
+    _stats["hedged_calls"] += 1
+    primary = asyncio.create_task(asyncio.to_thread(fn))
+    attempts = {primary: "primary"}
+    pending = {primary}
+
+    try:
+        first_wait = min(hedge_delay_seconds, budget_seconds)
+        done, pending = await asyncio.wait(pending, timeout=first_wait)
+        if done:
+            return primary.result()
+
+        limiter = get_scheduler().limiters[backend] if backend else None
+        if limiter is None or limiter.try_acquire():
+            hedge = asyncio.create_task(asyncio.to_thread(fn))
+            attempts[hedge] = "hedge"
+            pending.add(hedge)
+            _stats["hedges_sent"] += 1
+            if limiter is not None:
+                hedge_started = time.monotonic()
+                hedge.add_done_callback(lambda _: limiter.release(time.monotonic() - hedge_started))
+        else:
+            _stats["hedges_skipped"] += 1
+
+        last_error: BaseException | None = None
+        while pending:
+            remaining = budget_seconds - (time.monotonic() - started)
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"{label} call exceeded budget of {budget_seconds}s")
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                    continue
+                if attempts[task] == "hedge":
+                    _stats["hedge_wins"] += 1
+                return task.result()
+        raise last_error
+    finally:
+        elapsed = time.monotonic() - started
+        for task in pending:
+            # Cancelling would only mark the task done while its thread runs on
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            if task is primary:
+                hold_slot_for(task)
+        if pending:
+            _stats["hedge_wasted_seconds"] += elapsed
+        if len(attempts) > 1:
+            log_event("speculative/hedge", {
+                "label": label,
+                "elapsed_s": elapsed,
+                "abandoned": [attempts[t] for t in pending],
+            })
@@ -0,0 +1,322 @@
+import asyncio
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+from .bigquery_handler import BigQueryHandler
+
+# Physician phrasing -> (LOINC codes, display label). Blood pressure readings are
+# panel components in Synthea, so the systolic/diastolic component codes are used.
+LOINC_TERMS = {
+    "hba1c": (["4548-4"], "Hemoglobin A1c"),
+    "a1c": (["4548-4"], "Hemoglobin A1c"),
+    "blood pressure": (["8480-6", "8462-4"], "Blood pressure"),
+    "bp": (["8480-6", "8462-4"], "Blood pressure"),
+    "systolic": (["8480-6"], "Systolic blood pressure"),
+    "diastolic": (["8462-4"], "Diastolic blood pressure"),
+    "heart rate": (["8867-4"], "Heart rate"),
+    "pulse": (["8867-4"], "Heart rate"),
+    "weight": (["29463-7"], "Body weight"),
+    "bmi": (["39156-5"], "Body mass index"),
+    "glucose": (["2339-0"], "Glucose"),
+    "ldl": (["18262-6"], "LDL cholesterol"),
+    "hdl": (["2085-9"], "HDL cholesterol"),
+    "cholesterol": (["2093-3"], "Total cholesterol"),
+    "triglyceride": (["2571-8"], "Triglycerides"),
+    "creatinine": (["2160-0"], "Creatinine"),
+    "egfr": (["33914-3"], "eGFR"),
+    "respiratory rate": (["9279-1"], "Respiratory rate"),
+    "temperature": (["8310-5"], "Body temperature"),
+}
+
+_LOINC_WORDS = {word for term in LOINC_TERMS for word in term.split()}
+
+TREND_KEYWORDS = [
+    "trend", "changed", "change", "over time", "over the last", "over the past",
+    "since", "progress", "improv", "worse", "history of",
+]
+
+_WINDOW_PATTERN = re.compile(r"(?:last|past)\s+(\d+|a|one)?\s*(day|week|month|year)s?")
+_WINDOW_DAYS = {"day": 1, "week": 7, "month": 30, "year": 365}
+_ANCHOR_PATTERN = re.compile(r"\b(?:since|after|before)\s+((?:[a-z\-]+\s*){1,5})")
+# Words that can sit between "since" and the medication name, or describe a time window instead
+_ANCHOR_FILLER = {
+    "she", "he", "they", "the", "her", "his", "their", "patient", "started", "starting",
+    "start", "began", "beginning", "initiation", "of", "on", "taking", "was", "were", "being",
+    "last", "past", "this", "year", "years", "month", "months", "week", "weeks", "day", "days",
+    "then", "a", "an", "since", "after", "before", "it", "is", "has", "had", "been", "first",
+}
+# Anchors that are events, not medications; their dates are unknown here, so such questions
+# are left to the other paths
+_EVENT_ANCHORS = {
+    "visit", "visits", "appointment", "admission", "discharge", "diagnosis", "diagnosed",
+    "surgery", "operation", "procedure", "hospitalization", "pregnancy", "delivery", "birth",
+    "high", "low", "elevated", "normal", "abnormal", "today", "yesterday", "now",
+    # A drug class without a drug name ("since her bp meds were increased") cannot be looked up
+    "med", "meds", "medication", "medications", "medicine", "medicines", "drug", "drugs",
+    "prescription", "prescriptions", "pill", "pills", "dose", "dosage",
+}
+_MONTHS = {
+    name: number for number, names in enumerate([
+        ("jan", "january"), ("feb", "february"), ("mar", "march"), ("apr", "april"), ("may",),
+        ("jun", "june"), ("jul", "july"), ("aug", "august"), ("sep", "sept", "september"),
+        ("oct", "october"), ("nov", "november"), ("dec", "december"),
+    ], start=1) for name in names
+}
+# "since 2020", "since 2021-03-15", "since march 2021", "since march"
+_SINCE_DATE_PATTERN = re.compile(
+    r"\b(?:since|after)\s+(?:(\d{4})-(\d{1,2})(?:-(\d{1,2}))?\b|(" + "|".join(_MONTHS) + r")\b\.?(?:\s+(\d{4}))?|(\d{4})\b)"
+)
+
+# A measurement term directly before one of these names a drug class ("blood pressure
+# medication", "cholesterol meds"), not the measurement itself
+_MEDICATION_NOUN = r"(?:\s+lowering)?\s+(?:med|meds|medication|medications|medicine|medicines|drug|drugs|prescription|prescriptions|pill|pills|dose|dosage)\b"
+
+ROLLING_WINDOW = 3
+
+
+@dataclass
+class TrendRequest:
+    loinc_codes: list[str]
+    labels: list[str]
+    window_days: int | None = None
+    medication_term: str | None = None
+    since_date: date | None = None # From "since 2020" / "since March"
+
+
+@dataclass
+class CodeSeries:
+    """
+    One LOINC code's observations in one unit for a patient, held as aligned NumPy arrays.
+    """
+    loinc_code: str
+    label: str
+    unit: str | None
+    times: np.ndarray # int64 epoch seconds, ascending
+    values: np.ndarray # float64
+    facts: dict = field(default_factory=dict)
+
+
+def detect_trend_request(query_text: str) -> TrendRequest | None:
+    """
+    Recognise trend-style questions about known labs/vitals. Returns None when the
+    question is not a trend question or names no measurement we can map to LOINC.
+    """
+    text = query_text.lower()
+    if not any(keyword in text for keyword in TREND_KEYWORDS):
+        return None
+
+    codes: list[str] = []
+    labels: list[str] = []
+    for term, (term_codes, label) in LOINC_TERMS.items():
+        mentions = re.finditer(rf"\b{re.escape(term)}\b", text)
+        measured = any(not re.match(_MEDICATION_NOUN, text[m.end():]) for m in mentions)
+        if measured and label not in labels:
+            codes.extend(c for c in term_codes if c not in codes)
+            labels.append(label)
+    if not codes:
+        return None
+
+    window_days = None
+    window_match = _WINDOW_PATTERN.search(text)
+    if window_match:
+        count = window_match.group(1)
+        count = 1 if count in (None, "a", "one") else int(count)
+        window_days = count * _WINDOW_DAYS[window_match.group(2)]
+
+    since_date = _parse_since_date(text)
+
+    medication_term = None
+    for anchor_match in _ANCHOR_PATTERN.finditer(text):
+        if since_date is not None and _SINCE_DATE_PATTERN.match(text, anchor_match.start()):
+            continue
+        for word in anchor_match.group(1).split():
+            if word in _EVENT_ANCHORS:
+                # "since her surgery", "since last visit": an anchor we cannot date
+                return None
+            if word not in _ANCHOR_FILLER and word not in _LOINC_WORDS and len(word) >= 3:
+                medication_term = word
+                break
+        if medication_term:
+            break
+
+    return TrendRequest(codes, labels, window_days, medication_term, since_date)
+
+
+def _parse_since_date(text: str, today: date | None = None) -> date | None:
+    """
+    Start date of a "since <year | month [year] | ISO date>" phrase. A bare month
+    means its most recent occurrence.
+    """
+    match = _SINCE_DATE_PATTERN.search(text)
+    if match is None:
+        return None
+    today = today or datetime.now(timezone.utc).date()
+    iso_year, iso_month, iso_day, month_name, month_year, year = match.groups()
+    try:
+        if iso_year:
+            return date(int(iso_year), int(iso_month), int(iso_day or 1))
+        if month_name:
+            month = _MONTHS[month_name]
+            if month_year:
+                return date(int(month_year), month, 1)
+            return date(today.year if month <= today.month else today.year - 1, month, 1)
+        return date(int(year), 1, 1)
+    except ValueError:
+        return None
+
+
+def compute_series_facts(series: CodeSeries, anchor_time: int | None = None) -> dict:
+    """
+    Vectorised summary statistics for one series; optionally split around
+    `anchor_time` (epoch seconds, e.g. a medication's authoredOn).
+    """
+    t, v = series.times, series.values
+    n = v.size
+    facts = {"count": int(n)}
+    if n == 0:
+        return facts
+
+    facts.update({
+        "first_value": float(v[0]), "first_time": int(t[0]),
+        "latest_value": float(v[-1]), "latest_time": int(t[-1]),
+        "min_value": float(v.min()), "min_time": int(t[v.argmin()]),
+        "max_value": float(v.max()), "max_time": int(t[v.argmax()]),
+        "mean": float(v.mean()),
+        "delta": float(v[-1] - v[0]),
+        "pct_change": float((v[-1] - v[0]) / v[0] * 100.0) if v[0] != 0 else None,
+    })
+    if n >= 2:
+        facts["last_step_delta"] = float(v[-1] - v[-2])
+    if n >= ROLLING_WINDOW:
+        rolling = np.convolve(v, np.ones(ROLLING_WINDOW) / ROLLING_WINDOW, mode="valid")
+        facts["rolling_mean_latest"] = float(rolling[-1])
+        facts["rolling_mean_first"] = float(rolling[0])
+    if n >= 2 and t[-1] > t[0]:
+        years = (t - t[0]) / (365.25 * 86400.0)
+        facts["slope_per_year"] = float(np.polyfit(years, v, 1)[0])
+
+    if anchor_time is not None:
+        before = t < anchor_time
+        after = ~before
+        comparison = {"before_count": int(before.sum()), "after_count": int(after.sum())}
+        if before.any():
+            comparison["before_mean"] = float(v[before].mean())
+            comparison["last_before"] = float(v[before][-1])
+        if after.any():
+            comparison["after_mean"] = float(v[after].mean())
+            comparison["latest_after"] = float(v[after][-1])
+        if before.any() and after.any():
+            comparison["mean_delta"] = comparison["after_mean"] - comparison["before_mean"]
+            comparison["last_before_to_latest_delta"] = comparison["latest_after"] - comparison["last_before"]
+        facts["around_anchor"] = comparison
+    return facts
+
+
+def _fmt_date(epoch_seconds: int) -> str:
+    return datetime.fromtimestamp(epoch_seconds, tz=timezone.utc).strftime("%Y-%m-%d")
+
+
+def _fmt(value: float | None, unit: str | None = None) -> str:
+    if value is None:
+        return "N/A"
+    text = f"{value:.4g}" if abs(value) < 1000 else f"{value:.0f}"
+    return f"{text} {unit}" if unit else text
+
+
+def format_fact_sheet(
+    series_list: list[CodeSeries],
+    request: TrendRequest,
+    medication_name: str | None = None,
+    medication_start: int | None = None
+) -> str:
+    """
+    Compact, LLM-ready text of the computed facts (no raw rows).
+    """
+    lines = []
+    window_start = datetime.now(timezone.utc).date() - timedelta(days=request.window_days) if request.window_days else None
+    # When both are given, the later start is the one applied
+    if request.since_date and (window_start is None or request.since_date > window_start):
+        lines.append(f"Window: since {request.since_date.isoformat()}")
+    elif request.window_days:
+        lines.append(f"Window: last {request.window_days} days")
+    if request.medication_term and medication_start is not None:
+        lines.append(f"Anchor: {medication_name or request.medication_term} first prescribed {_fmt_date(medication_start)}")
+    codes_seen = [series.loinc_code for series in series_list]
+    for series in series_list:
+        f, unit = series.facts, series.unit
+        # Measurements recorded in different units are summarised separately, never mixed
+        unit_note = f", recorded in {unit or 'no unit'}" if codes_seen.count(series.loinc_code) > 1 else ""
+        lines.append(f"{series.label} (LOINC {series.loinc_code}{unit_note}), {f['count']} measurements:")
+        if not f["count"]:
+            continue
+        lines.append(f"- Latest: {_fmt(f['latest_value'], unit)} on {_fmt_date(f['latest_time'])}")
+        lines.append(f"- Earliest: {_fmt(f['first_value'], unit)} on {_fmt_date(f['first_time'])}")
+        lines.append(f"- Range: {_fmt(f['min_value'], unit)} ({_fmt_date(f['min_time'])}) to {_fmt(f['max_value'], unit)} ({_fmt_date(f['max_time'])}); mean {_fmt(f['mean'], unit)}")
+        change = f"- Change first to latest: {_fmt(f['delta'], unit)}"
+        if f.get("pct_change") is not None:
+            change += f" ({f['pct_change']:+.1f}%)"
+        lines.append(change)
+        if "rolling_mean_latest" in f:
+            lines.append(f"- {ROLLING_WINDOW}-point rolling mean: {_fmt(f['rolling_mean_first'], unit)} -> {_fmt(f['rolling_mean_latest'], unit)}")
+        if "slope_per_year" in f:
+            lines.append(f"- Linear trend: {_fmt(f['slope_per_year'], unit)} per year")
+        around = f.get("around_anchor")
+        if around:
+            lines.append(f"- Before anchor: {around['before_count']} measurements, mean {_fmt(around.get('before_mean'), unit)}; after: {around['after_count']} measurements, mean {_fmt(around.get('after_mean'), unit)}")
+            if "mean_delta" in around:
+                lines.append(f"- Mean change after anchor: {_fmt(around['mean_delta'], unit)}; last before -> latest: {_fmt(around['last_before_to_latest_delta'], unit)}")
+    return "\n".join(lines)
+
+
+class TrendEngine:
+    """
+    Answers lab/vital trend questions locally: one BigQuery job for the series,
+    NumPy for the statistics, and a compact fact sheet for the LLM.
+    """
+    def __init__(self, bq_handler: BigQueryHandler):
+        self.bq_handler = bq_handler
+
+    async def build_fact_sheet(self, patient_id: str, request: TrendRequest) -> tuple[str, list[CodeSeries]] | None:
+        starts = []
+        if request.window_days:
+            starts.append(datetime.now(timezone.utc) - timedelta(days=request.window_days))
+        if request.since_date:
+            starts.append(datetime(request.since_date.year, request.since_date.month, request.since_date.day, tzinfo=timezone.utc))
+        since = max(starts) if starts else None
+
+        series_task = self.bq_handler.fetch_observation_series(patient_id, request.loinc_codes, since)
+        if request.medication_term:
+            rows, medication = await asyncio.gather(
+                series_task,
+                self.bq_handler.fetch_medication_start(patient_id, request.medication_term)
+            )
+        else:
+            rows, medication = await series_task, None
+        if not rows:
+            return None
+        if request.medication_term and medication is None:
+            # The anchor word is not one of the patient's medications ("since her fall"), so
+            # this is not a question the engine understood; let the other paths answer it
+            return None
+
+        medication_name = medication.get("medication_name") if medication else None
+        medication_start = medication.get("started_at") if medication else None
+        anchor_time = int(medication_start.timestamp()) if medication_start is not None else None
+
+        series_list = []
+        for row in sorted(rows, key=lambda r: (request.loinc_codes.index(r["loinc_code"]), r.get("unit") or "")):
+            series = CodeSeries(
+                loinc_code=row["loinc_code"],
+                label=row.get("label") or row["loinc_code"],
+                unit=row.get("unit"),
+                times=np.asarray(row["times"], dtype=np.int64),
+                values=np.asarray(row["vals"], dtype=np.float64),
+            )
+            series.facts = compute_series_facts(series, anchor_time)
+            series_list.append(series)
+
+        fact_sheet = format_fact_sheet(series_list, request, medication_name, anchor_time)
+        return fact_sheet, series_list
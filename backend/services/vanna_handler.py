@@ -1,9 +1,13 @@
+import asyncio
 import vanna
 # Corrected imports for Vanna Vertex AI and BigQuery connectors
 from vanna.google import GoogleGeminiChat # Changed from vanna.vertex
 from vanna.google import BigQuery_VectorStore
-from ..utils.schema_loader import get_fhir_synthea_schema
+from ..utils.schema_loader import build_table_ddl, load_fhir_synthea_tables
+from ..utils.schema_selector import SchemaSelector
 from ..utils.wandb_monitor import log_event
+from .scheduler import get_scheduler
+from .resilience import CircuitOpenError, DeadlineExceededError, RetriesExhaustedError, call_with_resilience
 
 from ..config import settings
 from google.oauth2 import service_account
@@ -29,6 +33,14 @@ class VannaBigQueryGemini(GoogleGeminiChat, BigQuery_VectorStore):
         # Initialize GoogleBigQuery for database connection
         # It expects project_id where jobs will run.
         BigQuery_VectorStore.__init__(self, config=bigquery_config)
+        # Set by VannaHandler; when present it replaces vector-store DDL retrieval
+        self.schema_selector: SchemaSelector | None = None
+
+    def get_related_ddl(self, question: str, **kwargs) -> list:
+        # Only the tables/columns relevant to this question go into the prompt
+        if self.schema_selector is not None:
+            return list(self.schema_selector.select_ddls(question).values())
+        return super().get_related_ddl(question, **kwargs)
 
 class VannaHandler: # VannaHandler does not need to inherit from Vanna classes
     def __init__(self):
@@ -62,11 +74,19 @@ class VannaHandler: # VannaHandler does not need to inherit from Vanna classes
         # Basic training (idempotent, Vanna typically stores training data)
         # In a production setup, you might manage training data more robustly.
         existing_training_data = self.vn.get_training_data()
-        dynamic_ddls = list(
-            get_fhir_synthea_schema(
-                settings.BIGQUERY_PROJECT_ID,
-                settings.FHIR_DATASET_ID
-            ).values()
+        tables = load_fhir_synthea_tables(
+            settings.BIGQUERY_PROJECT_ID,
+            settings.FHIR_DATASET_ID
+        )
+        dynamic_ddls = [
+            build_table_ddl(fq_table, fields, settings.SCHEMA_STRUCT_DEPTH)
+            for fq_table, fields in tables.items()
+        ]
+        self.vn.schema_selector = SchemaSelector(
+            tables,
+            max_depth=settings.SCHEMA_STRUCT_DEPTH,
+            max_tables=settings.SCHEMA_MAX_TABLES,
+            max_columns=settings.SCHEMA_MAX_COLUMNS
         )
         if existing_training_data.empty or len(existing_training_data) < len(dynamic_ddls):
             print("Training Vanna with full dynamically extracted DDLs...")
@@ -76,6 +96,15 @@ class VannaHandler: # VannaHandler does not need to inherit from Vanna classes
             log_event("vanna/training_end", {})
 
     async def get_response(self, natural_language_query: str, patient_id: str) -> tuple[str, str | None]: # Return type changed to tuple[str, str | None]
+        # Admission control: one sql_generation slot covers the whole ask (generate, run, summarise).
+        # vn.ask calls Gemini and BigQuery from one thread, so it also holds one slot of each for
+        # its duration; otherwise those limits would not cap Vanna's share of the quota.
+        # Slots are always taken in this order, so nested acquisition cannot deadlock.
+        scheduler = get_scheduler()
+        async with scheduler.slot("sql_generation"), scheduler.slot("vertex_llm"), scheduler.slot("bigquery"):
+            return await self._ask(natural_language_query, patient_id)
+
+    async def _ask(self, natural_language_query: str, patient_id: str) -> tuple[str, str | None]:
         # Use patient_id as a parameter that Vanna can potentially use in SQL
         # The vn.ask method attempts to generate SQL, run it, and generate a natural language response.
         # It can also return charts, but we're interested in the text response and SQL.
@@ -94,7 +123,12 @@ class VannaHandler: # VannaHandler does not need to inherit from Vanna classes
             # The vn.ask method in recent Vanna versions (especially with GoogleGeminiChat)
             # often returns the SQL query as the first element of a tuple if successful,
             # and the natural language answer or DataFrame as other elements.
-            response_content = self.vn.ask(question=question_with_context, print_results=False)
+            # Bounded by the request deadline and guarded by the sql_generation breaker
+            response_content = await call_with_resilience(
+                lambda timeout: asyncio.to_thread(self.vn.ask, question=question_with_context, print_results=False),
+                backend="sql_generation",
+                model=settings.LLM_MODEL_NAME
+            )
             
             final_nl_answer = "Could not retrieve an answer from Vanna."
             sql_query = None
@@ -137,6 +171,9 @@ class VannaHandler: # VannaHandler does not need to inherit from Vanna classes
             log_event("response/vanna", {"answer": final_nl_answer, "sql": sql_query})
 
             return final_nl_answer, sql_query
+        except (CircuitOpenError, DeadlineExceededError, RetriesExhaustedError):
+            # Let the caller fail fast or fall back instead of masking the outage
+            raise
         except Exception as e:
             print(f"Error during Vanna interaction: {e}")
             log_event("error/vanna", {"error": str(e)})
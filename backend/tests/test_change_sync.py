@@ -0,0 +1,62 @@
+import asyncio
+import json
+import os
+import shutil
+
+from backend.services.change_sync import (
+    ChangeBus,
+    FixtureChangeSource,
+    IncrementalSync,
+    SqliteMirror,
+    WatermarkStore,
+)
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "change_sync_fixture.json")
+
+
+def _build_sync(tmp_path, fixture_path, events, page_size=2):
+    bus = ChangeBus()
+    bus.subscribe(lambda resource_type, patient_ids: events.append((resource_type, patient_ids)))
+    return IncrementalSync(
+        source=FixtureChangeSource(fixture_path),
+        mirror=SqliteMirror(str(tmp_path / "mirror.sqlite3")),
+        watermarks=WatermarkStore(str(tmp_path / "watermarks.json")),
+        resource_types=["Patient", "Condition", "Immunization"],
+        bus=bus,
+        page_size=page_size,
+    )
+
+
+def test_first_run_pages_every_row_including_ties_and_missing_last_updated(tmp_path):
+    events = []
+    stats = asyncio.run(_build_sync(tmp_path, FIXTURE, events).run_once())
+
+    # p3 has no meta.lastUpdated and sorts as EPOCH; p1/p2 and c1/c2 share a timestamp across a page boundary
+    assert stats["Patient"] == {"fetched": 3, "applied": 3, "patients": 3}
+    assert stats["Condition"] == {"fetched": 3, "applied": 3, "patients": 2}
+    # Immunization references its patient through `patient`, not `subject`
+    assert stats["Immunization"] == {"fetched": 1, "applied": 1, "patients": 1}
+    assert ("Immunization", {"p3"}) in events
+
+
+def test_second_run_fetches_only_changed_rows(tmp_path):
+    fixture_path = str(tmp_path / "fixture.json")
+    shutil.copy(FIXTURE, fixture_path)
+    asyncio.run(_build_sync(tmp_path, fixture_path, []).run_once())
+
+    events = []
+    stats = asyncio.run(_build_sync(tmp_path, fixture_path, events).run_once())
+    assert all(s["fetched"] == 0 for s in stats.values())
+    assert events == []
+
+    with open(fixture_path) as f:
+        resources = json.load(f)
+    resources["Condition"][1]["meta"]["lastUpdated"] = "2024-05-01T00:00:00Z"
+    resources["Condition"][1]["code"]["text"] = "Asthma, resolved"
+    with open(fixture_path, "w") as f:
+        json.dump(resources, f)
+
+    stats = asyncio.run(_build_sync(tmp_path, fixture_path, events).run_once())
+    assert stats["Condition"] == {"fetched": 1, "applied": 1, "patients": 1}
+    assert stats["Patient"]["fetched"] == 0
+    assert events == [("Condition", {"p2"})]
@@ -0,0 +1,364 @@
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from ..config import settings
+
+# Profiles hold code locations only: module and function names, never frame
+# locals, arguments, SQL text, URLs or request bodies, so they carry no PHI.
+# Slow-request captures record the route template ("/chat/{patient_id}/history"),
+# never the concrete path or query string.
+
+_stages: contextvars.ContextVar[list | None] = contextvars.ContextVar("request_stages", default=None)
+
+
+def _frame_label(frame) -> str:
+    module = frame.f_globals.get("__name__") or os.path.basename(frame.f_code.co_filename)
+    return f"{module}:{frame.f_code.co_name}"
+
+
+def _folded_stack(thread_name: str, frame) -> str:
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name.replace(";", "_").replace(" ", "_"))
+    # Folded format is root first: "thread;outer;...;leaf"
+    return ";".join(reversed(labels))
+
+
+def write_folded(path: str, stacks: Counter) -> str:
+    """
+    Write stacks as Brendan Gregg folded lines ("a;b;c <count>"), the input
+    format of flamegraph.pl, speedscope and inferno.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+# --- stage timings ---------------------------------------------------------+
+def start_stage_trace() -> list:
+    """
+    Begin collecting stage timings for the current request. Returns the list
+    that stage() appends to; tasks spawned afterwards share it.
+    """
+    stages = []
+    _stages.set(stages)
+    return stages
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a named stage of the current request (no-op outside a trace). Names
+    must be fixed labels such as "bigquery", never data.
+    """
+    stages = _stages.get()
+    if stages is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.append({"stage": name, "started": started, "seconds": round(time.perf_counter() - started, 6)})
+
+
+# --- sampling profiler -----------------------------------------------------+
+class SamplingSession:
+    """
+    One run of the sampler. Its thread, stop flag and stacks are its own, so
+    stopping one session can never end or read another that started later.
+    """
+    def __init__(self, seconds: float):
+        self.until = time.monotonic() + seconds
+        self.stop_event = threading.Event()
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.thread: threading.Thread | None = None
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's stack with sys._current_frames() from a daemon
+    thread. Nothing is installed in the profiled code, so the cost is one walk
+    of each thread's stack per interval and zero when not running. Idle time
+    shows up as the event loop's selector frames, which separates waiting on
+    the network from Python CPU.
+
+    Samples cover the whole worker: every request in flight shows up, not just
+    the one that asked for the profile.
+    """
+    def __init__(self, interval_seconds: float):
+        self.interval_seconds = interval_seconds
+        self._session: SamplingSession | None = None
+
+    @property
+    def running(self) -> bool:
+        session = self._session
+        return session is not None and session.thread.is_alive()
+
+    def _run(self, session: SamplingSession) -> None:
+        own_id = threading.get_ident()
+        while not session.stop_event.is_set() and time.monotonic() < session.until:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    session.stacks[_folded_stack(names.get(thread_id, str(thread_id)), frame)] += 1
+            session.samples += 1
+            session.stop_event.wait(self.interval_seconds)
+
+    def start(self, seconds: float) -> SamplingSession:
+        """
+        Start sampling for at most `seconds`; the returned session is the token
+        for stop().
+        """
+        if self.running:
+            raise RuntimeError("A profiling session is already running")
+        session = SamplingSession(seconds)
+        session.thread = threading.Thread(target=self._run, args=(session,), name="sampling-profiler", daemon=True)
+        self._session = session
+        session.thread.start()
+        return session
+
+    def stop(self, session: SamplingSession) -> Counter:
+        session.stop_event.set()
+        session.thread.join()
+        if self._session is session:
+            self._session = None
+        return session.stacks
+
+
+# --- event loop watchdog ---------------------------------------------------+
+class LoopWatchdog:
+    """
+    Detects event-loop blocking. A coroutine stamps a heartbeat every
+    `interval`; a thread checks it and, when the loop has been stuck for longer
+    than `threshold`, records the loop thread's stack, i.e. the code holding it.
+    """
+    def __init__(self, threshold_seconds: float, interval_seconds: float = 0.05, history: int = 256):
+        self.threshold_seconds = threshold_seconds
+        self.interval_seconds = interval_seconds
+        self.blocked: deque = deque(maxlen=history) # {"at", "seconds", "stack"}
+        self.max_lag_seconds = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+
+    async def _beat(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        while True:
+            expected = time.monotonic() + self.interval_seconds
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval_seconds)
+            self.max_lag_seconds = max(self.max_lag_seconds, time.monotonic() - expected)
+
+    def _watch(self) -> None:
+        reported_for = None
+        while True:
+            time.sleep(self.interval_seconds)
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < self.threshold_seconds or reported_for == heartbeat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                # One record per stall, taken while the blocking code is still on the stack
+                reported_for = heartbeat
+                self.blocked.append({"at": time.time(), "seconds": round(stalled, 3), "stack": _folded_stack("event-loop", frame)})
+                print(f"Event loop blocked for {stalled:.3f}s")
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def blocked_since(self, since: float) -> list[dict]:
+        return [event for event in self.blocked if event["at"] >= since]
+
+
+# --- worker-wide state -----------------------------------------------------+
+class ProfilingHooks:
+    """
+    One per worker: the on-demand sampler (worker-wide sessions and X-Profile
+    captures share it, one at a time), the loop watchdog and slow-request
+    capture. Files written to profile_dir are pruned to max_files and max_age.
+    """
+    def __init__(
+        self,
+        profile_dir: str,
+        interval_seconds: float,
+        slow_request_seconds: float,
+        loop_block_seconds: float,
+        slow_capture_interval_seconds: float = 60,
+        max_files: int = 200,
+        max_age_seconds: float = 7 * 86400
+    ):
+        self.profile_dir = profile_dir
+        self.profiler = SamplingProfiler(interval_seconds)
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_capture_interval_seconds = slow_capture_interval_seconds
+        self.max_files = max_files
+        self.max_age_seconds = max_age_seconds
+        self.watchdog = LoopWatchdog(loop_block_seconds) if loop_block_seconds > 0 else None
+        self._session: asyncio.Task | None = None
+        self._last_slow_capture = float("-inf")
+        self._prune_lock = threading.Lock()
+        self.slow_requests = 0
+        self.slow_captures_skipped = 0
+
+    def _path(self, label: str, suffix: str) -> str:
+        return os.path.join(self.profile_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{label}-{os.getpid()}-{uuid.uuid4().hex[:6]}{suffix}")
+
+    def _prune(self) -> None:
+        """
+        Delete profile files past max_age_seconds, then the oldest beyond max_files.
+        Names start with a timestamp, so name order is age order.
+        """
+        with self._prune_lock:
+            names = self.list_profiles(limit=None)[::-1] # Oldest first
+            cutoff = time.time() - self.max_age_seconds if self.max_age_seconds > 0 else None
+            expired = [name for name in names if cutoff is not None and os.path.getmtime(os.path.join(self.profile_dir, name)) < cutoff]
+            kept = [name for name in names if name not in expired]
+            if self.max_files > 0 and len(kept) > self.max_files:
+                expired += kept[:len(kept) - self.max_files]
+            for name in expired:
+                try:
+                    os.remove(os.path.join(self.profile_dir, name))
+                except FileNotFoundError:
+                    pass # Pruned concurrently by another worker
+
+    def start_session(self, seconds: float) -> str:
+        """
+        Sample the whole worker for `seconds` in the background; returns the
+        .folded file name the session will be written to.
+        """
+        path = self._path("worker", ".folded")
+        session = self.profiler.start(seconds)
+
+        async def finish():
+            await asyncio.sleep(seconds)
+            # Stops only this session, even if it already ended and another began
+            stacks = await asyncio.to_thread(self.profiler.stop, session)
+            await asyncio.to_thread(self._write_profile, path, stacks)
+            print(f"Profile written to {path} ({session.samples} samples)")
+
+        self._session = asyncio.create_task(finish())
+        return os.path.basename(path)
+
+    def _write_profile(self, path: str, stacks: Counter) -> str:
+        write_folded(path, stacks)
+        self._prune()
+        return path
+
+    def begin_request_profile(self, max_seconds: float) -> SamplingSession | None:
+        """
+        Start a worker-wide sample for the duration of one request; None when
+        another session holds the sampler.
+        """
+        if self.profiler.running:
+            return None
+        try:
+            return self.profiler.start(max_seconds)
+        except RuntimeError:
+            return None
+
+    def end_request_profile(self, session: SamplingSession, route: str) -> str:
+        stacks = self.profiler.stop(session)
+        return os.path.basename(self._write_profile(self._path(_route_label(route), ".folded"), stacks))
+
+    def claim_slow_capture(self) -> bool:
+        """
+        Count a slow request and decide whether to capture it: at most one
+        capture per slow_capture_interval_seconds, so a backend outage that
+        slows every request does not turn into a file per request.
+        """
+        self.slow_requests += 1
+        now = time.monotonic()
+        if now - self._last_slow_capture < self.slow_capture_interval_seconds:
+            self.slow_captures_skipped += 1
+            return False
+        self._last_slow_capture = now
+        return True
+
+    def capture_slow_request(self, route: str, method: str, status_code: int, started: float, wall_started: float, seconds: float, stages: list) -> str:
+        """
+        Write stage timings and any loop-blocking stacks seen during the request.
+        """
+        record = {
+            "route": route,
+            "method": method,
+            "status_code": status_code,
+            "seconds": round(seconds, 6),
+            "stages": [
+                {"stage": s["stage"], "offset": round(s["started"] - started, 6), "seconds": s["seconds"]}
+                for s in sorted(stages, key=lambda s: s["started"])
+            ],
+            "loop_blocked": self.watchdog.blocked_since(wall_started) if self.watchdog else [],
+        }
+        path = self._path(f"slow-{_route_label(route)}", ".json")
+        os.makedirs(self.profile_dir, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(record, f, indent=2)
+        # The blocking stacks double as a small flamegraph
+        if record["loop_blocked"]:
+            write_folded(path[:-len(".json")] + ".folded", Counter(event["stack"] for event in record["loop_blocked"]))
+        self._prune()
+        print(f"Slow request on {method} {route}: {seconds:.3f}s, captured to {path}")
+        return os.path.basename(path)
+
+    def list_profiles(self, limit: int | None = 100) -> list[str]:
+        """
+        Profile file names, newest first, at most `limit` of them.
+        """
+        if not os.path.isdir(self.profile_dir):
+            return []
+        names = sorted((entry.name for entry in os.scandir(self.profile_dir) if entry.is_file()), reverse=True)
+        return names[:limit] if limit is not None else names
+
+    def profile_path(self, name: str) -> str | None:
+        # Only plain file names inside the profile directory
+        if os.path.basename(name) != name or name.startswith("."):
+            return None
+        path = os.path.join(self.profile_dir, name)
+        return path if os.path.isfile(path) else None
+
+    def snapshot(self) -> dict:
+        return {
+            "sampling": self.profiler.running,
+            "slow_requests": self.slow_requests,
+            "slow_captures_skipped": self.slow_captures_skipped,
+            "loop_max_lag_seconds": round(self.watchdog.max_lag_seconds, 6) if self.watchdog else None,
+            "loop_blocked_events": len(self.watchdog.blocked) if self.watchdog else None,
+        }
+
+
+def _route_label(route: str) -> str:
+    return "".join(ch if ch.isalnum() else "_" for ch in route).strip("_") or "root"
+
+
+_hooks: ProfilingHooks | None = None
+
+def get_profiling_hooks() -> ProfilingHooks:
+    # Worker-wide, like the scheduler; profiles describe this process only
+    global _hooks
+    if _hooks is None:
+        _hooks = ProfilingHooks(
+            settings.PROFILE_DIR,
+            interval_seconds=settings.PROFILE_SAMPLE_INTERVAL_SECONDS,
+            slow_request_seconds=settings.SLOW_REQUEST_SECONDS,
+            loop_block_seconds=settings.LOOP_BLOCK_THRESHOLD_SECONDS,
+            slow_capture_interval_seconds=settings.SLOW_REQUEST_CAPTURE_INTERVAL_SECONDS,
+            max_files=settings.PROFILE_MAX_FILES,
+            max_age_seconds=settings.PROFILE_MAX_AGE_SECONDS
+        )
+    return _hooks
@@ -0,0 +1,36 @@
+import contextvars
+import time
+
+# Per-request scheduling context. Stored in contextvars so it follows the request
+# into tasks it spawns and into asyncio.to_thread workers without extra parameters.
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+_priority: contextvars.ContextVar[str] = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("request_deadline", default=None)
+
+
+def set_request_context(priority: str = INTERACTIVE, timeout_seconds: float | None = None) -> None:
+    """
+    Record the current request's priority and absolute deadline (monotonic clock).
+    """
+    _priority.set(priority)
+    _deadline.set(time.monotonic() + timeout_seconds if timeout_seconds is not None else None)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def current_deadline() -> float | None:
+    return _deadline.get()
+
+
+def remaining_seconds() -> float | None:
+    """
+    Seconds left before the request deadline, or None when no deadline is set.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
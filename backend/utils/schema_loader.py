@@ -1,7 +1,11 @@
 from google.cloud import bigquery
 
+# Nested RECORD fields are spelled out as STRUCT<...> down to this depth;
+# anything deeper collapses to JSON to keep DDLs bounded.
+DEFAULT_STRUCT_DEPTH = 2
+
 # --- utility to build CREATE TABLE DDLs -----------------------------------+
-def _field_to_sql(field: bigquery.SchemaField) -> str:
+def _field_type_sql(field: bigquery.SchemaField, depth: int, max_depth: int) -> str:
     type_map = {
         "STRING": "STRING", "INTEGER": "INT64", "INT64": "INT64",
         "FLOAT": "FLOAT64", "FLOAT64": "FLOAT64", "BOOLEAN": "BOOL",
@@ -9,22 +13,71 @@ def _field_to_sql(field: bigquery.SchemaField) -> str:
         "TIME": "TIME", "DATETIME": "DATETIME", "NUMERIC": "NUMERIC",
         "BIGNUMERIC": "BIGNUMERIC", "GEOGRAPHY": "GEOGRAPHY", "JSON": "JSON"
     }
-    sql_type = type_map.get(field.field_type.upper(), "JSON")
+    field_type = field.field_type.upper()
+    if field_type in ("RECORD", "STRUCT") and field.fields and depth < max_depth:
+        members = ", ".join(f"{sub.name} {_field_type_sql(sub, depth + 1, max_depth)}" for sub in field.fields)
+        sql_type = f"STRUCT<{members}>"
+    else:
+        sql_type = type_map.get(field_type, "JSON")
     if field.mode == "REPEATED":
         sql_type = f"ARRAY<{sql_type}>"
-    return f"{field.name} {sql_type}"
+    return sql_type
+
+def _field_to_sql(field: bigquery.SchemaField, max_depth: int = DEFAULT_STRUCT_DEPTH) -> str:
+    return f"{field.name} {_field_type_sql(field, 0, max_depth)}"
+
+def build_table_ddl(
+    fq_table: str,
+    fields: list[bigquery.SchemaField],
+    max_depth: int = DEFAULT_STRUCT_DEPTH,
+    column_depths: dict[str, int] | None = None
+) -> str:
+    """
+    CREATE TABLE DDL with STRUCTs spelled out to `max_depth`; `column_depths`
+    overrides the depth for named top-level columns.
+    """
+    column_depths = column_depths or {}
+    columns = ",\n    ".join(_field_to_sql(f, column_depths.get(f.name, max_depth)) for f in fields)
+    return f"CREATE TABLE {fq_table} (\n    {columns}\n);"
+
+def iter_field_paths(
+    fields: list[bigquery.SchemaField],
+    max_depth: int = DEFAULT_STRUCT_DEPTH,
+    prefix: str = "",
+    depth: int = 0
+):
+    """
+    Yield (dotted_path, field) for every field down to `max_depth`,
+    e.g. ("subject.patientId", <SchemaField>).
+    """
+    for field in fields:
+        path = f"{prefix}{field.name}"
+        yield path, field
+        if field.fields and depth < max_depth:
+            yield from iter_field_paths(field.fields, max_depth, f"{path}.", depth + 1)
 
 # --- public API -----------------------------------------------------------+
-def get_fhir_synthea_schema(project_id: str, dataset_id: str) -> dict[str, str]:
+def load_fhir_synthea_tables(project_id: str, dataset_id: str) -> dict[str, list[bigquery.SchemaField]]:
     """
-    Return {fully_qualified_table_name: CREATE TABLE DDL} for every table
-    in the specified dataset.  Runs once at start-up; caller may cache.
+    Return {fully_qualified_table_name: schema fields} for every table in the dataset.
     """
     client = bigquery.Client(project=project_id)
-    ddl_map: dict[str, str] = {}
+    tables: dict[str, list[bigquery.SchemaField]] = {}
     for tbl in client.list_tables(f"{project_id}.{dataset_id}"):
         fq_table = f"`{tbl.project}.{tbl.dataset_id}.{tbl.table_id}`"
-        schema = client.get_table(tbl.reference).schema
-        columns = ",\n    ".join(_field_to_sql(f) for f in schema)
-        ddl_map[fq_table] = f"CREATE TABLE {fq_table} (\n    {columns}\n);"
-    return ddl_map
+        tables[fq_table] = list(client.get_table(tbl.reference).schema)
+    return tables
+
+def get_fhir_synthea_schema(
+    project_id: str,
+    dataset_id: str,
+    max_depth: int = DEFAULT_STRUCT_DEPTH
+) -> dict[str, str]:
+    """
+    Return {fully_qualified_table_name: CREATE TABLE DDL} for every table
+    in the specified dataset.  Runs once at start-up; caller may cache.
+    """
+    return {
+        fq_table: build_table_ddl(fq_table, fields, max_depth)
+        for fq_table, fields in load_fhir_synthea_tables(project_id, dataset_id).items()
+    }
@@ -0,0 +1,184 @@
+import math
+import re
+
+from google.cloud import bigquery
+
+from .schema_loader import DEFAULT_STRUCT_DEPTH, build_table_ddl, iter_field_paths
+
+# Short descriptions per FHIR table, mirroring the router prompt overview.
+# They give the lexical index words a physician would actually use, including
+# inflected forms ("diagnosed", "vaccinated") since tokenize() only strips plurals.
+TABLE_DESCRIPTIONS = {
+    "Patient": "patient demographics name gender sex birth date age address",
+    "AllergyIntolerance": "allergy allergies allergic intolerance reaction drug food environment",
+    "Condition": "condition conditions diagnosis diagnoses diagnosed diagnose problem disease onset",
+    "MedicationRequest": "medication medications med meds prescription prescribed prescribe taking drug ordered active stopped",
+    "MedicationDispense": "medication dispense dispensed pharmacy fill refill",
+    "MedicationAdministration": "medication administration administered inpatient dose",
+    "Observation": "observation lab labs laboratory test tested result vital vitals value measurement measured reading systolic diastolic blood pressure bp heart rate pulse weight bmi glucose a1c hba1c cholesterol",
+    "DiagnosticReport": "diagnostic report panel lab results",
+    "Procedure": "procedure procedures surgery surgical operation performed",
+    "Encounter": "encounter encounters visit visits visited admission admitted hospitalized hospitalization inpatient outpatient emergency",
+    "Immunization": "immunization immunizations immunized vaccine vaccines vaccination vaccinated shot",
+    "CarePlan": "care plan goals activities treatment plan",
+    "DocumentReference": "document documents note notes report imaging",
+    "Practitioner": "practitioner doctor physician clinician provider",
+    "PractitionerRole": "practitioner role specialty",
+    "Organization": "organization facility hospital clinic",
+    "Location": "location ward clinic site",
+    "Provenance": "provenance author source",
+    "Device": "device devices implant",
+}
+
+# Fallback when the question matches nothing in the index
+DEFAULT_TABLES = ["Patient", "Condition", "MedicationRequest", "Observation", "AllergyIntolerance"]
+
+# Top-level columns every selected table keeps: identity, patient filter, coding, value, status and timing
+KEY_COLUMNS = {
+    "id", "subject", "patient", "code", "status", "clinicalStatus", "verificationStatus",
+    "category", "effectiveDateTime", "authoredOn", "recordedDate", "onsetDateTime",
+    "period", "performedDateTime", "occurrenceDateTime", "birthDate", "name", "gender",
+    "valueQuantity", "valueString", "valueCodeableConcept", "medicationCodeableConcept",
+    "vaccineCode", "criticality", "type", "component",
+}
+
+# Columns whose values sit deeper than the default STRUCT depth. Observation panels
+# (blood pressure: systolic 8480-6, diastolic 8462-4) keep their values in
+# component[].valueQuantity / valueCodeableConcept, keyed by component[].code.coding[].code.
+DEEP_COLUMNS = {"component": 3}
+
+_STOPWORDS = {
+    "a", "an", "and", "are", "by", "did", "do", "doe", "for", "from", "had", "ha", "have",
+    "her", "his", "how", "i", "in", "is", "it", "of", "on", "or", "our", "she", "he",
+    "show", "that", "the", "their", "them", "this", "to", "wa", "what", "when", "where",
+    "which", "who", "with", "any", "all", "me", "list", "tell", "give",
+}
+
+_CAMEL_BOUNDARY = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+_NON_WORD = re.compile(r"[^a-z0-9]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lower-case word tokens with camelCase and dotted paths split apart and a
+    light plural strip, so "subject.patientId" and "patient ids" share "patient".
+    """
+    words = _NON_WORD.split(_CAMEL_BOUNDARY.sub(" ", text or "").lower())
+    tokens = []
+    for word in words:
+        if not word:
+            continue
+        if len(word) > 4 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        if word not in _STOPWORDS:
+            tokens.append(word)
+    return tokens
+
+
+def _table_short_name(fq_table: str) -> str:
+    return fq_table.strip("`").split(".")[-1]
+
+
+class SchemaSelector:
+    """
+    Precomputed lexical index over table names, table descriptions, nested field
+    paths and field descriptions. For a question it returns only the tables and
+    top-level columns that look relevant, rendered as bounded-depth DDLs.
+    """
+    def __init__(
+        self,
+        tables: dict[str, list[bigquery.SchemaField]],
+        max_depth: int = DEFAULT_STRUCT_DEPTH,
+        max_tables: int = 4,
+        max_columns: int = 14
+    ):
+        self.tables = tables
+        self.max_depth = max_depth
+        self.max_tables = max_tables
+        self.max_columns = max_columns
+
+        # table -> token -> weight (name/description hits count more than field hits)
+        self._table_terms: dict[str, dict[str, float]] = {}
+        # table -> top-level column -> tokens from its nested paths and descriptions
+        self._column_terms: dict[str, dict[str, set[str]]] = {}
+        for fq_table, fields in tables.items():
+            short_name = _table_short_name(fq_table)
+            terms: dict[str, float] = {}
+            for token in tokenize(short_name) + [short_name.lower()]:
+                terms[token] = 3.0
+            for token in tokenize(TABLE_DESCRIPTIONS.get(short_name, "")):
+                terms[token] = max(terms.get(token, 0.0), 2.0)
+            columns: dict[str, set[str]] = {}
+            for path, field in iter_field_paths(fields, max_depth):
+                column_tokens = columns.setdefault(path.split(".")[0], set())
+                column_tokens.update(tokenize(path))
+                column_tokens.update(tokenize(field.description or ""))
+            for column_tokens in columns.values():
+                for token in column_tokens:
+                    terms.setdefault(token, 1.0)
+            self._table_terms[fq_table] = terms
+            self._column_terms[fq_table] = columns
+
+        # Inverse document frequency over tables, so ubiquitous tokens ("id", "text") score ~0
+        table_count = len(self._table_terms) or 1
+        document_frequency: dict[str, int] = {}
+        for terms in self._table_terms.values():
+            for token in terms:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        self._idf = {
+            token: math.log((table_count + 1) / (count + 0.5))
+            for token, count in document_frequency.items()
+        }
+
+    def select(self, question: str) -> dict[str, list[str]]:
+        """
+        Return {fully_qualified_table: [top-level column names]} for the question.
+        """
+        query_tokens = set(tokenize(question))
+        scores = {}
+        for fq_table, terms in self._table_terms.items():
+            score = sum(terms[token] * self._idf[token] for token in query_tokens if token in terms)
+            if score > 0:
+                scores[fq_table] = score
+
+        if scores:
+            best = max(scores.values())
+            ranked = sorted(scores, key=scores.get, reverse=True)
+            chosen = [t for t in ranked if scores[t] >= 0.25 * best][:self.max_tables]
+        else:
+            chosen = [t for t in self.tables if _table_short_name(t) in DEFAULT_TABLES]
+
+        return {fq_table: self._select_columns(fq_table, query_tokens) for fq_table in chosen}
+
+    def _select_columns(self, fq_table: str, query_tokens: set[str]) -> list[str]:
+        columns = self._column_terms[fq_table]
+        keep = [name for name in columns if name in KEY_COLUMNS]
+        scored = sorted(
+            (
+                (sum(self._idf.get(token, 0.0) for token in tokens & query_tokens), name)
+                for name, tokens in columns.items() if name not in KEY_COLUMNS
+            ),
+            reverse=True
+        )
+        for score, name in scored:
+            if score <= 0 or len(keep) >= self.max_columns:
+                break
+            keep.append(name)
+        # Preserve the table's own column order in the DDL
+        return [name for name in columns if name in keep]
+
+    def select_ddls(self, question: str) -> dict[str, str]:
+        ddls = {}
+        for fq_table, columns in self.select(question).items():
+            fields = [f for f in self.tables[fq_table] if f.name in columns]
+            column_depths = {name: max(depth, self.max_depth) for name, depth in DEEP_COLUMNS.items()}
+            ddls[fq_table] = build_table_ddl(fq_table, fields, self.max_depth, column_depths)
+        return ddls
+
+    def table_info(self, question: str) -> str:
+        """
+        Pruned DDLs joined into the `table_info` block of a SQL-generation prompt.
+        """
+        return "\n\n".join(self.select_ddls(question).values())